@@ -13,30 +13,428 @@
 # limitations under the License.
 
 import argparse
+import errno
+import json
 import logging
+import os
+import re
+import signal
 import sys
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
+_import_started = time.time()
 from backup_monkey.core import BackupMonkey, Logging
 from backup_monkey import __version__
+from backup_monkey.connections import ConnectionPool
+from backup_monkey.daemon import CronSchedule, Daemon, Job
 from backup_monkey.exceptions import BackupMonkeyException
-
-from boto.utils import get_instance_metadata
+from backup_monkey.metrics import Metrics, send_statsd, write_prometheus
+from backup_monkey.report import RunReport
+from backup_monkey.retention import RetentionPolicy
+from backup_monkey.tags import parse_tag_selector
+from backup_monkey.throttle import RateLimiter
+# boto is not imported here, only once a run needs it (see --profile-startup)
+IMPORT_SECONDS = time.time() - _import_started
 
 __all__ = ('run', )
 log = logging.getLogger(__name__)
 LIMIT_LABEL = 32 # Label is added to description when created snapshot.
                      # The description limit in aws is 255
+ISOLATED_REGION_PREFIXES = ('us-gov-', 'cn-') # Need their own credentials, so
+                                               # are not part of --all-regions
+# Options that only make sense for the whole daemon, not for one of its jobs
+JOB_EXCLUDED_OPTIONS = ('help', 'version', 'verbose', 'daemon', 'plan', 'apply_plan', 'metrics_json',
+                        'metrics_prometheus', 'max_parallel_runs', 'profile_startup', 'report')
+# Where the region found through the instance meta-data is kept, so later
+# runs on the same instance do not wait for the meta-data service. It is in
+# the user's own home directory, where other users cannot plant or redirect it
+REGION_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'backup-monkey', 'region')
+REGION_CACHE_SECONDS = 86400
+REGION_RE = re.compile(r'^[a-z]{2}(-[a-z]+)+-\d+$')
 
 def _fail(message="Unknown failure", code=1):
     log.error(message)
     sys.exit(code)
 
-def run():
+def get_instance_metadata(timeout=5):
+    ''' boto.utils.get_instance_metadata, imported when first needed '''
+    from boto.utils import get_instance_metadata
+    return get_instance_metadata(timeout=timeout)
+
+def _read_region_cache():
+    ''' The region saved by _write_region_cache, unless it is too old. A
+    symlink, a file owned by another user or anything that does not look
+    like a region is ignored '''
+    try:
+        fd = os.open(REGION_CACHE_PATH, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd) as fh:
+        st = os.fstat(fd)
+        if st.st_uid != os.getuid():
+            log.warning('Ignoring %s, which is owned by another user', REGION_CACHE_PATH)
+            return None
+        if time.time() - st.st_mtime > REGION_CACHE_SECONDS:
+            return None
+        region = fh.read(64).strip()
+    return region if REGION_RE.match(region) else None
+
+def _write_region_cache(region):
+    try:
+        try:
+            os.makedirs(os.path.dirname(REGION_CACHE_PATH), 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Never follow a symlink someone else put in place of the file
+        fd = os.open(REGION_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0600)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(region + '\n')
+    except (IOError, OSError) as e:
+        log.debug('Could not save the region to %s: %s', REGION_CACHE_PATH, e)
+
+def _get_regions(args):
+    ''' Works out the list of regions to run in '''
+    if args.all_regions:
+        from boto import ec2
+        return sorted(r.name for r in ec2.regions() if not r.name.startswith(ISOLATED_REGION_PREFIXES))
+    if args.regions:
+        regions = [r.strip() for r in args.regions.split(',') if r.strip()]
+        if not regions:
+            _fail('No regions were given')
+        return regions
+    if args.region:
+        return [args.region]
+    region = os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+    if region:
+        log.debug('Running in region %s, from the environment', region)
+        return [region]
+    region = _read_region_cache()
+    if region:
+        log.debug('Running in region %s, from %s', region, REGION_CACHE_PATH)
+        return [region]
+
+    # If no region was specified, assume this is running on an EC2 instance
+    # and work out what region it is in
+    log.debug("Figure out which region I am running in...")
+    instance_metadata = get_instance_metadata(timeout=5)
+    log.debug('Instance meta-data: %s', instance_metadata)
+    if not instance_metadata:
+        _fail('Could not determine region. This script is either not running on an EC2 instance (in which case you should use the --region option), or the meta-data service is down')
+
+    region = instance_metadata['placement']['availability-zone'][:-1]
+    log.debug("Running in region: %s", region)
+    _write_region_cache(region)
+    return [region]
+
+def _get_accounts(args):
+    ''' Works out the list of accounts to run in. None is the account of the
+    credentials Backup Monkey is running with '''
+    if args.cross_account_numbers:
+        accounts = [a.strip() for a in args.cross_account_numbers.split(',')]
+    elif args.cross_account_file:
+        try:
+            with open(args.cross_account_file) as fh:
+                accounts = [line.split('#')[0].strip() for line in fh]
+        except IOError as e:
+            _fail('Could not read the --cross-account-file: %s' % e)
+    else:
+        return [args.cross_account_number]
+    accounts = [a for a in accounts if a]
+    if not accounts:
+        _fail('No account numbers were given')
+    return accounts
+
+def _target_name(account, region):
+    if account:
+        return '%s/%s' % (account, region)
+    return region
+
+def _get_policy(args):
+    ''' A retention policy, if any of the grandfather-father-son options were
+    given. Otherwise only --max-snapshots-per-volume applies '''
+    if not (args.keep_daily or args.keep_weekly or args.keep_monthly or args.max_age):
+        return None
+    return RetentionPolicy(latest=args.max_snapshots_per_volume,
+                           daily=args.keep_daily,
+                           weekly=args.keep_weekly,
+                           monthly=args.keep_monthly,
+                           max_age=args.max_age * 86400 if args.max_age else None)
+
+@contextmanager
+def _timed(timings, name):
+    ''' Adds (name, seconds) for the block of code to `timings` '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.append((name, time.time() - start))
+
+def _report_startup(timings, all_metrics):
+    ''' Logs where the time before the real work went, for --profile-startup '''
+    for name, seconds in timings:
+        log.info('Startup: %s took %.3fs', name, seconds)
+    for metrics in all_metrics:
+        log.info('Startup: connecting to %s took %.3fs', _target_name(metrics.account, metrics.region),
+                 metrics.phases.get('connect', 0.0))
+
+def _read_plans(path):
+    ''' Reads a --plan file, as a dictionary of target name to plan '''
+    try:
+        with open(path) as fh:
+            plans = json.load(fh)['plans']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        _fail('Could not read the plan %s: %s' % (path, e))
+    if not plans:
+        _fail('The plan %s has nothing to do, it is for no accounts or regions' % path)
+    return dict((_target_name(p['account'], p['region']), p) for p in plans)
+
+def _write_plans(path, plans):
+    ''' Writes the plans for every target as JSON, to a file or - for stdout '''
+    data = json.dumps({'plans': [plans[name] for name in sorted(plans)]}, indent=2, sort_keys=True)
+    if path == '-':
+        print data
+        return
+    with open(path, 'w') as fh:
+        fh.write(data + '\n')
+    log.info('Wrote the plan to %s', path)
+
+def _write_metrics(args, all_metrics):
+    ''' Exports the metrics of every target in the formats asked for. A
+    failure here is logged, but does not fail the run '''
+    try:
+        if args.metrics_json:
+            data = json.dumps({'targets': [m.to_dict() for m in all_metrics]}, indent=2, sort_keys=True)
+            if args.metrics_json == '-':
+                print data
+            else:
+                with open(args.metrics_json, 'w') as fh:
+                    fh.write(data + '\n')
+        if args.metrics_prometheus:
+            write_prometheus(args.metrics_prometheus, all_metrics)
+        if args.metrics_statsd:
+            send_statsd(args.metrics_statsd, all_metrics)
+    except (IOError, OSError, ValueError) as e:
+        log.error('Could not write metrics: %s', e)
+
+def _open_report(path):
+    try:
+        return RunReport(path)
+    except IOError as e:
+        _fail('Could not open the report %s: %s' % (path, e))
+
+def _close_report(report, results):
+    ''' Writes the totals to the report and logs them '''
+    summary = report.close(results)
+    totals = report.summary
+    log.info('Snapshotted %d volumes (%d GiB), skipped %d, deleted %d snapshots, %d failed, in %.1f seconds',
+             totals.count('snapshot', 'ok'), totals.gib('snapshot'), totals.count('snapshot', 'skipped'),
+             totals.count('delete', 'ok'), totals.count('snapshot', 'failed') + totals.count('delete', 'failed'),
+             summary['seconds'])
+    if totals.count('copy') or totals.count('copy_delete'):
+        log.info('Copied %d snapshots to other regions, deleted %d old copies, %d failed',
+                 totals.count('copy', 'ok'), totals.count('copy_delete', 'ok'),
+                 totals.count('copy') - totals.count('copy', 'ok') + totals.count('copy_delete', 'failed'))
+    if report.path != '-':
+        log.info('Wrote the report to %s', report.path)
+
+def _run_target(args, account, region, plans, metrics=None, connections=None, report=None):
+    ''' Runs Backup Monkey in a single account and region. Returns the error
+    message if it failed, otherwise None. With --plan, the plan for the
+    target is added to `plans`, and with --apply-plan it is taken from it.
+    What happened to each volume and snapshot is written to `report` '''
+    try:
+        monkey = BackupMonkey(region,
+                              args.max_snapshots_per_volume,
+                              args.tags,
+                              args.reverse_tags,
+                              args.label,
+                              account,
+                              args.cross_account_role,
+                              concurrency=args.concurrency,
+                              max_deletes_per_run=args.max_deletes_per_run,
+                              limiter=RateLimiter(args.max_requests_per_second, max_retries=args.max_retries),
+                              page_size=args.page_size,
+                              policy=_get_policy(args),
+                              cache_path=args.inventory_cache,
+                              rebuild_cache=args.rebuild_cache,
+                              reconcile_days=args.reconcile_days,
+                              exclude_tags=args.exclude_tags,
+                              tag_snapshots=args.tag_snapshots,
+                              match_snapshot_tags=args.match_snapshot_tags,
+                              group_by_instance=args.group_by_instance,
+                              metrics=metrics,
+                              connections=connections,
+                              journal_path=args.journal,
+                              detached_interval=args.detached_interval * 86400 if args.detached_interval else None,
+                              copy_regions=[r.strip() for r in (args.copy_to or '').split(',') if r.strip()],
+                              copy_keep=args.copy_keep,
+                              max_copies_in_flight=args.max_copies_in_flight,
+                              shard_index=args.shard_index,
+                              shard_count=args.shard_count,
+                              report=report)
+
+        if args.plan:
+            plans[_target_name(account, region)] = monkey.plan(snapshot=not args.remove_only,
+                                                               remove=not args.snapshot_only)
+            return None
+        timeout = args.wait_timeout * 60 if args.wait_timeout else None
+        if args.apply_plan:
+            monkey.apply_plan(plans[_target_name(account, region)])
+            if args.wait or args.copy_to:
+                monkey.wait_for_snapshots(timeout=timeout)
+            if args.copy_to:
+                monkey.copy_snapshots(timeout=timeout)
+            monkey.end_run()
+            return None
+
+        if not args.remove_only:
+            monkey.snapshot_volumes()
+            # Only completed snapshots can be copied
+            if args.wait or args.copy_to:
+                monkey.wait_for_snapshots(timeout=timeout)
+            if args.copy_to:
+                monkey.copy_snapshots(timeout=timeout)
+        if not args.snapshot_only:
+            monkey.remove_old_snapshots()
+        monkey.end_run()
+
+    except BackupMonkeyException as e:
+        return e.message
+    except Exception as e:
+        log.exception('Unexpected error in %s', _target_name(account, region))
+        return str(e) or e.__class__.__name__
+    return None
+
+def _run_targets(args, targets, plans=None, all_metrics=None, report=None):
+    ''' Runs Backup Monkey in all (account, region) targets, up to
+    --max-parallel-runs at a time. Returns a list of (target name, error
+    message) pairs. The metrics of each target are added to `all_metrics`,
+    and all targets write their results to the same `report` '''
+    plans = {} if plans is None else plans
+    names = [_target_name(account, region) for account, region in targets]
+    metrics = [Metrics(account, region) for account, region in targets]
+    if all_metrics is not None:
+        all_metrics.extend(metrics)
+    if len(targets) == 1:
+        return [(names[0], _run_target(args, targets[0][0], targets[0][1], plans, metrics[0], report=report))]
+    pool = ThreadPool(min(len(targets), args.max_parallel_runs))
+    try:
+        errors = pool.map(lambda i: _run_target(args, targets[i][0], targets[i][1], plans, metrics[i], report=report),
+                          range(len(targets)))
+    finally:
+        pool.close()
+        pool.join()
+    return zip(names, errors)
+
+def _job_error(message):
+    raise BackupMonkeyException(message)
+
+def _job_options(parser, args, job):
+    ''' The options of a --daemon job: those given on the command line,
+    overridden by the ones in the job, which use the long option names, e.g.
+    {"keep-daily": 7, "regions": "us-east-1,eu-west-1"} '''
+    options = argparse.Namespace(**vars(args))
+    actions = dict((action.dest, action) for action in parser._actions)
+    for key, value in job.iteritems():
+        if key in ('name', 'schedule'):
+            continue
+        dest = key.replace('-', '_')
+        action = actions.get(dest)
+        if action is None or dest in JOB_EXCLUDED_OPTIONS:
+            raise BackupMonkeyException('Unknown option %r' % key)
+        if action.nargs == '+':
+            value = value if isinstance(value, list) else [value]
+        elif isinstance(action, argparse._StoreTrueAction):
+            if not isinstance(value, bool):
+                raise BackupMonkeyException('The %s option must be true or false' % key)
+        elif value is not None and action.type:
+            try:
+                value = action.type(value)
+            except (TypeError, ValueError):
+                raise BackupMonkeyException('Invalid value %r for %s' % (value, key))
+        # An option replaces the ones it is mutually exclusive with, so a job
+        # can set --regions when --region was given on the command line
+        for group in parser._mutually_exclusive_groups:
+            if action in group._group_actions:
+                for other in group._group_actions:
+                    setattr(options, other.dest, other.default)
+        setattr(options, dest, value)
+    _check_args(options, _job_error)
+    return options
+
+def _read_jobs(parser, args):
+    ''' Reads the --daemon config file, as a list of Jobs '''
+    try:
+        with open(args.daemon) as fh:
+            config = json.load(fh)
+        jobs = config['jobs']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        _fail('Could not read the daemon config %s: %s' % (args.daemon, e))
+    if not jobs:
+        _fail('There are no jobs in the daemon config %s' % args.daemon)
+    result = []
+    for i, job in enumerate(jobs):
+        name = job.get('name') or 'job %d' % (i + 1)
+        try:
+            schedule = CronSchedule(job.get('schedule') or '')
+        except ValueError as e:
+            _fail('Invalid schedule for %s in %s: %s' % (name, args.daemon, e))
+        try:
+            options = _job_options(parser, args, job)
+        except BackupMonkeyException as e:
+            _fail('Invalid options for %s in %s: %s' % (name, args.daemon, e.message))
+        regions = _get_regions(options)
+        targets = [(account, region) for account in _get_accounts(options) for region in regions]
+        result.append(Job(name, schedule, targets, options))
+    return result
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt()
+
+def _run_daemon(parser, args):
+    ''' Runs the --daemon jobs on their schedules until interrupted. The
+    EC2 connections (and the assumed role credentials behind them) are kept
+    from one run to the next, and so is any --inventory-cache '''
+    jobs = _read_jobs(parser, args)
+    connections = ConnectionPool()
+
+    def run_job(job, account, region):
+        metrics = Metrics(account, region)
+        error = _run_target(job.options, account, region, {}, metrics, connections)
+        _write_metrics(job.options, [metrics])
+        return error
+
+    daemon = Daemon(jobs, run_job, args.max_parallel_runs)
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        daemon.run_forever()
+    except KeyboardInterrupt:
+        log.info('Stopping, after the runs in progress')
+    daemon.stop()
+    sys.exit(0)
+
+def _create_parser():
     parser = argparse.ArgumentParser(description='Loops through all EBS volumes, and snapshots them, then loops through all snapshots, and removes the oldest ones.')
-    parser.add_argument('--region', metavar='REGION', 
-                        help='the region to loop through and snapshot (default is current region of EC2 instance this is running on). E.g. us-east-1')
+    region_group = parser.add_mutually_exclusive_group()
+    region_group.add_argument('--region', metavar='REGION', 
+                        help='the region to loop through and snapshot (default is the AWS_REGION or AWS_DEFAULT_REGION environment variable, or else the current region of EC2 instance this is running on). E.g. us-east-1')
+    region_group.add_argument('--regions', metavar='REGIONS',
+                        help='a comma separated list of regions to loop through and snapshot concurrently. E.g. us-east-1,eu-west-1')
+    region_group.add_argument('--all-regions', action='store_true', default=False,
+                        help='loop through and snapshot all public regions concurrently')
     parser.add_argument('--max-snapshots-per-volume', metavar='SNAPSHOTS', default=3, type=int,
                         help='the maximum number of snapshots to keep per EBS volume. The oldest snapshots will be deleted. Default: 3')
+    parser.add_argument('--keep-daily', metavar='DAYS', default=0, type=int,
+                        help='also keep the newest snapshot of each of the last DAYS days that have snapshots. Default: 0')
+    parser.add_argument('--keep-weekly', metavar='WEEKS', default=0, type=int,
+                        help='also keep the newest snapshot of each of the last WEEKS weeks that have snapshots. Default: 0')
+    parser.add_argument('--keep-monthly', metavar='MONTHS', default=0, type=int,
+                        help='also keep the newest snapshot of each of the last MONTHS months that have snapshots. Default: 0')
+    parser.add_argument('--max-age', metavar='DAYS', type=int,
+                        help='delete snapshots older than DAYS days, even if they would otherwise be kept. Default: no limit')
     parser.add_argument('--snapshot-only', action='store_true', default=False,
                         help='Only snapshot EBS volumes, do not remove old snapshots')
     parser.add_argument('--remove-only', action='store_true', default=False,
@@ -46,64 +444,238 @@ def run():
     parser.add_argument('--version', action='version', version='%(prog)s ' + __version__,
                         help='display version number and exit')
     parser.add_argument('--tags', nargs="+", 
-                        help='Only snapshot instances that match passed in tags. E.g. --tag Name:foo will snapshot all instances with a tag `Name` and value is `foo`')
+                        help='Only snapshot instances that match passed in tags. E.g. --tag Name:foo will snapshot all instances with a tag `Name` and value is `foo`. Name:[foo,bar] matches either value, Name:foo* any value starting with `foo`, Name alone any value, and !Name:foo excludes. Quote keys that contain a colon, e.g. "aws:autoscaling:groupName":web')
     parser.add_argument('--reverse-tags', action='store_true', default=False,
                         help='Do a reverse match on the passed in tags. E.g. --tag Name:foo --reverse-tags will snapshot all instances that do not have a `Name` tag with the value `foo`')
+    parser.add_argument('--exclude-tags', nargs="+",
+                        help='Do not snapshot instances that match any of the passed in tags, on top of any --tags filter. A value ending in * matches any value starting with the text before it. E.g. --tags Env:prod --exclude-tags Name:scratch-*')
     parser.add_argument('--label', action='store',
                         help='Only snapshot instances that match passed in label are created or deleted. Default: None. Selected all snapshot. You have the posibility of create a different strategies for daily, weekly and monthly for example. Label daily won\'t deleted label weekly')
-    parser.add_argument('--cross-account-number', action='store',
+    account_group = parser.add_mutually_exclusive_group()
+    account_group.add_argument('--cross-account-number', action='store',
                         help='Do a cross-account snapshot (this is the account number to do snapshots on). NOTE: This requires that you pass in the --cross-account-role parameter. E.g. --cross-account-number 111111111111 --cross-account-role Snapshot')
+    account_group.add_argument('--cross-account-numbers', metavar='CROSS_ACCOUNT_NUMBERS',
+                        help='Do a cross-account snapshot in each of a comma separated list of accounts, concurrently. NOTE: This requires that you pass in the --cross-account-role parameter. E.g. --cross-account-numbers 111111111111,222222222222')
+    account_group.add_argument('--cross-account-file', metavar='FILE',
+                        help='Like --cross-account-numbers, but reads the account numbers from a file, one per line. Text after a # is ignored')
     parser.add_argument('--cross-account-role', action='store',
                         help='The name of the role that backup-monkey will assume when doing a cross-account snapshot. E.g. --cross-account-role Snapshot')
+    parser.add_argument('--concurrency', metavar='N', default=1, type=int,
+                        help='the number of snapshots to create or delete concurrently. Default: 1')
+    parser.add_argument('--max-deletes-per-run', metavar='DELETES', type=int,
+                        help='the maximum number of snapshots to delete in one run. The oldest expired snapshots are deleted first, the rest are left for the next run. Default: no limit')
+    parser.add_argument('--max-requests-per-second', metavar='RATE', default=10.0, type=float,
+                        help='the maximum rate of EC2 API requests. The rate is lowered automatically when AWS throttles requests. Default: 10')
+    parser.add_argument('--max-retries', metavar='RETRIES', default=8, type=int,
+                        help='the number of times an EC2 API request that is throttled, or fails with a server or network error, is retried before giving up. Default: 8')
+    parser.add_argument('--page-size', metavar='SNAPSHOTS', default=1000, type=int,
+                        help='the number of snapshots to fetch per request when listing snapshots (5 to 1000). Default: 1000')
+    parser.add_argument('--inventory-cache', metavar='FILE',
+                        help='keep a record of snapshots in this SQLite file, so later runs only fetch the snapshots that changed since the last run. Default: no cache')
+    parser.add_argument('--rebuild-cache', action='store_true', default=False,
+                        help='rebuild the --inventory-cache from a full listing of snapshots')
+    parser.add_argument('--reconcile-days', metavar='DAYS', default=7, type=int,
+                        help='take a full listing of snapshots into the --inventory-cache when the last one is this many days old, so snapshots deleted outside Backup Monkey are noticed. 0 for every run. Default: 7')
+    parser.add_argument('--tag-snapshots', action='store_true', default=False,
+                        help='tag new snapshots with their label, instance, retention policy and run id (backup-monkey:label, backup-monkey:instance, backup-monkey:policy and backup-monkey:run-id). Needs the ec2:CreateTags permission')
+    parser.add_argument('--match-snapshot-tags', action='store_true', default=False,
+                        help='find old snapshots by their backup-monkey:label tag instead of their description. Only snapshots created with --tag-snapshots are removed')
+    parser.add_argument('--group-by-instance', action='store_true', default=False,
+                        help='snapshot all volumes of an instance at the same moment, and tag them as a group (backup-monkey:group) that is kept or removed as a whole. Implies --tag-snapshots')
+    parser.add_argument('--detached-interval', metavar='DAYS', type=int,
+                        help='snapshot volumes that are not attached to an instance at most every DAYS days, skipping them while their newest snapshot is younger than that. Default: snapshot them every run')
+    parser.add_argument('--wait', action='store_true', default=False,
+                        help='wait for the new snapshots to complete before removing old ones, and fail if any of them end up in the error state')
+    parser.add_argument('--wait-timeout', metavar='MINUTES', type=int,
+                        help='fail if the new snapshots have not completed after this many minutes. Default: no limit')
+    parser.add_argument('--copy-to', metavar='REGIONS',
+                        help='once the new snapshots have completed, copy them to each of a comma separated list of regions, e.g. for disaster recovery. Implies --wait, and --wait-timeout applies to the copies too')
+    parser.add_argument('--copy-keep', metavar='SNAPSHOTS', type=int,
+                        help='the number of copies to keep per EBS volume in each --copy-to region. Default: --max-snapshots-per-volume')
+    parser.add_argument('--max-copies-in-flight', metavar='COPIES', default=5, type=int,
+                        help='the maximum number of copies in progress to each --copy-to region at once. Fewer are started when AWS says the limit on concurrent copies has been reached. Default: 5')
+    parser.add_argument('--journal', metavar='DIR',
+                        help='record each snapshot created and deleted in a journal file per account, region and label in this directory, so a run that is killed part way through is resumed by the next one, instead of starting over. Default: no journal')
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument('--plan', metavar='FILE',
+                        help='work out which snapshots would be created and deleted, and which would be kept by which retention buckets, without changing anything, and write that plan to a JSON file (- for stdout)')
+    plan_group.add_argument('--apply-plan', metavar='FILE',
+                        help='create and delete the snapshots in a plan written by --plan, in the accounts and regions it was made for. With --wait or --copy-to, the new snapshots are waited for or copied too')
+    parser.add_argument('--metrics-json', metavar='FILE',
+                        help='write the timings of each phase, EC2 API call counts, latencies, retries and errors, and the number of volumes and snapshots scanned and acted on to a JSON file (- for stdout)')
+    parser.add_argument('--metrics-prometheus', metavar='FILE',
+                        help='write the same metrics as --metrics-json to a file for the Prometheus node_exporter textfile collector')
+    parser.add_argument('--metrics-statsd', metavar='HOST:PORT',
+                        help='send the same metrics as --metrics-json to a StatsD server')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write a line of JSON to a file (- for stdout) for each volume snapshotted, skipped or resumed, each snapshot deleted, and each --copy-to copy made or old copy deleted (under the region of the copy), as soon as it is done, followed by a line with the totals: counts, GiB of volumes covered and time taken. Default: no report')
+    parser.add_argument('--shard-index', metavar='INDEX', default=0, type=int,
+                        help='with --shard-count, which share of the volumes to work on, from 0 to COUNT - 1. Default: 0')
+    parser.add_argument('--shard-count', metavar='COUNT', default=1, type=int,
+                        help='split the volumes, and the removal of their old snapshots, into COUNT shares by a hash of their id, so COUNT hosts or processes running with --shard-index 0 to COUNT - 1 can share the work of a region without overlapping. Default: 1')
+    parser.add_argument('--max-parallel-runs', metavar='RUNS', default=32, type=int,
+                        help='the maximum number of accounts and regions to work on at the same time. Default: 32')
+    parser.add_argument('--profile-startup', action='store_true', default=False,
+                        help='log how long importing Backup Monkey and boto, finding the region and connecting to each account and region took')
+    parser.add_argument('--daemon', metavar='CONFIG',
+                        help='keep running, and run the jobs in a JSON config file on their cron schedules, reusing EC2 connections between runs. See the README for the format')
 
-    args = parser.parse_args()
+    return parser
 
-    if args.cross_account_number and not args.cross_account_role:
-        parser.error('The --cross-account-role parameter is required if you specify --cross-account-number (doing a cross-account snapshot)')
+def _check_args(args, error):
+    ''' Checks the options go together, calling `error` with a message if not '''
+    cross_account = args.cross_account_number or args.cross_account_numbers or args.cross_account_file
+    if cross_account and not args.cross_account_role:
+        error('The --cross-account-role parameter is required if you specify --cross-account-number (doing a cross-account snapshot)')
 
-    if args.cross_account_role and not args.cross_account_number:
-        parser.error('The --cross-account-number parameter is required if you specify --cross-account-role (doing a cross-account snapshot)')
+    if args.cross_account_role and not cross_account and not args.apply_plan:
+        error('The --cross-account-number parameter is required if you specify --cross-account-role (doing a cross-account snapshot)')
 
     if args.reverse_tags and not args.tags:
-        parser.error('The --tags parameter is required if you specify --reverse-tags (doing a blacklist filter)')
+        error('The --tags parameter is required if you specify --reverse-tags (doing a blacklist filter)')
+
+    for selector in (args.tags or []) + (args.exclude_tags or []):
+        try:
+            parse_tag_selector(selector)
+        except ValueError as e:
+            error('Invalid tag parameter: %s' % e)
 
     if args.label and len(args.label) > LIMIT_LABEL:
-        parser.error('The --label parameter lenght should be less than 32')
+        error('The --label parameter lenght should be less than 32')
+
+    if min(args.keep_daily, args.keep_weekly, args.keep_monthly) < 0:
+        error('The --keep-daily, --keep-weekly and --keep-monthly parameters cannot be negative')
+
+    if args.max_age is not None and args.max_age < 1:
+        error('The --max-age parameter must be at least 1')
+
+    if args.concurrency < 1:
+        error('The --concurrency parameter must be at least 1')
+
+    if args.max_deletes_per_run is not None and args.max_deletes_per_run < 0:
+        error('The --max-deletes-per-run parameter cannot be negative')
+
+    if args.max_requests_per_second <= 0:
+        error('The --max-requests-per-second parameter must be greater than 0')
+
+    if args.max_retries < 0:
+        error('The --max-retries parameter cannot be negative')
+
+    if not 5 <= args.page_size <= 1000:
+        error('The --page-size parameter must be between 5 and 1000')
+
+    if args.rebuild_cache and not args.inventory_cache:
+        error('The --inventory-cache parameter is required if you specify --rebuild-cache')
+
+    if args.reconcile_days < 0:
+        error('The --reconcile-days parameter cannot be negative')
+
+    if args.group_by_instance and args.inventory_cache:
+        error('The --group-by-instance parameter cannot be used with --inventory-cache, which does not record snapshot tags')
+
+    if args.detached_interval is not None and args.detached_interval < 1:
+        error('The --detached-interval parameter must be at least 1')
+
+    # With --apply-plan, the snapshots the plan creates are copied
+    if args.copy_to and (args.remove_only or args.plan):
+        error('The --copy-to parameter cannot be used with --remove-only or --plan')
+
+    if args.copy_keep is not None and not args.copy_to:
+        error('The --copy-to parameter is required if you specify --copy-keep')
+
+    if args.copy_keep is not None and args.copy_keep < 1:
+        error('The --copy-keep parameter must be at least 1')
+
+    if args.max_copies_in_flight < 1:
+        error('The --max-copies-in-flight parameter must be at least 1')
+
+    if args.wait and args.remove_only:
+        error('The --wait parameter cannot be used with --remove-only')
+
+    if args.wait_timeout is not None and not (args.wait or args.copy_to):
+        error('The --wait or --copy-to parameter is required if you specify --wait-timeout')
+
+    if args.wait_timeout is not None and args.wait_timeout < 1:
+        error('The --wait-timeout parameter must be at least 1')
+
+    if args.plan and args.journal:
+        error('The --journal parameter cannot be used with --plan, which does not create or delete anything')
+
+    if args.plan and args.wait:
+        error('The --wait parameter cannot be used with --plan')
+
+    if args.apply_plan and (args.region or args.regions or args.all_regions or cross_account):
+        error('The --apply-plan parameter runs in the accounts and regions of the plan, so cannot be used with the region or account parameters')
+
+    if args.metrics_statsd and not args.metrics_statsd.rpartition(':')[2].isdigit():
+        error('The --metrics-statsd parameter must be a HOST:PORT address')
+
+    if args.shard_count < 1:
+        error('The --shard-count parameter must be at least 1')
+
+    if not 0 <= args.shard_index < args.shard_count:
+        error('The --shard-index parameter must be between 0 and --shard-count - 1')
+
+    if args.max_parallel_runs < 1:
+        error('The --max-parallel-runs parameter must be at least 1')
+
+    if args.daemon and (args.plan or args.apply_plan or args.metrics_json or args.metrics_prometheus or args.report):
+        error('The --daemon parameter cannot be used with --plan, --apply-plan, --metrics-json, --metrics-prometheus or --report')
+
+    if args.report and args.plan:
+        error('The --report parameter cannot be used with --plan, which does not change anything')
+
+
+def run():
+    parser = _create_parser()
+    args = parser.parse_args()
+    _check_args(args, parser.error)
 
     Logging().configure(args.verbose)
 
     log.debug("CLI parse args: %s", args)
 
-    if args.region:
-        region = args.region
+    if args.daemon:
+        _run_daemon(parser, args)
+
+    timings = [('importing Backup Monkey', IMPORT_SECONDS)]
+    if args.apply_plan:
+        plans = _read_plans(args.apply_plan)
+        targets = sorted((p['account'], p['region']) for p in plans.itervalues())
+        if any(account for account, region in targets) and not args.cross_account_role:
+            _fail('The --cross-account-role parameter is required to apply a plan made for other accounts')
     else:
-        # If no region was specified, assume this is running on an EC2 instance
-        # and work out what region it is in
-        log.debug("Figure out which region I am running in...")
-        instance_metadata = get_instance_metadata(timeout=5)
-        log.debug('Instance meta-data: %s', instance_metadata)
-        if not instance_metadata:
-            _fail('Could not determine region. This script is either not running on an EC2 instance (in which case you should use the --region option), or the meta-data service is down')
-        
-        region = instance_metadata['placement']['availability-zone'][:-1]
-        log.debug("Running in region: %s", region)
+        plans = {}
+        with _timed(timings, 'finding the region'):
+            regions = _get_regions(args)
+        targets = [(account, region) for account in _get_accounts(args) for region in regions]
+    if args.profile_startup:
+        # Only moves the import earlier, so it is timed apart from connecting
+        with _timed(timings, 'importing boto'):
+            import boto.ec2
+    report = _open_report(args.report) if args.report else None
+    all_metrics = []
+    results = _run_targets(args, targets, plans, all_metrics, report)
+    if args.profile_startup:
+        _report_startup(timings, all_metrics)
+    _write_metrics(args, all_metrics)
+    if report:
+        _close_report(report, results)
+    failed = [name for name, error in results if error]
+    if len(results) > 1:
+        for name, error in results:
+            if error:
+                log.error('%s: %s', name, error)
+            else:
+                log.info('%s: completed successfully', name)
+
+    if failed and len(results) == 1:
+        _fail(results[0][1])
+    elif failed:
+        _fail('Backup Monkey failed in %d of %d accounts and regions: %s' % (len(failed), len(results), ', '.join(failed)))
+
+    if args.plan:
+        _write_plans(args.plan, plans)
 
-    try:
-        monkey = BackupMonkey(region,
-                              args.max_snapshots_per_volume,
-                              args.tags,
-                              args.reverse_tags,
-                              args.label,
-                              args.cross_account_number,
-                              args.cross_account_role)
-        
-        if not args.remove_only:
-            monkey.snapshot_volumes()
-        if not args.snapshot_only:
-            monkey.remove_old_snapshots()
-        
-    except BackupMonkeyException as e:
-        _fail(e.message)
-    
     log.info('Backup Monkey completed successfully!')
     sys.exit(0)
@@ -0,0 +1,47 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import threading
+
+__all__ = ('ConnectionPool', )
+log = logging.getLogger(__name__)
+
+class ConnectionPool(object):
+    ''' EC2 connections kept from one run to the next, one per account and
+    region, so a long running process does not reconnect every time. A
+    connection made with assumed role credentials is replaced once those
+    credentials have been refreshed. '''
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, credentials_id, connect):
+        ''' The connection for `key`, e.g. (account, region). `connect` makes
+        a new one when there is none yet, or when the one there was made with
+        different credentials than `credentials_id` '''
+        with self._lock:
+            entry = self._connections.get(key)
+        if entry is not None and entry[0] == credentials_id:
+            log.debug('Reusing the connection to %s', '/'.join(k for k in key if k))
+            return entry[1]
+        connection = connect()
+        if connection is not None:
+            with self._lock:
+                self._connections[key] = (credentials_id, connection)
+        return connection
+
+    def clear(self):
+        with self._lock:
+            self._connections.clear()
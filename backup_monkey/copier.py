@@ -0,0 +1,148 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import re
+import time
+
+from backup_monkey.waiter import MAX_MISSING_POLLS
+
+__all__ = ('SnapshotCopier', 'copy_description', 'parse_copy_description')
+log = logging.getLogger(__name__)
+
+# The description EC2 itself gives copies made in the console
+COPY_DESCRIPTION = '[Copied %s from %s] %s'
+COPY_DESCRIPTION_RE = re.compile(r'^\[Copied (snap-[0-9a-f]+) from ([a-z0-9-]+)\] (.*)$')
+
+def copy_description(snapshot, region):
+    ''' The description of a copy of a snapshot from a region. It does not
+    start with the Backup Monkey prefix, so the copies are never mistaken
+    for snapshots made in their own region '''
+    return COPY_DESCRIPTION % (snapshot.id, region, snapshot.description)
+
+def parse_copy_description(description):
+    ''' (source snapshot id, source region, source description) of a copy,
+    or None if the description is not that of a copy '''
+    match = COPY_DESCRIPTION_RE.match(description or '')
+    return match.groups() if match else None
+
+class SnapshotCopier(object):
+    ''' Copies snapshots to another region, with at most `max_in_flight`
+    copies going at once. EC2 limits the number of copies in progress to a
+    region, and answers ResourceLimitExceeded to any more. When it does,
+    the copier lowers its own limit to the copies it has in flight, and
+    raises it again by one for every copy that completes.
+
+    `start(snapshot)` starts a copy and returns the id of the new snapshot,
+    and `describe(ids)` returns the copies with those ids. Between polls the
+    copier waits `min_interval` seconds, doubling up to `max_interval` for as
+    long as no copy finishes, and gives up on a copy missing from
+    `max_missing_polls` polls in a row, as SnapshotWaiter does. '''
+
+    def __init__(self, start, describe, max_in_flight=5, min_interval=5, max_interval=60, timeout=None,
+                 batch_size=200, max_missing_polls=MAX_MISSING_POLLS, clock=time.time, sleep=time.sleep):
+        self._start = start
+        self._describe = describe
+        self.max_in_flight = max_in_flight
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_missing_polls = max_missing_polls
+        self._clock = clock
+        self._sleep = sleep
+        self.completed = []
+        self.failed = []
+        self.pending = []
+        self._missing = {}
+
+    def _start_copies(self, queue, in_flight, limit):
+        ''' Starts copies from the front of the queue while there is room.
+        Returns the limit, lowered if EC2 would not take any more '''
+        while queue and len(in_flight) < limit:
+            source = queue[0]
+            try:
+                copy_id = self._start(source)
+            except Exception as e:
+                if getattr(e, 'error_code', None) == 'ResourceLimitExceeded' and in_flight:
+                    log.warning('Too many copies in progress, waiting for some of the %d in flight to complete',
+                                len(in_flight))
+                    return len(in_flight)
+                log.error('Could not copy %s: %s', source.id, e)
+                self.failed.append(source.id)
+                queue.pop(0)
+                continue
+            log.info('Copying %s to %s', source.id, copy_id)
+            queue.pop(0)
+            in_flight[copy_id] = source.id
+        return limit
+
+    def run(self, snapshots, in_flight=()):
+        ''' Copies the snapshots, and waits for the copies to complete.
+        `in_flight` has the ids of copies already in progress, e.g. from an
+        earlier run, which count against the limit. Afterwards `completed`
+        has the completed copies, `failed` the ids of the snapshots that
+        could not be copied and `pending` those of the copies still going
+        at the timeout, or not started by then '''
+        started = self._clock()
+        queue = list(snapshots)
+        in_flight = dict((copy_id, None) for copy_id in in_flight)
+        limit = self.max_in_flight
+        interval = None
+        while queue or in_flight:
+            limit = self._start_copies(queue, in_flight, limit)
+            if not in_flight:
+                continue
+            if self.timeout is not None and self._clock() - started + (interval or self.min_interval) > self.timeout:
+                log.warning('Gave up waiting for %d copies after %d seconds', len(in_flight), self._clock() - started)
+                break
+            interval = self.min_interval if interval is None else min(self.max_interval, interval * 2)
+            self._sleep(interval)
+            finished = self._poll(in_flight)
+            if finished:
+                interval = None
+                limit = min(self.max_in_flight, limit + finished)
+            log.info('%d copies completed, %d failed, %d in flight, %d queued',
+                     len(self.completed), len(self.failed), len(in_flight), len(queue))
+        self.pending = [source_id or copy_id for copy_id, source_id in in_flight.iteritems()]
+        self.pending.extend(source.id for source in queue)
+        return not self.failed and not self.pending
+
+    def _poll(self, in_flight):
+        ''' Checks on the copies in flight. Returns how many finished '''
+        finished = 0
+        ids = sorted(in_flight)
+        seen = set()
+        for i in range(0, len(ids), self.batch_size):
+            for copy in self._describe(ids[i:i + self.batch_size]):
+                seen.add(copy.id)
+                if copy.status == 'completed':
+                    self.completed.append(copy)
+                elif copy.status == 'error':
+                    log.error('Copy %s of %s failed', copy.id, in_flight[copy.id] or 'an earlier run')
+                    self.failed.append(in_flight[copy.id] or copy.id)
+                else:
+                    continue
+                del in_flight[copy.id]
+                finished += 1
+        for copy_id in ids:
+            if copy_id in seen:
+                self._missing.pop(copy_id, None)
+                continue
+            self._missing[copy_id] = self._missing.get(copy_id, 0) + 1
+            if self._missing[copy_id] >= self.max_missing_polls:
+                log.error('Copy %s of %s has gone missing, it was not found in %d polls', copy_id,
+                          in_flight[copy_id] or 'an earlier run', self._missing[copy_id])
+                self.failed.append(in_flight.pop(copy_id) or copy_id)
+                finished += 1
+        return finished
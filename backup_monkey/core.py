@@ -12,143 +12,895 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+import threading
+import time
+import uuid
+import zlib
+from multiprocessing.pool import ThreadPool
 
-from boto.exception import NoAuthHandlerFound
-from boto import ec2
-
+from backup_monkey.copier import COPY_DESCRIPTION, SnapshotCopier, copy_description, parse_copy_description
+from backup_monkey.credentials import assumed_roles
 from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.metrics import Metrics
+from backup_monkey.inventory import MAX_REFRESH_DAYS, CachedSnapshot, InventoryCache, days_since
+from backup_monkey.journal import Journal
+from backup_monkey.report import Result, Summary
+from backup_monkey.retention import GFSRetention, KeepNewest, SnapshotGroup
+from backup_monkey.tags import TagMatcher, escape_filter_value
+from backup_monkey.throttle import RateLimiter
+from backup_monkey.waiter import SnapshotWaiter
 
 __all__ = ('BackupMonkey', 'Logging')
 log = logging.getLogger(__name__)
 
+# Tags put on the snapshots Backup Monkey creates, with --tag-snapshots
+TAG_LABEL = 'backup-monkey:label'
+TAG_INSTANCE = 'backup-monkey:instance'
+TAG_POLICY = 'backup-monkey:policy'
+TAG_RUN_ID = 'backup-monkey:run-id'
+TAG_GROUP = 'backup-monkey:group'
+# Snapshots tagged per CreateTags call
+TAG_BATCH_SIZE = 200
+# Format of the plans made by BackupMonkey.plan
+PLAN_VERSION = 1
+# The EC2 action behind each boto call, which API call metrics are labelled with
+EC2_ACTIONS = {
+    'get_all_volumes': 'DescribeVolumes',
+    'get_all_snapshots': 'DescribeSnapshots',
+    'create_snapshot': 'CreateSnapshot',
+    'delete': 'DeleteSnapshot',
+    'delete_snapshot': 'DeleteSnapshot',
+    'create_tags': 'CreateTags',
+    'copy_snapshot': 'CopySnapshot',
+}
+
 class BackupMonkey(object):
-    def __init__(self, region, max_snapshots_per_volume, tags, reverse_tags, label, cross_account_number, cross_account_role):
+    def __init__(self, region, max_snapshots_per_volume, tags, reverse_tags, label, cross_account_number, cross_account_role,
+                 concurrency=1, max_deletes_per_run=None, limiter=None,
+                 page_size=None, policy=None, cache_path=None, rebuild_cache=False, exclude_tags=None,
+                 tag_snapshots=False, match_snapshot_tags=False, run_id=None, group_by_instance=False,
+                 metrics=None, connections=None, journal_path=None, detached_interval=None,
+                 copy_regions=None, copy_keep=None, max_copies_in_flight=5, shard_index=0, shard_count=1,
+                 report=None, reconcile_days=7):
         self._region = region
+        self._label = label
         self._prefix = 'BACKUP_MONKEY'
         if label:
             self._prefix += ' ' + label
         self._snapshots_per_volume = max_snapshots_per_volume
         self._tags = tags
         self._reverse_tags = reverse_tags
+        self._exclude_tags = exclude_tags
         self._cross_account_number = cross_account_number
         self._cross_account_role = cross_account_role
-        self._conn = self.get_connection()
+        self._concurrency = concurrency
+        self._max_deletes_per_run = max_deletes_per_run
+        self._limiter = limiter or RateLimiter()
+        self._page_size = page_size
+        self._policy = policy
+        self._tag_snapshots = tag_snapshots
+        self._match_snapshot_tags = match_snapshot_tags
+        self._group_by_instance = group_by_instance
+        self._detached_interval = detached_interval
+        self._copy_regions = copy_regions or []
+        self._copy_keep = copy_keep if copy_keep is not None else max_snapshots_per_volume
+        self._max_copies_in_flight = max_copies_in_flight
+        self._shard_index = shard_index
+        self._shard_count = shard_count
+        self.run_id = run_id or uuid.uuid4().hex
+        self.metrics = metrics or Metrics(cross_account_number, region)
+        self._connections = connections
+        with self.metrics.phase('connect'):
+            self._conn = self.get_connection()
+        self._cache = None
+        if cache_path:
+            self._cache = InventoryCache(cache_path, cross_account_number, region, self._prefix)
+        self._rebuild_cache = rebuild_cache
+        self._reconcile_days = reconcile_days
+        self._journal = None
+        if journal_path:
+            self._journal = Journal(journal_path, cross_account_number, region, self._prefix,
+                                    shard=(shard_index, shard_count) if shard_count > 1 else None)
+        self._created = []
+        self._created_at = None
+        self._completed = []
+        self._listing_calls = 0
+        # Start time of each volume's newest snapshot, from the last retention pass
+        self._newest = None
+        # Expired snapshots worked out early, for skip_detached_volumes
+        self._expired = None
+        self.skipped = []
+        self._report = report
+        self._results_lock = threading.Lock()
+        # Totals of the results of the whole run, and of the current step
+        self.results = Summary()
+        self._step = Summary()
 
-    def get_connection(self):
+    def get_connection(self, region=None):
+        ''' Connects to this BackupMonkey's region, or to another region of
+        the same account, e.g. to copy snapshots there '''
+        # boto is only imported once it is needed, as importing it takes
+        # longer than many short runs spend doing anything else
+        from boto.exception import NoAuthHandlerFound
+        region = region or self._region
         ret = None
         if self._cross_account_number and self._cross_account_role:
-            from boto.sts import STSConnection
-            import boto
             try:
                 role_arn = 'arn:aws:iam::%s:role/%s' % (self._cross_account_number, self._cross_account_role)
-                sts = STSConnection()
-                assumed_role = sts.assume_role(role_arn=role_arn, role_session_name='AssumeRoleSession')
-                ret = ec2.connect_to_region(
-                    self._region,
-                    aws_access_key_id=assumed_role.credentials.access_key, 
-                    aws_secret_access_key=assumed_role.credentials.secret_key, 
-                    security_token=assumed_role.credentials.session_token
-                )
+                credentials = assumed_roles.get(role_arn)
+                ret = self._connect(region, credentials)
             except Exception,e:
                 print e
                 raise BackupMonkeyException('Cannot complete cross account access')
         else:
-            log.info("Connecting to region %s", self._region)
+            log.info("Connecting to region %s", region)
             try:
-                ret = ec2.connect_to_region(self._region)
+                ret = self._connect(region)
             except NoAuthHandlerFound:
-                log.error('Could not connect to region %s' % self._region)
+                log.error('Could not connect to region %s' % region)
                 log.critical('No AWS credentials found. To configure Boto, please read: http://boto.readthedocs.org/en/latest/boto_config_tut.html')
                 raise BackupMonkeyException('No AWS credentials found')            
         if not ret:
-            raise BackupMonkeyException('Could not connect to region `%s`. Check to make sure you are connecting to a valid region' % self._region)
+            raise BackupMonkeyException('Could not connect to region `%s`. Check to make sure you are connecting to a valid region' % region)
         return ret
 
-    def get_filters(self):
-        filters = dict([t.split(':') for t in self._tags])
+    def _connect(self, region, credentials=None):
+        ''' Connects to EC2, or reuses a connection from the pool. boto's own
+        retries are turned off: it would retry throttled calls (HTTP 503) up
+        to 6 times with a backoff of its own, before the RateLimiter saw any
+        throttling to slow down for '''
+        kwargs = {}
+        if credentials:
+            kwargs = dict(aws_access_key_id=credentials.access_key,
+                          aws_secret_access_key=credentials.secret_key,
+                          security_token=credentials.session_token)
+        from boto import ec2
+        connect = lambda: ec2.connect_to_region(region, **kwargs)
+        if self._connections is None:
+            conn = connect()
+        else:
+            conn = self._connections.get((self._cross_account_number, region),
+                                         credentials.access_key if credentials else None, connect)
+        if conn is not None:
+            conn.num_retries = 0
+        return conn
+
+    def _call(self, func, *args, **kwargs):
+        ''' Makes an EC2 API call through the shared rate limiter, recording
+        its latency and retries in the metrics under the EC2 action name '''
+        operation = getattr(func, '__name__', 'call')
+        if operation == 'get_list' and args:
+            operation = args[0]
+        operation = EC2_ACTIONS.get(operation, operation)
+        attempts = [0]
+        def attempt():
+            attempts[0] += 1
+            return func(*args, **kwargs)
+        start = time.time()
+        error = True
         try:
-            for f in filters.keys():
-                try:
-                    filters[f] = eval(filters[f])
-                except Exception:
-                    pass
-        except ValueError:
-            log.error('Invalid tag parameter')
+            result = self._limiter.call(attempt)
+            error = False
+            return result
+        finally:
+            self.metrics.api_call(operation, time.time() - start, max(0, attempts[0] - 1), error)
+
+    def get_tag_matcher(self):
+        ''' Compiles the tag parameters into a TagMatcher '''
+        try:
+            return TagMatcher.compile(self._tags, self._exclude_tags, self._reverse_tags)
+        except ValueError as e:
+            log.error('Invalid tag parameter: %s', e)
             raise BackupMonkeyException('Invalid tag parameter')
-        if not self._reverse_tags:
-            for f in filters.keys():
-                filters['tag:%s' % f] = filters.pop(f)
-        return filters
+
+    def get_filters(self):
+        ''' The DescribeVolumes filters for the tag parameters '''
+        return self.get_tag_matcher().filters()
 
     def get_volumes_to_snapshot(self):
-        volumes = [] 
-        if self._reverse_tags:
-            filters = self.get_filters()
-            black_list = []
-            for f in filters.keys():
-                if isinstance(filters[f], list):
-                    black_list = black_list + [(f, i) for i in filters[f]]
-                else:
-                    black_list.append((f, filters[f]))
-            for v in self._conn.get_all_volumes():
-                if len(set(v.tags.items()) - set(black_list)) == len(set(v.tags.items())):
-                    volumes.append(v) 
-        else:
-            if self._tags:
-                return self._conn.get_all_volumes(filters=self.get_filters())
+        matcher = self.get_tag_matcher()
+        filters = matcher.filters()
+        with self.metrics.phase('list_volumes'):
+            if filters:
+                volumes = self._call(self._conn.get_all_volumes, filters=filters)
             else:
-                volumes = self._conn.get_all_volumes()
+                volumes = self._call(self._conn.get_all_volumes)
+        self.metrics.count('volumes_scanned', len(volumes))
+        if matcher.needs_local_check():
+            with self.metrics.phase('filter_volumes'):
+                volumes = [v for v in volumes if matcher.match(v.tags)]
+        self.metrics.count('volumes_matched', len(volumes))
+        if self._shard_count > 1:
+            sharded = [v for v in volumes if self.in_shard(self.get_shard_key(v))]
+            log.info('%d of %d volumes are in shard %d of %d', len(sharded), len(volumes),
+                     self._shard_index, self._shard_count)
+            volumes = sharded
         return volumes
+
+    def get_shard_key(self, volume):
+        ''' What a volume is sharded by: its instance with --group-by-instance,
+        so an instance's volumes are all in the same shard, otherwise itself '''
+        if self._group_by_instance and volume.attach_data.instance_id:
+            return volume.attach_data.instance_id
+        return volume.id
+
+    def in_shard(self, key):
+        ''' Whether a volume or instance id belongs to this shard. crc32 is
+        stable across processes and hosts, unlike hash() '''
+        return self._shard_count <= 1 or (zlib.crc32(key) & 0xffffffff) % self._shard_count == self._shard_index
     
+    def _map(self, func, items):
+        ''' Apply func to every item, using a bounded pool of worker threads
+        when more than one concurrent request is allowed '''
+        if self._concurrency <= 1 or len(items) <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self._concurrency, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_snapshot_description(self, volume):
+        description_parts = [self._prefix]
+        description_parts.append(volume.id)
+        if volume.attach_data.instance_id:
+            description_parts.append(volume.attach_data.instance_id)
+        if volume.attach_data.device:
+            description_parts.append(volume.attach_data.device)
+        return ' '.join(description_parts)
+
+    def _record(self, result, region=None):
+        ''' Adds the result for a volume or snapshot to the totals, and
+        writes it to the report as soon as it is known. `region` is that of
+        a copy, when it is not this region '''
+        with self._results_lock:
+            self.results.add(result)
+            self._step.add(result)
+        if self._report:
+            self._report.write(self._cross_account_number, region or self._region, result)
+
+    def _begin_step(self):
+        ''' Starts the totals of a step, which the step returns '''
+        with self._results_lock:
+            self._step = Summary()
+        return self._step
+
+    def _snapshot_volume(self, volume):
+        ''' Creates a snapshot of a single volume. Returns the snapshot and
+        the error instead of raising it, so one failed volume does not stop
+        the others '''
+        description = self.get_snapshot_description(volume)
+        log.info('Creating snapshot of %s: %s', volume.id, description)
+        start = time.time()
+        try:
+            snapshot = self._call(volume.create_snapshot, description)
+        except Exception as e:
+            log.error('Could not create snapshot of %s: %s', volume.id, e)
+            self._record(Result('snapshot', 'failed', volume.id, size=getattr(volume, 'size', None),
+                                seconds=time.time() - start, detail=str(e)))
+            return volume, None, e
+        self._record(Result('snapshot', 'ok', volume.id, snapshot.id if snapshot is not None else None,
+                            size=getattr(volume, 'size', None), seconds=time.time() - start))
+        if self._cache and snapshot is not None:
+            self._cache.record([snapshot])
+        if self._journal and snapshot is not None:
+            self._journal.record('snapshot', volume.id, snapshot.id)
+        return volume, snapshot, None
+
     def snapshot_volumes(self):
-        ''' Loops through all EBS volumes and creates snapshots of them '''
+        ''' Loops through all EBS volumes and creates snapshots of them.
+        Returns the Summary of what happened to them '''
 
+        self._begin_step()
         log.info('Getting list of EBS volumes')
         volumes = self.get_volumes_to_snapshot()
         log.info('Found %d volumes', len(volumes))
-        for volume in volumes:            
-            description_parts = [self._prefix]
-            description_parts.append(volume.id)
-            if volume.attach_data.instance_id:
-                description_parts.append(volume.attach_data.instance_id)
-            if volume.attach_data.device:
-                description_parts.append(volume.attach_data.device)
-            description = ' '.join(description_parts)
-            log.info('Creating snapshot of %s: %s', volume.id, description)
-            volume.create_snapshot(description)
+        if self._detached_interval:
+            volumes = self.skip_detached_volumes(volumes)
+        return self._create_snapshots(volumes)
+
+    def skip_detached_volumes(self, volumes, now=None):
+        ''' Leaves out the volumes not attached to any instance whose newest
+        snapshot is less than `detached_interval` seconds old, as their data
+        cannot have changed since. The newest snapshots come from the
+        retention pass, which runs now if it has not yet; its result is kept
+        for remove_old_snapshots, so the snapshots are only listed once.
+        `skipped` has (volume id, reason) for each volume left out '''
+        if self._newest is None:
+            log.info('Getting list of EBS snapshots first, to find the newest snapshot of each volume')
+            self._expired = self.get_expired_snapshots()
+        now = time.time() if now is None else now
+        result = []
+        for volume in volumes:
+            newest = self._newest.get(volume.id)
+            if volume.attach_data.instance_id or newest is None or now - newest >= self._detached_interval:
+                result.append(volume)
+                continue
+            reason = 'detached, newest snapshot %.1f days old' % ((now - newest) / 86400.0)
+            log.debug('Skipping %s: %s', volume.id, reason)
+            self.skipped.append((volume.id, reason))
+            self._record(Result('snapshot', 'skipped', volume.id, size=getattr(volume, 'size', None), detail=reason))
+        if len(result) < len(volumes):
+            log.info('Skipping %d detached volumes with a snapshot in the last %.1f days',
+                     len(volumes) - len(result), self._detached_interval / 86400.0)
+        self.metrics.count('volumes_skipped', len(volumes) - len(result))
+        return result
+
+    def _resumed_snapshots(self, volumes):
+        ''' Starts the snapshot step in the journal. When it resumes a run
+        that did not finish, returns the (volume, snapshot) pairs that run
+        already created, and the volumes it had not got to yet '''
+        from boto.ec2.snapshot import Snapshot
+        self.run_id, done = self._journal.begin('snapshot', self.run_id)
+        resumed = []
+        for volume in volumes:
+            if volume.id in done:
+                snapshot = Snapshot(self._conn)
+                snapshot.id = done[volume.id]
+                snapshot.volume_id = volume.id
+                resumed.append((volume, snapshot))
+                self._record(Result('snapshot', 'resumed', volume.id, snapshot.id, size=getattr(volume, 'size', None)))
+        if resumed:
+            log.info('Skipping %d volumes already snapshotted by run %s', len(resumed), self.run_id)
+            volumes = [volume for volume in volumes if volume.id not in done]
+        return resumed, volumes
+
+    def _create_snapshots(self, volumes):
+        self._created_at = time.time()
+        resumed = []
+        if self._journal:
+            resumed, volumes = self._resumed_snapshots(volumes)
+            self.metrics.count('snapshots_resumed', len(resumed))
+        with self.metrics.phase('create'):
+            if self._group_by_instance:
+                groups = self.group_volumes(volumes)
+                log.info('Snapshotting %d instances and detached volumes', len(groups))
+                results = [result for group in self._map(self._snapshot_group, groups) for result in group]
+            else:
+                results = self._map(self._snapshot_volume, volumes)
+        # Snapshots created before a resumed run died are tagged and waited
+        # for along with the new ones
+        created = resumed + [(volume, snapshot) for volume, snapshot, error in results if snapshot is not None]
+        self._created = [snapshot for volume, snapshot in created]
+        failed = [volume.id for volume, snapshot, error in results if error is not None]
+        self.metrics.count('snapshots_created', len(results) - len(failed))
+        self.metrics.count('snapshots_failed', len(failed))
+        log.info('Created %d snapshots, %d failed', len(results) - len(failed), len(failed))
+        if self._tag_snapshots or self._group_by_instance:
+            self.tag_snapshots(created)
+        if failed:
+            raise BackupMonkeyException('Could not create snapshots of %d volumes: %s' % (len(failed), ', '.join(failed)))
+        if self._journal:
+            self._journal.finish('snapshot')
+        return self._step
+
+    def group_volumes(self, volumes):
+        ''' Splits volumes into one list per instance they are attached to,
+        in the order the instances are first seen. Each detached volume is
+        a group of its own '''
+        groups = []
+        by_instance = {}
+        for volume in volumes:
+            instance_id = volume.attach_data.instance_id
+            if not instance_id:
+                groups.append([volume])
+            elif instance_id in by_instance:
+                by_instance[instance_id].append(volume)
+            else:
+                by_instance[instance_id] = [volume]
+                groups.append(by_instance[instance_id])
+        return groups
+
+    def _snapshot_group(self, volumes):
+        ''' Snapshots all volumes of an instance at the same moment, with a
+        thread per volume '''
+        if len(volumes) == 1:
+            return [self._snapshot_volume(volumes[0])]
+        pool = ThreadPool(len(volumes))
+        try:
+            return pool.map(self._snapshot_volume, volumes)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_snapshot_tags(self, volume):
+        ''' The tags for a new snapshot of the volume. The volume itself is
+        left out, as EC2 already records it in the snapshot's VolumeId '''
+        tags = {TAG_LABEL: self._label or '',
+                TAG_POLICY: str(self._policy) if self._policy else 'latest=%d' % self._snapshots_per_volume,
+                TAG_RUN_ID: self.run_id}
+        if volume.attach_data.instance_id:
+            tags[TAG_INSTANCE] = volume.attach_data.instance_id
+            if self._group_by_instance:
+                tags[TAG_GROUP] = '%s/%s' % (volume.attach_data.instance_id, self.run_id)
+        return tags
+
+    def _tag_batches(self, items):
+        ''' Yields (tags, batch of items) for one CreateTags call each, from
+        (volume, item) pairs '''
+        groups = {}
+        for volume, item in items:
+            tags = tuple(sorted(self.get_snapshot_tags(volume).iteritems()))
+            groups.setdefault(tags, []).append(item)
+        for tags, group in sorted(groups.iteritems()):
+            for i in range(0, len(group), TAG_BATCH_SIZE):
+                yield dict(tags), group[i:i + TAG_BATCH_SIZE]
+
+    def tag_snapshots(self, created):
+        ''' Tags new snapshots, given as (volume, snapshot) pairs. Snapshots
+        that get the same tags share CreateTags calls, of up to
+        TAG_BATCH_SIZE snapshots each '''
+        failed = []
+        calls = 0
+        with self.metrics.phase('tag'):
+            for tags, batch in self._tag_batches((volume, snapshot.id) for volume, snapshot in created):
+                calls += 1
+                try:
+                    self._call(self._conn.create_tags, batch, tags)
+                except Exception as e:
+                    log.error('Could not tag %d snapshots: %s', len(batch), e)
+                    failed.extend(batch)
+        self.metrics.count('snapshots_tagged', len(created) - len(failed))
+        log.info('Tagged %d snapshots in %d requests', len(created) - len(failed), calls)
+        if failed:
+            raise BackupMonkeyException('Could not tag %d snapshots: %s' % (len(failed), ', '.join(failed)))
         return True
 
+    def _describe_snapshots(self, snapshot_ids):
+        # A snapshot-id filter, unlike SnapshotIds, does not fail the whole
+        # call when a new snapshot is not visible to DescribeSnapshots yet
+        return self._call(self._conn.get_all_snapshots, owner='self', filters={'snapshot-id': snapshot_ids})
+
+    def wait_for_snapshots(self, timeout=None, min_interval=5, max_interval=60):
+        ''' Waits for the snapshots created by snapshot_volumes to complete.
+        Raises a BackupMonkeyException if any of them failed, or were still
+        not complete after `timeout` seconds '''
+        if not self._created:
+            log.info('No snapshots to wait for')
+            return True
+        log.info('Waiting for %d snapshots to complete', len(self._created))
+        waiter = SnapshotWaiter(self._describe_snapshots, min_interval=min_interval, max_interval=max_interval,
+                                timeout=timeout)
+        with self.metrics.phase('wait'):
+            waiter.wait([snapshot.id for snapshot in self._created], self._created_at)
+        self._completed = waiter.completed
+        if self._cache and waiter.completed:
+            self._cache.record(waiter.completed)
+        if waiter.completed and self._expired is not None:
+            # Worked out by skip_detached_volumes before these completed, so
+            # it would keep one snapshot too many of their volumes
+            log.debug('Listing the snapshots again, with the %d that completed', len(waiter.completed))
+            self._expired = None
+        log.info('%d snapshots completed: %s', len(waiter.durations), waiter.summary())
+        if waiter.failed or waiter.pending:
+            raise BackupMonkeyException('%d snapshots failed and %d did not complete in time: %s' % (
+                len(waiter.failed), len(waiter.pending), ', '.join(waiter.failed + waiter.pending)))
+        return True
+
+    def copy_snapshots(self, timeout=None, min_interval=5, max_interval=60):
+        ''' Copies the snapshots that wait_for_snapshots saw complete to each
+        of the copy regions, then deletes the oldest copies of each volume in
+        those regions beyond the newest `copy_keep`. Raises a
+        BackupMonkeyException if any copy failed, or had not completed after
+        `timeout` seconds. Returns the Summary of the copies made and the
+        old copies deleted '''
+        self._begin_step()
+        regions = [region for region in self._copy_regions if region != self._region]
+        if not regions:
+            return self._step
+        if not self._completed:
+            log.info('No completed snapshots to copy')
+        with self.metrics.phase('copy'):
+            pool = ThreadPool(len(regions))
+            try:
+                results = pool.map(lambda region: self._copy_to_region(region, timeout, min_interval, max_interval),
+                                   regions)
+            finally:
+                pool.close()
+                pool.join()
+        errors = [error for error in results if error]
+        if errors:
+            raise BackupMonkeyException('; '.join(errors))
+        return self._step
+
+    def _as_copy(self, conn, snapshot):
+        ''' A copy in another region as a CachedSnapshot whose volume_id is
+        that of the source volume, or None if it is not a copy of one of
+        this region's snapshots '''
+        source = parse_copy_description(snapshot.description)
+        if not source or source[1] != self._region or not source[2].startswith(self._prefix + ' '):
+            return None
+        # The description of a source snapshot is the prefix, then the volume id
+        volume_ids = [part for part in source[2][len(self._prefix):].split() if part.startswith('vol-')]
+        if not volume_ids:
+            return None
+        return CachedSnapshot(conn, snapshot.id, volume_ids[0], snapshot.description, snapshot.start_time,
+                              snapshot.status)
+
+    def get_copies(self, conn):
+        ''' The copies of this region's snapshots in the region of `conn` '''
+        snapshots = self._call(conn.get_all_snapshots, owner='self',
+                               filters={'description': COPY_DESCRIPTION % ('*', self._region,
+                                                                           escape_filter_value(self._prefix) + ' *')})
+        return [c for c in (self._as_copy(conn, snapshot) for snapshot in snapshots) if c is not None]
+
+    def _copy_to_region(self, region, timeout, min_interval, max_interval):
+        ''' Copies the new snapshots to one region, and removes the old
+        copies there. Returns the error message if anything failed '''
+        try:
+            conn = self.get_connection(region)
+            existing = self.get_copies(conn)
+        except Exception as e:
+            log.error('Could not list the copies in %s: %s', region, e)
+            return 'Could not copy snapshots to %s: %s' % (region, e)
+        copied = set(parse_copy_description(c.description)[0] for c in existing)
+        # Copied by an earlier, interrupted run
+        sources = [snapshot for snapshot in self._completed if snapshot.id not in copied]
+        in_flight = [c.id for c in existing if c.status == 'pending']
+        log.info('Copying %d snapshots to %s, %d copies already in progress there', len(sources), region, len(in_flight))
+
+        def start(snapshot):
+            return self._call(conn.copy_snapshot, self._region, snapshot.id, copy_description(snapshot, self._region))
+        def describe(ids):
+            return self._call(conn.get_all_snapshots, owner='self', filters={'snapshot-id': ids})
+        copier = SnapshotCopier(start, describe, max_in_flight=self._max_copies_in_flight, min_interval=min_interval,
+                                max_interval=max_interval, timeout=timeout)
+        copier.run(sources, in_flight)
+        self.metrics.count('snapshots_copied', len(copier.completed))
+        self.metrics.count('copies_failed', len(copier.failed) + len(copier.pending))
+        by_id = dict((snapshot.id, snapshot) for snapshot in sources)
+        for c in copier.completed:
+            source_id = parse_copy_description(c.description)[0]
+            source = by_id.get(source_id)
+            self._record(Result('copy', 'ok', getattr(source, 'volume_id', None), c.id,
+                                getattr(source, 'volume_size', None), detail='copy of %s' % source_id), region)
+        for status, snapshot_ids in (('failed', copier.failed), ('pending', copier.pending)):
+            for snapshot_id in snapshot_ids:
+                self._record(Result('copy', status, getattr(by_id.get(snapshot_id), 'volume_id', None), snapshot_id),
+                             region)
+
+        # Retention counts the completed copies, as remove_old_snapshots does
+        expired = []
+        retention = KeepNewest(self._copy_keep, expired.append)
+        completed = dict((c.id, c) for c in existing if c.status == 'completed')
+        for c in copier.completed:
+            completed[c.id] = self._as_copy(conn, c)
+        for c in completed.itervalues():
+            if self.in_shard(c.volume_id):
+                retention.add(c)
+        log.info('Keeping %d copies per volume in %s, deleting %d', self._copy_keep, region, len(expired))
+        results = self._map(lambda snapshot: self._delete_snapshot(snapshot, journal=False, copy_region=region),
+                            expired)
+        not_deleted = [snapshot.id for snapshot, error in results if error is not None]
+        self.metrics.count('copies_deleted', len(results) - len(not_deleted))
+
+        errors = []
+        if copier.failed:
+            errors.append('%d snapshots could not be copied to %s: %s' % (len(copier.failed), region, ', '.join(copier.failed)))
+        if copier.pending:
+            errors.append('%d copies to %s did not complete in time: %s' % (len(copier.pending), region, ', '.join(copier.pending)))
+        if not_deleted:
+            errors.append('Could not delete %d copies in %s: %s' % (len(not_deleted), region, ', '.join(not_deleted)))
+        return '; '.join(errors) or None
+
+    def plan(self, snapshot=True, remove=True):
+        ''' Works out what snapshot_volumes and remove_old_snapshots would
+        do, without creating, tagging or deleting anything. Returns the plan
+        as a dictionary that can be saved as JSON and given to apply_plan
+        later. Alongside what would be deleted, it has the snapshots that
+        would be kept and the retention buckets keeping each of them. The
+        same volumes and snapshots always give the same plan '''
+        volumes = self.get_volumes_to_snapshot() if snapshot else []
+        self._listing_calls = 0
+        kept = {}
+        expired = self.get_expired_snapshots(kept) if remove or (volumes and self._detached_interval) else []
+        if volumes and self._detached_interval:
+            volumes = self.skip_detached_volumes(volumes)
+        if not remove:
+            expired = []
+            kept = {}
+        keeps = dict((volume_id, [{'id': s.id, 'start_time': s.start_time, 'buckets': buckets} for s, buckets in snapshots])
+                     for volume_id, snapshots in kept.iteritems())
+        deletes = {}
+        for s in expired:
+            deletes.setdefault(s.volume_id, []).append({'id': s.id, 'description': s.description,
+                                                        'start_time': s.start_time})
+        for snapshots in deletes.itervalues():
+            snapshots.sort(key=lambda s: (s['start_time'], s['id']))
+        tag_calls = 0
+        if self._tag_snapshots or self._group_by_instance:
+            tag_calls = len(list(self._tag_batches((volume, volume.id) for volume in volumes)))
+        return {
+            'version': PLAN_VERSION,
+            'account': self._cross_account_number,
+            'region': self._region,
+            'prefix': self._prefix,
+            'snapshot': sorted(({'volume_id': volume.id, 'description': self.get_snapshot_description(volume)}
+                                for volume in volumes), key=lambda v: v['volume_id']),
+            'delete': deletes,
+            'keep': keeps,
+            'api_calls': {
+                'DescribeVolumes': 1 if snapshot else 0,
+                'DescribeSnapshots': self._listing_calls,
+                'CreateSnapshot': len(volumes),
+                'CreateTags': tag_calls,
+                'DeleteSnapshot': len(expired),
+            },
+        }
+
+    def get_volumes_by_id(self, volume_ids):
+        ''' The volumes that still exist out of a list of volume ids '''
+        volumes = []
+        for i in range(0, len(volume_ids), 200):
+            volumes.extend(self._call(self._conn.get_all_volumes, filters={'volume-id': volume_ids[i:i + 200]}))
+        return volumes
+
+    def apply_plan(self, plan):
+        ''' Creates and deletes the snapshots in a plan made by plan(), with
+        no further listing of snapshots. Volumes and snapshots that have gone
+        away since the plan was made are skipped '''
+        if plan.get('version') != PLAN_VERSION:
+            raise BackupMonkeyException('Unsupported plan version %r' % plan.get('version'))
+        for key, value in (('account', self._cross_account_number), ('region', self._region), ('prefix', self._prefix)):
+            if plan.get(key) != value:
+                raise BackupMonkeyException('The plan is for %s %r, not %r' % (key, plan.get(key), value))
+        errors = []
+
+        volume_ids = [v['volume_id'] for v in plan['snapshot']]
+        if volume_ids:
+            volumes = self.get_volumes_by_id(volume_ids)
+            missing = set(volume_ids) - set(volume.id for volume in volumes)
+            if missing:
+                log.warning('Skipping %d volumes that no longer exist: %s', len(missing), ', '.join(sorted(missing)))
+            try:
+                self._begin_step()
+                self._create_snapshots(sorted(volumes, key=lambda volume: volume.id))
+            except BackupMonkeyException as e:
+                errors.append(e.message)
+
+        expired = [CachedSnapshot(self._conn, s['id'], volume_id, s['description'], s['start_time'], 'completed')
+                   for volume_id, snapshots in sorted(plan['delete'].iteritems()) for s in snapshots]
+        # As in remove_old_snapshots, never delete anything without our prefix
+        expired = [s for s in expired if s.description.startswith(self._prefix)]
+        if expired:
+            try:
+                self._begin_step()
+                self._delete_snapshots(expired)
+            except BackupMonkeyException as e:
+                errors.append(e.message)
+
+        if errors:
+            raise BackupMonkeyException('; '.join(errors))
+        return True
+
+    def get_snapshot_filters(self):
+        ''' DescribeSnapshots filters that match completed Backup Monkey
+        snapshots, so other snapshots are never sent to us '''
+        if self._match_snapshot_tags:
+            # Like the description prefix, no label matches every label
+            if self._label:
+                return {'tag:%s' % TAG_LABEL: escape_filter_value(self._label), 'status': 'completed'}
+            return {'tag-key': TAG_LABEL, 'status': 'completed'}
+        return {'description': escape_filter_value(self._prefix) + '*', 'status': 'completed'}
+
+    def get_snapshot_pages(self, filters=None):
+        ''' Yields this account's snapshots one page at a time, so only a
+        single page has to be held in memory '''
+        if not self._page_size:
+            self._listing_calls += 1
+            yield self._call(self._conn.get_all_snapshots, owner='self', filters=filters)
+            return
+        from boto.ec2.snapshot import Snapshot
+        params = {'MaxResults': self._page_size}
+        self._conn.build_list_params(params, ['self'], 'Owner')
+        if filters:
+            self._conn.build_filter_params(params, filters)
+        while True:
+            self._listing_calls += 1
+            page = self._call(self._conn.get_list, 'DescribeSnapshots', params, [('item', Snapshot)], verb='POST')
+            log.debug('Got a page of %d snapshots', len(page))
+            yield page
+            if not page.next_token:
+                break
+            params['NextToken'] = page.next_token
+
+    def get_completed_snapshot_pages(self):
+        ''' Yields pages of completed Backup Monkey snapshots. They come from
+        EC2, or from the inventory cache once it has been brought up to date '''
+        if not self._cache:
+            for page in self.get_snapshot_pages(self.get_snapshot_filters()):
+                yield page
+            return
+        self.refresh_cache()
+        for page in self._cache.completed_pages(self._conn, self._page_size or 1000):
+            yield page
+
+    def refresh_cache(self):
+        ''' Brings the inventory cache up to date. The first time (or when
+        asked to rebuild it) that takes a full listing, after that only the
+        snapshots started since the last refresh and the ones that were still
+        pending are fetched. Those never notice snapshots deleted outside
+        Backup Monkey, which would take up places among the snapshots kept,
+        so a full listing is taken again every `reconcile_days` days '''
+        today = time.strftime('%Y-%m-%d', time.gmtime())
+        last_refresh = None if self._rebuild_cache else self._cache.last_refresh()
+        self._rebuild_cache = False
+        filters = self.get_snapshot_filters()
+        filters['status'] = ['pending', 'completed']
+        days = days_since(last_refresh) if last_refresh else []
+        last_full = self._cache.last_full_listing()
+        full = not days or len(days) > MAX_REFRESH_DAYS
+        if full:
+            log.info('Building the inventory cache from a full listing')
+        elif last_full is None or len(days_since(last_full)) - 1 >= self._reconcile_days:
+            log.info('Reconciling the inventory cache with a full listing, the last one was %s', last_full or 'never')
+            full = True
+        if full:
+            self._cache.clear()
+        else:
+            log.info('Refreshing the inventory cache with snapshots started since %s', last_refresh)
+            filters['start-time'] = [day + '*' for day in days]
+        for page in self.get_snapshot_pages(filters):
+            self._cache.record(page)
+
+        pending = self._cache.pending_ids()
+        if pending:
+            log.info('Checking on %d pending snapshots', len(pending))
+        for i in range(0, len(pending), 200):
+            snapshot_ids = pending[i:i + 200]
+            found = set()
+            for page in self.get_snapshot_pages({'snapshot-id': snapshot_ids}):
+                self._cache.record(page)
+                found.update(s.id for s in page)
+            self._cache.forget([snapshot_id for snapshot_id in snapshot_ids if snapshot_id not in found])
+
+        self._cache.refreshed(today, full=full)
+        evicted = self._cache.compact()
+        if evicted:
+            log.info('Evicted %d failed snapshots from the inventory cache', evicted)
+
+    def _delete_snapshot(self, snapshot, journal=True, copy_region=None):
+        ''' Deletes a single snapshot, or an old copy in `copy_region`.
+        Returns the error instead of raising it, so one failed snapshot does
+        not stop the others '''
+        log.info(' Deleting %s: %s', snapshot.id, snapshot.description)
+        action = 'copy_delete' if copy_region else 'delete'
+        size = getattr(snapshot, 'volume_size', None)
+        start = time.time()
+        detail = None
+        try:
+            self._call(snapshot.delete)
+        except Exception as e:
+            if getattr(e, 'error_code', None) != 'InvalidSnapshot.NotFound':
+                log.error('Could not delete %s: %s', snapshot.id, e)
+                self._record(Result(action, 'failed', snapshot.volume_id, snapshot.id, size,
+                                    time.time() - start, str(e)), copy_region)
+                return snapshot, e
+            log.info(' %s was already deleted', snapshot.id)
+            detail = 'already deleted'
+        self._record(Result(action, 'ok', snapshot.volume_id, snapshot.id, size, time.time() - start, detail),
+                     copy_region)
+        if self._journal and journal:
+            self._journal.record('remove', snapshot.id)
+        return snapshot, None
 
     def remove_old_snapshots(self):
         ''' Loop through this account's snapshots, and remove the oldest ones
-        where there are more snapshots per volume than required '''
-        
-        log.info('Configured to keep %d snapshots per volume', self._snapshots_per_volume)
+        where there are more snapshots per volume than required, or that the
+        retention policy does not keep. Returns the Summary of what happened
+        to the expired snapshots '''
+        self._begin_step()
+        expired, self._expired = self._expired, None
+        if expired is None:
+            expired = self.get_expired_snapshots()
+        return self._delete_snapshots(expired)
+
+    def get_expired_snapshots(self, kept=None):
+        ''' The snapshots remove_old_snapshots would delete. When `kept` is
+        a dictionary, the snapshots kept for each volume, newest first, are
+        added to it as (snapshot, names of the buckets keeping it) '''
+        expired = []
+        if self._policy:
+            log.info('Configured to keep %r', self._policy)
+            retention = GFSRetention(self._policy, expired.append, time.time())
+        else:
+            log.info('Configured to keep %d snapshots per volume', self._snapshots_per_volume)
+            retention = KeepNewest(self._snapshots_per_volume, expired.append)
         log.info('Getting list of EBS snapshots')
-        snapshots = self._conn.get_all_snapshots(owner='self')
-        log.info('Found %d snapshots', len(snapshots))
-        vol_snap_map = {}
-        for snapshot in snapshots:
-            if not snapshot.description.startswith(self._prefix):
-                log.debug('Skipping %s as prefix does not match', snapshot.id)
-                continue
-            if not snapshot.status == 'completed':
-                log.debug('Skipping %s as it is not a complete snapshot', snapshot.id)
-                continue
-            
-            log.debug('Found %s: %s', snapshot.id, snapshot.description)
-            vol_snap_map.setdefault(snapshot.volume_id, []).append(snapshot)
-            
-        for volume_id, most_recent_snapshots in vol_snap_map.iteritems():
-            most_recent_snapshots.sort(key=lambda s: s.start_time, reverse=True)
-            num_snapshots = len(most_recent_snapshots)
+        # Snapshots go through retention as they are listed, so both are timed together
+        with self.metrics.phase('scan_snapshots'):
+            num_snapshots = 0
+            groups = {}
+            # EC2 does the filtering, but the checks below stay as a safety net
+            for page in self.get_completed_snapshot_pages():
+                num_snapshots += len(page)
+                for snapshot in page:
+                    if not snapshot.description.startswith(self._prefix):
+                        log.debug('Skipping %s as prefix does not match', snapshot.id)
+                        continue
+                    if not snapshot.status == 'completed':
+                        log.debug('Skipping %s as it is not a complete snapshot', snapshot.id)
+                        continue
+
+                    log.debug('Found %s: %s', snapshot.id, snapshot.description)
+                    group_id = getattr(snapshot, 'tags', {}).get(TAG_GROUP) if self._group_by_instance else None
+                    # Snapshots are sharded the same way as their volumes,
+                    # so each volume's retention is worked out by one shard
+                    if not self.in_shard(group_id.split('/')[0] if group_id else snapshot.volume_id):
+                        continue
+                    if group_id:
+                        groups.setdefault(group_id, []).append(snapshot)
+                    else:
+                        retention.add(snapshot)
+            log.info('Found %d snapshots', num_snapshots)
+            if groups:
+                # Each instance's groups are kept or expired as a whole
+                log.info('Found %d instance snapshot groups', len(groups))
+                for group_id, snapshots in sorted(groups.iteritems()):
+                    retention.add(SnapshotGroup(group_id, group_id.split('/')[0], snapshots))
+        self.metrics.count('snapshots_scanned', num_snapshots)
+        self._newest = retention.newest
+
+        for volume_id, num_snapshots in retention.counts.iteritems():
             log.info('Found %d snapshots for %s', num_snapshots, volume_id)
+            if self._policy or kept is not None:
+                for snapshot in retention.kept(volume_id):
+                    # Without a policy, the newest snapshots are kept as by latest=N
+                    buckets = retention.buckets(volume_id, snapshot.id) if self._policy else ['latest']
+                    log.debug(' Keeping %s for %s', snapshot.id, ', '.join(buckets))
+                    if kept is not None:
+                        kept.setdefault(volume_id, []).append((snapshot, buckets))
 
-            for i in range(self._snapshots_per_volume, num_snapshots):
-                snapshot = most_recent_snapshots[i]
-                log.info(' Deleting %s: %s', snapshot.id, snapshot.description)
-                snapshot.delete()
-        return True
+        num_expired = sum(len(e) if isinstance(e, SnapshotGroup) else 1 for e in expired)
+        self.metrics.count('snapshots_expired', num_expired)
+        if self._max_deletes_per_run is not None and num_expired > self._max_deletes_per_run:
+            log.warning('Only deleting the oldest %d of %d expired snapshots this run', self._max_deletes_per_run, num_expired)
+            expired.sort(key=lambda s: s.start_time)
+            capped = []
+            num_expired = 0
+            for e in expired:
+                # Groups are never split, so stop at the first that does not fit
+                num_expired += len(e) if isinstance(e, SnapshotGroup) else 1
+                if num_expired > self._max_deletes_per_run:
+                    break
+                capped.append(e)
+            expired = capped
+        return [s for e in expired for s in (e.snapshots if isinstance(e, SnapshotGroup) else [e])]
+
+    def _delete_snapshots(self, expired):
+        if self._journal:
+            run_id, done = self._journal.begin('remove', self.run_id)
+            if done:
+                # Deleted by a run that died before it could update the cache
+                log.info('Skipping %d snapshots already deleted by run %s', len(done), run_id)
+                if self._cache:
+                    self._cache.forget(list(done))
+                for snapshot in expired:
+                    if snapshot.id in done:
+                        self._record(Result('delete', 'resumed', snapshot.volume_id, snapshot.id))
+                expired = [snapshot for snapshot in expired if snapshot.id not in done]
+        with self.metrics.phase('delete'):
+            results = self._map(self._delete_snapshot, expired)
+        failed = [snapshot.id for snapshot, error in results if error is not None]
+        self.metrics.count('snapshots_deleted', len(results) - len(failed))
+        self.metrics.count('snapshots_not_deleted', len(failed))
+        if self._cache:
+            self._cache.forget([snapshot.id for snapshot, error in results if error is None])
+        log.info('Deleted %d snapshots, %d failed', len(results) - len(failed), len(failed))
+        if failed:
+            raise BackupMonkeyException('Could not delete %d snapshots: %s' % (len(failed), ', '.join(failed)))
+        if self._journal:
+            self._journal.finish('remove')
+        return self._step
+
+    def end_run(self):
+        ''' Called once every step of the run has succeeded. Empties the
+        journal, which until then keeps the snapshots the run created, so a
+        run killed in a later step (e.g. --wait or the removal of old
+        snapshots) does not snapshot the same volumes again '''
+        if self._journal and self._journal.end():
+            log.debug('Run %s is done, emptied the journal %s', self.run_id, self._journal.path)
 
 
 
@@ -0,0 +1,74 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import calendar
+import logging
+import threading
+import time
+
+__all__ = ('AssumedRoleCache', 'assumed_roles')
+log = logging.getLogger(__name__)
+
+def parse_expiration(expiration):
+    ''' Converts an STS expiration time (e.g. 2016-01-01T12:00:00Z) to
+    seconds since the epoch '''
+    return calendar.timegm(time.strptime(expiration[:19], '%Y-%m-%dT%H:%M:%S'))
+
+class AssumedRoleCache(object):
+    ''' Assumed role credentials, shared by every region and thread that works
+    on the same account. Credentials are reused until `refresh_margin`
+    seconds before they expire. '''
+
+    def __init__(self, refresh_margin=300, clock=time.time, sts_factory=None):
+        self.refresh_margin = refresh_margin
+        self._clock = clock
+        self._sts_factory = sts_factory
+        self._credentials = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _connect_sts(self):
+        if self._sts_factory:
+            return self._sts_factory()
+        from boto.sts import STSConnection
+        return STSConnection()
+
+    def _lock_for(self, role_arn):
+        with self._lock:
+            return self._locks.setdefault(role_arn, threading.Lock())
+
+    def _is_fresh(self, credentials):
+        return parse_expiration(credentials.expiration) - self.refresh_margin > self._clock()
+
+    def get(self, role_arn, session_name='AssumeRoleSession'):
+        ''' Returns credentials for the role, only calling STS when there are
+        no cached credentials or they are about to expire '''
+        # One lock per role, so concurrent regions of the same account wait
+        # for a single AssumeRole call instead of all making their own
+        with self._lock_for(role_arn):
+            credentials = self._credentials.get(role_arn)
+            if credentials is None or not self._is_fresh(credentials):
+                log.info('Assuming role %s', role_arn)
+                assumed_role = self._connect_sts().assume_role(role_arn=role_arn, role_session_name=session_name)
+                credentials = assumed_role.credentials
+                self._credentials[role_arn] = credentials
+            else:
+                log.debug('Reusing credentials for %s until %s', role_arn, credentials.expiration)
+            return credentials
+
+    def clear(self):
+        with self._lock:
+            self._credentials.clear()
+
+# Shared by every BackupMonkey in the process
+assumed_roles = AssumedRoleCache()
@@ -0,0 +1,220 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+__all__ = ('CronSchedule', 'Daemon', 'Job')
+log = logging.getLogger(__name__)
+
+# (name, lowest, highest) of the fields of a cron expression
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7))
+
+def _parse_field(text, name, lowest, highest):
+    ''' The set of values a cron field matches, e.g. */15 or 1-5 or 0,30 '''
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/', 1)
+            if not step.isdigit() or int(step) < 1:
+                raise ValueError('invalid step in %s field %r' % (name, text))
+            step = int(step)
+        if part == '*':
+            start, end = lowest, highest
+        elif '-' in part:
+            start, end = part.split('-', 1)
+            if not (start.isdigit() and end.isdigit()):
+                raise ValueError('invalid range in %s field %r' % (name, text))
+            start, end = int(start), int(end)
+        elif part.isdigit():
+            start = end = int(part)
+            if step > 1:
+                end = highest
+        else:
+            raise ValueError('invalid %s field %r' % (name, text))
+        if not lowest <= start <= end <= highest:
+            raise ValueError('%s field %r is out of range %d-%d' % (name, text, lowest, highest))
+        values.update(range(start, end + 1, step))
+    return values
+
+class CronSchedule(object):
+    ''' A standard five field cron expression, e.g. "30 2 * * 1-5", in UTC.
+    As in cron, when both the day of month and the day of week are
+    restricted, a day matching either one will do. '''
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('expected 5 fields in cron expression %r' % expression)
+        (self.minutes, self.hours, self.days, self.months, self.weekdays) = [
+            _parse_field(field, *spec) for field, spec in zip(fields, CRON_FIELDS)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _day_matches(self, t):
+        # struct_time weekdays start at Monday=0, cron's at Sunday=0
+        weekday = (t.tm_wday + 1) % 7
+        if self._any_day or self._any_weekday:
+            return t.tm_mday in self.days and weekday in self.weekdays
+        return t.tm_mday in self.days or weekday in self.weekdays
+
+    def matches(self, timestamp):
+        ''' Whether the schedule fires in the minute of `timestamp` '''
+        t = time.gmtime(timestamp)
+        return (t.tm_min in self.minutes and t.tm_hour in self.hours and t.tm_mon in self.months
+                and self._day_matches(t))
+
+    def next_after(self, timestamp):
+        ''' The start of the first minute after `timestamp` the schedule fires
+        in, looking up to a year ahead '''
+        minute = int(timestamp // 60 + 1) * 60
+        end = minute + 366 * 86400
+        while minute < end:
+            t = time.gmtime(minute)
+            if t.tm_mon not in self.months or not self._day_matches(t):
+                # Skip to the start of the next day
+                minute += 86400 - (minute % 86400)
+            elif t.tm_hour not in self.hours:
+                minute += 3600 - (minute % 3600)
+            elif t.tm_min not in self.minutes:
+                minute += 60
+            else:
+                return minute
+        return None
+
+    def __repr__(self):
+        return 'CronSchedule(%r)' % self.expression
+
+class Job(object):
+    ''' A named set of Backup Monkey options, run on a schedule in some
+    accounts and regions '''
+
+    def __init__(self, name, schedule, targets, options):
+        self.name = name
+        self.schedule = schedule
+        self.targets = targets
+        self.options = options
+
+class Daemon(object):
+    ''' Runs jobs when their schedules say so, up to `max_parallel_runs`
+    accounts and regions at a time. A job never starts in an account and
+    region where another run is still going: it is queued, and started as
+    soon as that account and region is free. Only a job that is already
+    running or queued there is skipped, with a warning. `run_target(job,
+    account, region)` does the work and returns an error message or None. '''
+
+    def __init__(self, jobs, run_target, max_parallel_runs=8, clock=time.time, sleep=time.sleep):
+        self.jobs = jobs
+        self._run_target = run_target
+        self._clock = clock
+        self._sleep = sleep
+        self._pool = ThreadPool(max_parallel_runs)
+        # (account, region) -> the job running there
+        self._busy = {}
+        # (account, region) -> jobs waiting for the running one to finish
+        self._queued = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def tick(self, now):
+        ''' Starts every job due in the minute of `now`. Returns the runs
+        started, as (job, account, region), not counting those queued '''
+        started = []
+        for job in self.jobs:
+            if not job.schedule.matches(now):
+                continue
+            for account, region in job.targets:
+                if self._start(job, account, region):
+                    started.append((job, account, region))
+        return started
+
+    def _start(self, job, account, region):
+        target = '/'.join(t for t in (account, region) if t)
+        with self._lock:
+            if self._stopped.is_set():
+                return False
+            running = self._busy.get((account, region))
+            if running is not None:
+                queued = self._queued.setdefault((account, region), [])
+                if running is job or job in queued:
+                    log.warning('Skipping %s in %s, the previous run of it there has not finished', job.name, target)
+                else:
+                    log.info('Queueing %s in %s until %s has finished there', job.name, target, running.name)
+                    queued.append(job)
+                return False
+            self._busy[(account, region)] = job
+        self._pool.apply_async(self._run, (job, account, region))
+        return True
+
+    def _run(self, job, account, region):
+        target = '/'.join(t for t in (account, region) if t)
+        start = self._clock()
+        try:
+            log.info('Starting %s in %s', job.name, target)
+            error = self._run_target(job, account, region)
+            if error:
+                log.error('%s in %s failed after %d seconds: %s', job.name, target, self._clock() - start, error)
+            else:
+                log.info('%s in %s completed in %d seconds', job.name, target, self._clock() - start)
+        except Exception:
+            log.exception('Unexpected error running %s in %s', job.name, target)
+        finally:
+            with self._lock:
+                queued = self._queued.get((account, region))
+                if queued:
+                    # Hand the target straight to the next job, so a due
+                    # job cannot start in between
+                    job = self._busy[(account, region)] = queued.pop(0)
+                    self._pool.apply_async(self._run, (job, account, region))
+                else:
+                    self._queued.pop((account, region), None)
+                    del self._busy[(account, region)]
+
+    def running(self):
+        with self._lock:
+            return len(self._busy)
+
+    def run_forever(self):
+        ''' Checks the schedules at the start of every minute until stop() '''
+        log.info('Backup Monkey daemon started with %d jobs', len(self.jobs))
+        for job in self.jobs:
+            log.info('%s runs on %r in %d accounts and regions, next at %s', job.name, job.schedule.expression,
+                     len(job.targets), time.strftime('%F %T UTC', time.gmtime(job.schedule.next_after(self._clock()) or 0)))
+        last_minute = int(self._clock() // 60)
+        while not self._stopped.is_set():
+            now = self._clock()
+            self._sleep(60 - now % 60)
+            now = self._clock()
+            minute = int(now // 60)
+            if minute != last_minute:
+                last_minute = minute
+                self.tick(now)
+
+    def stop(self):
+        ''' Stops scheduling, and waits for the runs that have started.
+        Runs still queued are not started '''
+        self._stopped.set()
+        with self._lock:
+            for (account, region), queued in sorted(self._queued.iteritems()):
+                if queued:
+                    log.warning('Not running %s in %s, which were waiting for the run there to finish',
+                                ', '.join(job.name for job in queued), '/'.join(t for t in (account, region) if t))
+            self._queued.clear()
+            self._pool.close()
+        self._pool.join()
@@ -0,0 +1,172 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import calendar
+import logging
+import sqlite3
+import threading
+import time
+
+__all__ = ('InventoryCache', 'CachedSnapshot')
+log = logging.getLogger(__name__)
+
+# Incremental refreshes ask for snapshots started on each day since the last
+# refresh. After a longer gap than this, a full listing is cheaper
+MAX_REFRESH_DAYS = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    scope TEXT NOT NULL,
+    id TEXT NOT NULL,
+    volume_id TEXT,
+    description TEXT,
+    start_time TEXT,
+    status TEXT,
+    PRIMARY KEY (scope, id)
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    scope TEXT PRIMARY KEY,
+    day TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS full_listings (
+    scope TEXT PRIMARY KEY,
+    day TEXT NOT NULL
+);
+'''
+
+class CachedSnapshot(object):
+    ''' A snapshot known from the inventory cache rather than from EC2. Has
+    the attributes of a boto Snapshot that Backup Monkey uses '''
+    __slots__ = ('connection', 'id', 'volume_id', 'description', 'start_time', 'status')
+
+    def __init__(self, connection, id, volume_id, description, start_time, status):
+        self.connection = connection
+        self.id = id
+        self.volume_id = volume_id
+        self.description = description
+        self.start_time = start_time
+        self.status = status
+
+    def delete(self):
+        return self.connection.delete_snapshot(self.id)
+
+class InventoryCache(object):
+    ''' An SQLite record of the Backup Monkey snapshots created or seen in one
+    account and region, so later runs only have to ask EC2 about what changed
+    since the last one. Several caches (one per account and region) can share
+    the same file. '''
+
+    def __init__(self, path, account, region, prefix):
+        self.path = path
+        self.scope = '%s/%s/%s' % (account or 'self', region, prefix)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+
+    def last_refresh(self):
+        ''' The UTC day (YYYY-MM-DD) of the last refresh, or None if the cache
+        has to be built from a full listing '''
+        with self._lock:
+            row = self._db.execute('SELECT day FROM refreshes WHERE scope = ?', (self.scope,)).fetchone()
+        return row[0] if row else None
+
+    def last_full_listing(self):
+        ''' The UTC day (YYYY-MM-DD) the cache was last built from a full
+        listing, or None if it never was (or was built by an older version) '''
+        with self._lock:
+            row = self._db.execute('SELECT day FROM full_listings WHERE scope = ?', (self.scope,)).fetchone()
+        return row[0] if row else None
+
+    def refreshed(self, day, full=False):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO refreshes (scope, day) VALUES (?, ?)', (self.scope, day))
+            if full:
+                self._db.execute('INSERT OR REPLACE INTO full_listings (scope, day) VALUES (?, ?)', (self.scope, day))
+            self._db.commit()
+
+    def record(self, snapshots):
+        ''' Adds or updates snapshots, e.g. a page of a DescribeSnapshots listing '''
+        rows = [(self.scope, s.id, s.volume_id, s.description, s.start_time, s.status) for s in snapshots]
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO snapshots (scope, id, volume_id, description, start_time, status) '
+                                 'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._db.commit()
+
+    def forget(self, snapshot_ids):
+        ''' Removes snapshots that have been deleted '''
+        with self._lock:
+            self._db.executemany('DELETE FROM snapshots WHERE scope = ? AND id = ?',
+                                 [(self.scope, snapshot_id) for snapshot_id in snapshot_ids])
+            self._db.commit()
+
+    def pending_ids(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT id FROM snapshots WHERE scope = ? AND status = ?',
+                                                       (self.scope, 'pending'))]
+
+    def completed_pages(self, connection, page_size=1000):
+        ''' Yields the completed snapshots in pages of CachedSnapshots '''
+        last_id = ''
+        while True:
+            # Keyset pagination, so no cursor is held open between pages
+            with self._lock:
+                rows = self._db.execute('SELECT id, volume_id, description, start_time, status FROM snapshots '
+                                        'WHERE scope = ? AND status = ? AND id > ? ORDER BY id LIMIT ?',
+                                        (self.scope, 'completed', last_id, page_size)).fetchall()
+            if not rows:
+                break
+            yield [CachedSnapshot(connection, *row) for row in rows]
+            last_id = rows[-1][0]
+
+    def clear(self):
+        ''' Forgets everything about this account and region '''
+        with self._lock:
+            self._db.execute('DELETE FROM snapshots WHERE scope = ?', (self.scope,))
+            self._db.execute('DELETE FROM refreshes WHERE scope = ?', (self.scope,))
+            self._db.execute('DELETE FROM full_listings WHERE scope = ?', (self.scope,))
+            self._db.commit()
+
+    def compact(self):
+        ''' Evicts snapshots that ended up in an error state, and gives the
+        space back if there was a lot of it '''
+        with self._lock:
+            evicted = self._db.execute('DELETE FROM snapshots WHERE scope = ? AND status NOT IN (?, ?)',
+                                       (self.scope, 'pending', 'completed')).rowcount
+            self._db.commit()
+            free = self._db.execute('PRAGMA freelist_count').fetchone()[0]
+            pages = self._db.execute('PRAGMA page_count').fetchone()[0]
+            if pages and free > pages / 4:
+                log.debug('Vacuuming inventory cache %s', self.path)
+                try:
+                    self._db.execute('VACUUM')
+                except sqlite3.OperationalError as e:
+                    # Another account or region is using the file, next time
+                    log.debug('Could not vacuum inventory cache: %s', e)
+        return evicted
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def days_since(day, now=None):
+    ''' Each UTC day (YYYY-MM-DD) from `day` up to and including today '''
+    today = time.strftime('%Y-%m-%d', time.gmtime(now))
+    first = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+    days = []
+    while day <= today:
+        days.append(day)
+        day = time.strftime('%Y-%m-%d', time.gmtime(first + len(days) * 86400))
+    return days
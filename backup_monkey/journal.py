@@ -0,0 +1,139 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import errno
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+__all__ = ('Journal', )
+log = logging.getLogger(__name__)
+
+# An unfinished run older than this is not resumed, so a volume snapshotted
+# by a run that crashed yesterday gets today's snapshot
+RESUME_HOURS = 20
+
+class Journal(object):
+    ''' An append-only JSON Lines record of the work done by the runs in one
+    account and region, with one file per account, region and label in a
+    directory. Each step of a run (snapshot or remove) writes a start line,
+    a line per volume snapshotted or snapshot deleted, and a finish line.
+    When a run dies part way through, the next run takes over its run id and
+    skips what it already did, in finished steps as well as the one it died
+    in: a run killed while waiting for its snapshots or removing old ones
+    must not snapshot the same volumes again. The file is only emptied by
+    end(), once the whole run is done, so it never holds more than one run.
+    Each shard (index, count) of a sharded run has a journal of its own. '''
+
+    def __init__(self, directory, account, region, prefix, clock=time.time, shard=None):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', '%s_%s_%s' % (account or 'self', region, prefix))
+        if shard:
+            name += '_shard-%d-of-%d' % shard
+        self.path = os.path.join(directory, name + '.jsonl')
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._runs = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fh:
+                lines = fh.readlines()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for number, line in enumerate(lines, 1):
+            try:
+                entry = json.loads(line)
+                step, event = entry['step'], entry['event']
+            except (ValueError, KeyError, TypeError):
+                # Most likely the last line, cut short by a crash
+                log.warning('Ignoring line %d of the journal %s', number, self.path)
+                continue
+            if event == 'start':
+                self._runs[step] = {'run_id': entry['run_id'], 'started': entry['time'], 'done': {}, 'finished': False}
+            elif step not in self._runs:
+                continue
+            elif event == 'done':
+                self._runs[step]['done'][entry['key']] = entry.get('snapshot_id')
+            elif event in ('finish', 'resume'):
+                self._runs[step]['finished'] = event == 'finish'
+
+    def _write(self, entry):
+        entry['time'] = self._clock()
+        with self._lock:
+            with open(self.path, 'a') as fh:
+                fh.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def begin(self, step, run_id):
+        ''' Starts a step, or resumes it when the last run did not end, even
+        if that run finished the step itself. Returns the run id to carry on
+        with, and a dictionary of what that run already did: volume id to
+        snapshot id for the snapshot step, or snapshot id to None for the
+        remove step '''
+        run = self._runs.get(step)
+        if run is not None:
+            if self._clock() - run['started'] < RESUME_HOURS * 3600:
+                log.info('Resuming %s%s step of run %s, which already did %d of its work',
+                         'finished ' if run['finished'] else '', step, run['run_id'], len(run['done']))
+                if run['finished']:
+                    run['finished'] = False
+                    self._write({'step': step, 'event': 'resume', 'run_id': run['run_id']})
+                return run['run_id'], dict(run['done'])
+            log.warning('Not resuming the %s step of run %s, which started more than %d hours ago',
+                        step, run['run_id'], RESUME_HOURS)
+        self._runs[step] = {'run_id': run_id, 'started': self._clock(), 'done': {}, 'finished': False}
+        self._write({'step': step, 'event': 'start', 'run_id': run_id})
+        return run_id, {}
+
+    def record(self, step, key, snapshot_id=None):
+        ''' Records a volume snapshotted or a snapshot deleted, as soon as it
+        is done '''
+        run = self._runs[step]
+        with self._lock:
+            run['done'][key] = snapshot_id
+        entry = {'step': step, 'event': 'done', 'run_id': run['run_id'], 'key': key}
+        if snapshot_id:
+            entry['snapshot_id'] = snapshot_id
+        self._write(entry)
+
+    def finish(self, step):
+        ''' Records that a step completed. What it did is kept until end(),
+        so a run that dies in a later step does not do it again '''
+        run = self._runs[step]
+        run['finished'] = True
+        self._write({'step': step, 'event': 'finish', 'run_id': run['run_id']})
+
+    def end(self):
+        ''' Records that the whole run is done by emptying the file, so the
+        next run starts afresh. Steps left unfinished are kept, to be
+        resumed '''
+        if any(not run['finished'] for run in self._runs.itervalues()):
+            return False
+        with self._lock:
+            self._runs = {}
+            open(self.path, 'w').close()
+        return True
+
+    def unfinished(self):
+        ''' The run ids of the steps left unfinished, by step '''
+        return dict((step, run['run_id']) for step, run in self._runs.iteritems() if not run['finished'])
@@ -0,0 +1,169 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ('Metrics', 'to_prometheus', 'to_statsd', 'send_statsd', 'write_prometheus')
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the API latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class _Operation(object):
+    __slots__ = ('calls', 'retries', 'errors', 'seconds', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.seconds = 0.0
+        # One count per bucket, plus one for slower calls
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+class Metrics(object):
+    ''' Timings and counts for one account and region. Phases (listing,
+    filtering, creating, deleting...) record their wall time, API calls their
+    latency, retries and errors per operation, and counters the number of
+    volumes and snapshots scanned and acted on. Safe to share between
+    threads. '''
+
+    def __init__(self, account=None, region=None, clock=time.time):
+        self.account = account
+        self.region = region
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.phases = {}
+        self.operations = {}
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name):
+        ''' Times a block of code as a phase. A phase run more than once adds up '''
+        start = self._clock()
+        try:
+            yield
+        finally:
+            elapsed = self._clock() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def api_call(self, operation, seconds, retries=0, error=False):
+        ''' Records one API call, including any retries and the time spent
+        waiting for the rate limiter '''
+        with self._lock:
+            op = self.operations.get(operation)
+            if op is None:
+                op = self.operations[operation] = _Operation()
+            op.calls += 1
+            op.retries += retries
+            op.errors += 1 if error else 0
+            op.seconds += seconds
+            op.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        ''' A JSON serialisable summary '''
+        with self._lock:
+            return {
+                'account': self.account,
+                'region': self.region,
+                'phases': dict((name, round(seconds, 6)) for name, seconds in self.phases.iteritems()),
+                'counters': dict(self.counters),
+                'api_calls': dict((name, {
+                    'calls': op.calls,
+                    'retries': op.retries,
+                    'errors': op.errors,
+                    'seconds': round(op.seconds, 6),
+                    'latency_buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], op.buckets)),
+                }) for name, op in self.operations.iteritems()),
+            }
+
+def _labels(metrics, **extra):
+    labels = [('account', metrics.account or 'self'), ('region', metrics.region or '')] + sorted(extra.items())
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+def to_prometheus(all_metrics, prefix='backup_monkey'):
+    ''' The metrics of several accounts and regions in the Prometheus text
+    format, e.g. for the node_exporter textfile collector '''
+    lines = []
+    def family(name, kind, help):
+        lines.append('# HELP %s_%s %s' % (prefix, name, help))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+    family('phase_seconds', 'gauge', 'Wall time of each phase of the last run')
+    for m in all_metrics:
+        for phase, seconds in sorted(m.phases.items()):
+            lines.append('%s_phase_seconds%s %f' % (prefix, _labels(m, phase=phase), seconds))
+    family('objects', 'gauge', 'Volumes and snapshots scanned and acted on in the last run')
+    for m in all_metrics:
+        for name, value in sorted(m.counters.items()):
+            lines.append('%s_objects%s %d' % (prefix, _labels(m, kind=name), value))
+    for name, help in (('calls', 'EC2 API calls'), ('retries', 'Retries of throttled EC2 API calls'),
+                       ('errors', 'Failed EC2 API calls')):
+        family('api_%s' % name, 'gauge', '%s in the last run' % help)
+        for m in all_metrics:
+            for operation, op in sorted(m.operations.items()):
+                lines.append('%s_api_%s%s %d' % (prefix, name, _labels(m, operation=operation), getattr(op, name)))
+    family('api_latency_seconds', 'histogram', 'Latency of EC2 API calls in the last run, including retries')
+    for m in all_metrics:
+        for operation, op in sorted(m.operations.items()):
+            total = 0
+            for bound, count in zip([repr(b) for b in LATENCY_BUCKETS] + ['+Inf'], op.buckets):
+                total += count
+                lines.append('%s_api_latency_seconds_bucket%s %d' % (prefix, _labels(m, operation=operation, le=bound), total))
+            lines.append('%s_api_latency_seconds_sum%s %f' % (prefix, _labels(m, operation=operation), op.seconds))
+            lines.append('%s_api_latency_seconds_count%s %d' % (prefix, _labels(m, operation=operation), op.calls))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path, all_metrics):
+    ''' Writes a Prometheus textfile. It is renamed into place, so the
+    collector never reads a half written file '''
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as fh:
+        fh.write(to_prometheus(all_metrics))
+    os.rename(tmp, path)
+
+def to_statsd(all_metrics, prefix='backup_monkey'):
+    ''' The metrics as StatsD lines, as gauges and timers '''
+    lines = []
+    for m in all_metrics:
+        target = '%s.%s.%s' % (prefix, m.account or 'self', m.region or 'unknown')
+        for phase, seconds in sorted(m.phases.items()):
+            lines.append('%s.phase.%s:%d|ms' % (target, phase, seconds * 1000))
+        for name, value in sorted(m.counters.items()):
+            lines.append('%s.objects.%s:%d|g' % (target, name, value))
+        for operation, op in sorted(m.operations.items()):
+            for name in ('calls', 'retries', 'errors'):
+                lines.append('%s.api.%s.%s:%d|g' % (target, operation, name, getattr(op, name)))
+            if op.calls:
+                lines.append('%s.api.%s.latency:%d|ms' % (target, operation, op.seconds * 1000 / op.calls))
+    return lines
+
+def send_statsd(address, all_metrics):
+    ''' Sends the metrics to a StatsD server at host:port over UDP '''
+    host, _, port = address.rpartition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for line in to_statsd(all_metrics):
+            sock.sendto(line, (host or 'localhost', int(port)))
+    finally:
+        sock.close()
@@ -0,0 +1,157 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+import sys
+import threading
+import time
+
+__all__ = ('Result', 'RunReport', 'Summary')
+log = logging.getLogger(__name__)
+
+class Result(object):
+    ''' What happened to one volume or snapshot. `action` is snapshot,
+    delete, copy (to another region) or copy_delete (of an old copy), and
+    `status` one of ok, failed, skipped (e.g. a detached volume with a
+    recent snapshot), resumed (done by an earlier run that did not finish)
+    or pending (a copy still going at the timeout). `size` is the size of
+    the volume in GiB, when known, and `seconds` how long the API call
+    took '''
+    __slots__ = ('action', 'status', 'volume_id', 'snapshot_id', 'size', 'seconds', 'detail')
+
+    def __init__(self, action, status, volume_id=None, snapshot_id=None, size=None, seconds=None, detail=None):
+        self.action = action
+        self.status = status
+        self.volume_id = volume_id
+        self.snapshot_id = snapshot_id
+        self.size = size
+        self.seconds = seconds
+        self.detail = detail
+
+    def to_dict(self):
+        ''' A JSON serialisable dictionary, without the fields that are not set '''
+        entry = dict((name, getattr(self, name)) for name in self.__slots__ if getattr(self, name) is not None)
+        if self.seconds is not None:
+            entry['seconds'] = round(self.seconds, 6)
+        return entry
+
+    def __repr__(self):
+        return 'Result(%r, %r, volume_id=%r, snapshot_id=%r)' % (self.action, self.status, self.volume_id, self.snapshot_id)
+
+class _Totals(object):
+    __slots__ = ('statuses', 'gib', 'seconds', 'max_seconds')
+
+    def __init__(self):
+        self.statuses = {}
+        self.gib = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+class Summary(object):
+    ''' Totals of a number of results, by action: how many had each status,
+    the GiB of volume data the successful ones covered, and the time their
+    API calls took. Only the totals are held, never the results, so its size
+    does not grow with the number of volumes. Not safe to share between
+    threads on its own. '''
+
+    def __init__(self):
+        self._actions = {}
+
+    def add(self, result):
+        totals = self._actions.get(result.action)
+        if totals is None:
+            totals = self._actions[result.action] = _Totals()
+        totals.statuses[result.status] = totals.statuses.get(result.status, 0) + 1
+        if result.status == 'ok' and result.size:
+            totals.gib += result.size
+        if result.seconds is not None:
+            totals.seconds += result.seconds
+            totals.max_seconds = max(totals.max_seconds, result.seconds)
+
+    def count(self, action, status=None):
+        ''' The number of results for an action, or for an action with a status '''
+        totals = self._actions.get(action)
+        if totals is None:
+            return 0
+        if status is None:
+            return sum(totals.statuses.itervalues())
+        return totals.statuses.get(status, 0)
+
+    def gib(self, action):
+        ''' The GiB of volume data covered by the successful results for an action '''
+        totals = self._actions.get(action)
+        return totals.gib if totals else 0
+
+    def to_dict(self):
+        ''' A JSON serialisable summary '''
+        return dict((action, {
+            'statuses': dict(totals.statuses),
+            'gib': totals.gib,
+            'bytes': totals.gib * 2 ** 30,
+            'seconds': round(totals.seconds, 6),
+            'max_seconds': round(totals.max_seconds, 6),
+        }) for action, totals in self._actions.iteritems())
+
+class RunReport(object):
+    ''' A JSON Lines report of every volume snapshotted, skipped or resumed
+    and every snapshot deleted, in all accounts and regions of a run. Each
+    result is written out as it arrives, so a long run can be followed with
+    tail -f, and what it had done is on disk if it dies. close() adds a last
+    line with the totals. A failure to write is logged once, and does not
+    fail the run. Safe to share between threads. '''
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._fh = sys.stdout if path == '-' else open(path, 'w')
+        self._broken = False
+        self.started = clock()
+        self.summary = Summary()
+
+    def _write_line(self, entry):
+        if self._broken:
+            return
+        try:
+            self._fh.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._fh.flush()
+        except (IOError, OSError) as e:
+            log.error('Could not write to the report %s, no more results will be written: %s', self.path, e)
+            self._broken = True
+
+    def write(self, account, region, result):
+        entry = result.to_dict()
+        entry.update({'type': 'result', 'account': account, 'region': region, 'time': self._clock()})
+        with self._lock:
+            self.summary.add(result)
+            self._write_line(entry)
+
+    def close(self, targets=()):
+        ''' Writes the totals, along with the error message (or None) of each
+        (target name, error) in `targets`, and closes the report. Returns
+        the summary line '''
+        finished = self._clock()
+        with self._lock:
+            entry = {
+                'type': 'summary',
+                'started': self.started,
+                'finished': finished,
+                'seconds': round(finished - self.started, 6),
+                'results': self.summary.to_dict(),
+                'targets': dict(targets),
+            }
+            self._write_line(entry)
+            if self._fh is not sys.stdout:
+                self._fh.close()
+        return entry
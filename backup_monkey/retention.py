@@ -0,0 +1,225 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import calendar
+import heapq
+import logging
+
+__all__ = ('GFSRetention', 'KeepNewest', 'RetentionPolicy', 'SnapshotGroup', 'parse_start_time')
+log = logging.getLogger(__name__)
+
+# Seconds since the epoch at the start of each day we have seen. There are
+# only a few thousand distinct days, however many snapshots there are
+_day_starts = {}
+
+def parse_start_time(start_time):
+    ''' Converts an EC2 timestamp (e.g. 2016-01-01T10:00:00.000Z) to seconds
+    since the epoch. Much cheaper than time.strptime, which matters when
+    there are millions of snapshots '''
+    day = start_time[:10]
+    day_start = _day_starts.get(day)
+    if day_start is None:
+        day_start = _day_starts[day] = calendar.timegm((int(day[0:4]), int(day[5:7]), int(day[8:10]), 0, 0, 0))
+    return day_start + int(start_time[11:13]) * 3600 + int(start_time[14:16]) * 60 + int(start_time[17:19])
+
+class SnapshotGroup(object):
+    ''' The snapshots of all volumes of an instance taken together, which
+    are kept or expired as one. It goes through KeepNewest and GFSRetention
+    like a single snapshot of a volume called `key` (e.g. the instance id),
+    started when the first of its snapshots was '''
+    __slots__ = ('id', 'volume_id', 'start_time', 'snapshots')
+
+    def __init__(self, id, key, snapshots):
+        self.id = id
+        self.volume_id = key
+        self.start_time = min(s.start_time for s in snapshots)
+        self.snapshots = snapshots
+
+    def __len__(self):
+        return len(self.snapshots)
+
+class KeepNewest(object):
+    ''' Keeps the newest `keep` snapshots of each volume as snapshots stream
+    in, in one bounded min-heap per volume. A snapshot that is pushed out of
+    a heap, or is too old to get into one, is handed straight to `expire`.
+    `newest` has the start time of the newest snapshot of each volume, in
+    seconds since the epoch. '''
+
+    def __init__(self, keep, expire):
+        self.keep = keep
+        self._expire = expire
+        self._heaps = {}
+        self.counts = {}
+        self.newest = {}
+
+    def add(self, snapshot):
+        volume_id = snapshot.volume_id
+        self.counts[volume_id] = self.counts.get(volume_id, 0) + 1
+        # The snapshot id breaks ties, so snapshots themselves are never compared
+        entry = (parse_start_time(snapshot.start_time), snapshot.id, snapshot)
+        if entry[0] > self.newest.get(volume_id, 0):
+            self.newest[volume_id] = entry[0]
+        heap = self._heaps.get(volume_id)
+        if heap is None:
+            heap = self._heaps[volume_id] = []
+        if len(heap) < self.keep:
+            heapq.heappush(heap, entry)
+        elif heap and entry > heap[0]:
+            self._expire(heapq.heapreplace(heap, entry)[2])
+        else:
+            self._expire(snapshot)
+
+    def kept(self, volume_id):
+        ''' The snapshots kept for a volume, newest first '''
+        return [entry[2] for entry in sorted(self._heaps.get(volume_id, []), reverse=True)]
+
+def _day(timestamp, start_time):
+    return timestamp // 86400
+
+def _week(timestamp, start_time):
+    # 1970-01-01 was a Thursday, shift by three days so weeks start on Monday
+    return (timestamp // 86400 + 3) // 7
+
+def _month(timestamp, start_time):
+    return int(start_time[0:4]) * 12 + int(start_time[5:7])
+
+class RetentionPolicy(object):
+    ''' A grandfather-father-son schedule: the newest `latest` snapshots of a
+    volume, plus the newest snapshot of each of the last `daily` days, `weekly`
+    weeks and `monthly` months that have snapshots. Snapshots older than
+    `max_age` seconds are never kept. '''
+
+    def __init__(self, latest=0, daily=0, weekly=0, monthly=0, max_age=None):
+        self.latest = latest
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.max_age = max_age
+
+    def periods(self):
+        ''' (bucket name, number of periods to keep, period function) for the
+        buckets that keep anything '''
+        return [(name, keep, period) for name, keep, period in (('daily', self.daily, _day),
+                                                                ('weekly', self.weekly, _week),
+                                                                ('monthly', self.monthly, _month)) if keep]
+
+    def __str__(self):
+        ''' e.g. latest=3,daily=7,weekly=4,max-age=90d '''
+        parts = ['%s=%d' % (name, keep) for name, keep in (('latest', self.latest), ('daily', self.daily),
+                                                           ('weekly', self.weekly), ('monthly', self.monthly)) if keep]
+        if self.max_age is not None:
+            parts.append('max-age=%dd' % (self.max_age // 86400))
+        return ','.join(parts)
+
+    def __repr__(self):
+        return 'RetentionPolicy(latest=%d, daily=%d, weekly=%d, monthly=%d, max_age=%r)' % (
+            self.latest, self.daily, self.weekly, self.monthly, self.max_age)
+
+class _VolumeBuckets(object):
+    __slots__ = ('latest', 'periods', 'holds')
+
+    def __init__(self, num_periods):
+        self.latest = []
+        self.periods = [{} for i in range(num_periods)]
+        # snapshot id -> names of the buckets currently keeping it
+        self.holds = {}
+
+class GFSRetention(object):
+    ''' Evaluates a RetentionPolicy over a single pass of the snapshot listing.
+    Like KeepNewest, only the snapshots some bucket still keeps are held on
+    to. A snapshot no bucket wants is handed to `expire` as soon as that is
+    known: once a newer snapshot takes its place in a period, or its period
+    falls out of the newest N, nothing that arrives later can bring it back.
+    As in KeepNewest, `newest` has the start time of each volume's newest
+    snapshot, whether or not it is kept. '''
+
+    def __init__(self, policy, expire, now):
+        self.policy = policy
+        self._expire = expire
+        self._periods = policy.periods()
+        self._oldest = now - policy.max_age if policy.max_age is not None else None
+        self._volumes = {}
+        self.counts = {}
+        self.newest = {}
+
+    def _keep(self, volume, entry, bucket):
+        volume.holds.setdefault(entry[1], []).append(bucket)
+
+    def _release(self, volume, entry, bucket):
+        buckets = volume.holds[entry[1]]
+        buckets.remove(bucket)
+        if not buckets:
+            del volume.holds[entry[1]]
+            self._expire(entry[2])
+
+    def add(self, snapshot):
+        volume_id = snapshot.volume_id
+        self.counts[volume_id] = self.counts.get(volume_id, 0) + 1
+        volume = self._volumes.get(volume_id)
+        if volume is None:
+            volume = self._volumes[volume_id] = _VolumeBuckets(len(self._periods))
+
+        timestamp = parse_start_time(snapshot.start_time)
+        if timestamp > self.newest.get(volume_id, 0):
+            self.newest[volume_id] = timestamp
+        if self._oldest is not None and timestamp < self._oldest:
+            self._expire(snapshot)
+            return
+        entry = (timestamp, snapshot.id, snapshot)
+        # Keep the snapshot until the buckets have had their say
+        self._keep(volume, entry, None)
+
+        if len(volume.latest) < self.policy.latest:
+            heapq.heappush(volume.latest, entry)
+            self._keep(volume, entry, 'latest')
+        elif volume.latest and entry > volume.latest[0]:
+            self._keep(volume, entry, 'latest')
+            self._release(volume, heapq.heapreplace(volume.latest, entry), 'latest')
+
+        for (bucket, keep, period), slots in zip(self._periods, volume.periods):
+            key = period(timestamp, snapshot.start_time)
+            current = slots.get(key)
+            if current is not None:
+                if entry > current:
+                    slots[key] = entry
+                    self._keep(volume, entry, bucket)
+                    self._release(volume, current, bucket)
+            elif len(slots) < keep:
+                slots[key] = entry
+                self._keep(volume, entry, bucket)
+            else:
+                oldest = min(slots)
+                if key > oldest:
+                    slots[key] = entry
+                    self._keep(volume, entry, bucket)
+                    self._release(volume, slots.pop(oldest), bucket)
+
+        self._release(volume, entry, None)
+
+    def kept(self, volume_id):
+        ''' The snapshots kept for a volume, newest first '''
+        volume = self._volumes.get(volume_id)
+        if volume is None:
+            return []
+        entries = set()
+        for slots in volume.periods:
+            entries.update(slots.itervalues())
+        entries.update(volume.latest)
+        return [entry[2] for entry in sorted(entries, reverse=True)]
+
+    def buckets(self, volume_id, snapshot_id):
+        ''' The names of the buckets that kept a snapshot, e.g. ['daily', 'weekly'] '''
+        volume = self._volumes.get(volume_id)
+        if volume is None:
+            return []
+        return sorted(volume.holds.get(snapshot_id, []))
@@ -0,0 +1,201 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+
+__all__ = ('TagRule', 'TagMatcher', 'escape_filter_value', 'parse_tag_selector')
+log = logging.getLogger(__name__)
+
+def escape_filter_value(value):
+    ''' Escapes the characters EC2 filter values treat as wildcards (* and
+    ?), and the backslash, so `value` only matches itself '''
+    return value.replace('\\', '\\\\').replace('*', '\\*').replace('?', '\\?')
+
+def _read_quoted(text, pos):
+    ''' Reads a '...' or "..." string starting at pos, where a backslash
+    escapes the next character. Returns the string and the position after it '''
+    quote = text[pos]
+    chars = []
+    pos += 1
+    while pos < len(text):
+        c = text[pos]
+        if c == '\\' and pos + 1 < len(text):
+            chars.append(text[pos + 1])
+            pos += 2
+        elif c == quote:
+            return ''.join(chars), pos + 1
+        else:
+            chars.append(c)
+            pos += 1
+    raise ValueError('unterminated %s in %r' % (quote, text))
+
+def _read_list(text, pos):
+    ''' Reads a [value, 'value', ...] list starting at pos '''
+    values = []
+    pos += 1
+    while True:
+        while pos < len(text) and text[pos] == ' ':
+            pos += 1
+        if pos == len(text):
+            raise ValueError('missing ] in %r' % text)
+        if text[pos] in '\'"':
+            value, pos = _read_quoted(text, pos)
+        else:
+            end = pos
+            while end < len(text) and text[end] not in ',]':
+                end += 1
+            value, pos = text[pos:end].strip(), end
+        while pos < len(text) and text[pos] == ' ':
+            pos += 1
+        values.append(value)
+        if pos < len(text) and text[pos] == ',':
+            pos += 1
+        elif pos < len(text) and text[pos] == ']':
+            if pos + 1 != len(text):
+                raise ValueError('unexpected %r after ] in %r' % (text[pos + 1:], text))
+            return values
+        else:
+            raise ValueError('expected , or ] in %r' % text)
+
+def parse_tag_selector(text):
+    ''' Parses a tag selector into (negated, TagRule). The grammar is
+
+        selector := ['!'] key [':' values]
+        key      := quoted | characters up to the first ':'
+        values   := '[' value (',' value)* ']' | any text, colons included
+        value    := quoted | characters up to the next ',' or ']'
+        quoted   := '...' or "..." with backslash escapes
+
+    A value ending in * matches any value starting with the text before it,
+    and a selector without values matches any volume with the tag. E.g.
+    Name:foo, Name:['bar','baz'], !Env:dev*, "aws:cloudformation:stack-name" '''
+    if not text:
+        raise ValueError('empty tag selector')
+    negated = text.startswith('!')
+    pos = 1 if negated else 0
+    if pos < len(text) and text[pos] in '\'"':
+        key, pos = _read_quoted(text, pos)
+    else:
+        end = text.find(':', pos)
+        end = len(text) if end < 0 else end
+        key, pos = text[pos:end], end
+    if not key:
+        raise ValueError('missing tag key in %r' % text)
+    if pos == len(text):
+        return negated, TagRule(key)
+    if text[pos] != ':':
+        raise ValueError('expected : after the tag key in %r' % text)
+    pos += 1
+    if text[pos:pos + 1] == '[':
+        return negated, TagRule(key, _read_list(text, pos))
+    return negated, TagRule(key, [text[pos:]])
+
+class TagRule(object):
+    ''' Matches a tag `key` whose value is any of `values`. A value ending in
+    * matches any value starting with what comes before it, and no values at
+    all matches any value, as long as the tag is there. '''
+    __slots__ = ('key', 'values', 'exact', 'prefixes', 'any_value')
+
+    def __init__(self, key, values=None):
+        self.key = key
+        self.values = list(values or [])
+        self.exact = frozenset(v for v in self.values if not v.endswith('*'))
+        self.prefixes = tuple(v[:-1] for v in self.values if v.endswith('*'))
+        self.any_value = not self.values or '' in self.prefixes
+
+    def match(self, value):
+        return self.any_value or value in self.exact or (self.prefixes and value.startswith(self.prefixes))
+
+    def merge(self, other):
+        ''' A rule matching what either rule matches '''
+        if self.any_value or other.any_value:
+            return TagRule(self.key)
+        return TagRule(self.key, self.values + [v for v in other.values if v not in self.values])
+
+    def filter_values(self):
+        ''' The values as EC2 filter values, matching what match() does: only
+        the trailing * of a prefix is a wildcard '''
+        return [escape_filter_value(v[:-1]) + '*' if v.endswith('*') else escape_filter_value(v) for v in self.values]
+
+    def __repr__(self):
+        return 'TagRule(%r, %r)' % (self.key, self.values)
+
+class TagMatcher(object):
+    ''' Decides which volumes to snapshot from their tags. A volume has to
+    match every include rule, and must not match any exclude rule.
+
+    The rules are compiled once. Include rules are sent to EC2 as filters
+    where possible, so they only have to be checked here when they could not
+    be. Exclude rules are indexed by tag key, so checking a volume costs one
+    dictionary lookup per tag it has, however many rules there are. '''
+
+    def __init__(self, include=(), exclude=()):
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self._filters = {}
+        self._local_include = []
+        for rule in self.include:
+            if rule.any_value:
+                # tag-key values are ORed by EC2, so only one key can go there
+                name, value = 'tag-key', escape_filter_value(rule.key)
+            else:
+                values = rule.filter_values()
+                name, value = 'tag:%s' % rule.key, values[0] if len(values) == 1 else values
+            # EC2 filters are a dictionary, so any further rules on the same
+            # key are checked here
+            if name in self._filters:
+                self._local_include.append(rule)
+            else:
+                self._filters[name] = value
+        self._exclude_index = {}
+        for rule in self.exclude:
+            current = self._exclude_index.get(rule.key)
+            self._exclude_index[rule.key] = current.merge(rule) if current else rule
+
+    @classmethod
+    def compile(cls, tags=(), exclude_tags=(), reverse=False):
+        ''' Builds a matcher from tag selectors (see parse_tag_selector).
+        Selectors in `tags` are include rules, unless negated with !.
+        `exclude_tags` and `reverse` turn that the other way around. Raises
+        ValueError for a selector that does not parse '''
+        include, exclude = [], []
+        for selectors, negate in ((tags, bool(reverse)), (exclude_tags, True)):
+            for selector in selectors or []:
+                negated, rule = parse_tag_selector(selector)
+                (exclude if negated != negate else include).append(rule)
+        return cls(include, exclude)
+
+    def __nonzero__(self):
+        return bool(self.include or self.exclude)
+
+    def filters(self):
+        ''' EC2 DescribeVolumes filters for the include rules EC2 can check '''
+        return dict(self._filters)
+
+    def needs_local_check(self):
+        ''' Whether volumes returned by EC2 still have to go through match() '''
+        return bool(self._local_include or self._exclude_index)
+
+    def match(self, tags):
+        ''' Checks the rules EC2 has not already checked against a volume's tags '''
+        for rule in self._local_include:
+            value = tags.get(rule.key)
+            if value is None or not rule.match(value):
+                return False
+        if self._exclude_index:
+            index = self._exclude_index
+            for key, value in tags.iteritems():
+                rule = index.get(key)
+                if rule is not None and rule.match(value):
+                    return False
+        return True
@@ -0,0 +1,128 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import httplib
+import logging
+import random
+import socket
+import threading
+import time
+
+__all__ = ('RateLimiter', 'is_retryable_error', 'is_throttle_error')
+log = logging.getLogger(__name__)
+
+# Error codes AWS uses when a caller goes over the API request rate
+THROTTLE_ERROR_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+def is_throttle_error(e):
+    ''' Whether the exception is AWS telling us to slow down '''
+    return getattr(e, 'error_code', None) in THROTTLE_ERROR_CODES
+
+def is_retryable_error(e):
+    ''' Whether the call is worth another try: throttling, a server error or
+    a network error. boto would retry these on its own, but Backup Monkey's
+    connections leave retries to the RateLimiter '''
+    if is_throttle_error(e) or isinstance(e, (socket.error, httplib.HTTPException)):
+        return True
+    status = getattr(e, 'status', None)
+    return isinstance(status, int) and status >= 500
+
+class RateLimiter(object):
+    ''' A token bucket shared by every thread making API calls for one
+    connection. Throttled calls are retried with jittered exponential backoff,
+    and throttling halves the request rate, at most once every `cooldown`
+    seconds: when many threads are throttled at once, they are all answering
+    the same excess, so it only calls for one decrease. Successful calls then
+    raise the rate by `increase` of itself per second, so it climbs back in
+    the same number of seconds whatever the rate. '''
+
+    def __init__(self, rate=10.0, burst=None, max_retries=8, base_delay=0.5, max_delay=30.0,
+                 min_rate=0.5, cooldown=1.0, increase=0.1, clock=time.time, sleep=time.sleep,
+                 random=random.random):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.burst = float(burst or max(rate, 1))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cooldown = cooldown
+        self.increase = increase
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+        self._last_decrease = None
+        self._last_change = self._last
+
+    def acquire(self):
+        ''' Takes a token, blocking until it is due. Tokens may be reserved
+        ahead of time, so waiting callers are served in order '''
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            self._sleep(wait)
+
+    def throttled(self):
+        ''' Multiplicative decrease of the request rate, unless it was
+        already decreased in the last `cooldown` seconds. Returns whether it
+        was decreased '''
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._tokens, 0)
+            if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+                return False
+            self._last_decrease = self._last_change = now
+            self.rate = max(self.min_rate, self.rate / 2)
+        log.warning('API requests are being throttled, slowing down to %.2f requests per second', self.rate)
+        return True
+
+    def succeeded(self):
+        ''' Increase of the request rate in proportion to itself and to the
+        time since the last change, back up to the maximum '''
+        if self.rate < self.max_rate:
+            with self._lock:
+                now = self._clock()
+                self.rate = min(self.max_rate, self.rate * (1 + self.increase * (now - self._last_change)))
+                self._last_change = now
+
+    def backoff(self, attempt):
+        ''' Seconds to wait before retry number `attempt` (full jitter) '''
+        return self._random() * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    def call(self, func, *args, **kwargs):
+        ''' Calls func once a token is available, retrying when throttled,
+        or on a server or network error. Only throttling lowers the rate '''
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable_error(e) or attempt >= self.max_retries:
+                    raise
+                if is_throttle_error(e):
+                    self.throttled()
+                delay = self.backoff(attempt)
+                attempt += 1
+                log.debug('Retry %d of %s in %.2f seconds', attempt, getattr(func, '__name__', func), delay)
+                self._sleep(delay)
+            else:
+                self.succeeded()
+                return result
@@ -0,0 +1,126 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import time
+
+__all__ = ('SnapshotWaiter', 'percentile')
+log = logging.getLogger(__name__)
+
+# A new snapshot may not be visible to DescribeSnapshots for a poll or two.
+# One missing from this many polls in a row has been deleted
+MAX_MISSING_POLLS = 5
+
+def percentile(values, p):
+    ''' The nearest-rank p-th percentile of a list of numbers '''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))]
+
+class SnapshotWaiter(object):
+    ''' Waits for a set of snapshots to finish, asking EC2 about up to
+    `batch_size` of them per DescribeSnapshots call. The time between polls
+    starts at `min_interval` seconds and doubles, up to `max_interval`, for
+    as long as no snapshot finishes. A snapshot DescribeSnapshots does not
+    return for `max_missing_polls` polls in a row counts as failed, so one
+    deleted while we wait cannot keep us waiting forever. '''
+
+    def __init__(self, describe, min_interval=5, max_interval=60, timeout=None, batch_size=200,
+                 max_missing_polls=MAX_MISSING_POLLS, clock=time.time, sleep=time.sleep):
+        self._describe = describe
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_missing_polls = max_missing_polls
+        self._clock = clock
+        self._sleep = sleep
+        self.durations = {}
+        self.failed = []
+        self.pending = []
+        self.completed = []
+        self._missing = {}
+
+    def wait(self, snapshot_ids, started=None):
+        ''' Polls until every snapshot has completed or failed, or until the
+        timeout. `started` is when the snapshots were created, and defaults to
+        now. Afterwards `durations` has the seconds each completed snapshot
+        took, `completed` the snapshots themselves, `failed` the ids of
+        snapshots in the error state or gone missing and `pending` the ids
+        still going '''
+        started = self._clock() if started is None else started
+        pending = list(snapshot_ids)
+        interval = None
+        while pending:
+            finished, progress = self._poll(pending, started)
+            pending = [snapshot_id for snapshot_id in pending if snapshot_id not in finished]
+            log.info('%d of %d snapshots completed, %d failed, %d pending%s',
+                     len(self.durations), len(snapshot_ids), len(self.failed), len(pending),
+                     ' (%s average progress)' % progress if pending and progress else '')
+            if not pending:
+                break
+            if finished or interval is None:
+                interval = self.min_interval
+            else:
+                interval = min(self.max_interval, interval * 2)
+            if self.timeout is not None and self._clock() - started + interval > self.timeout:
+                log.warning('Gave up waiting for %d snapshots after %d seconds', len(pending), self._clock() - started)
+                break
+            self._sleep(interval)
+        self.pending = pending
+        return not self.failed and not self.pending
+
+    def _poll(self, pending, started):
+        ''' Checks on the pending snapshots. Returns the ids of the ones that
+        finished, and the average progress of the rest as a string, e.g. 45% '''
+        now = self._clock()
+        finished = set()
+        progress = []
+        seen = set()
+        for i in range(0, len(pending), self.batch_size):
+            for snapshot in self._describe(pending[i:i + self.batch_size]):
+                seen.add(snapshot.id)
+                if snapshot.status == 'completed':
+                    self.durations[snapshot.id] = now - started
+                    self.completed.append(snapshot)
+                    finished.add(snapshot.id)
+                elif snapshot.status == 'error':
+                    log.error('Snapshot %s failed', snapshot.id)
+                    self.failed.append(snapshot.id)
+                    finished.add(snapshot.id)
+                else:
+                    try:
+                        progress.append(int((getattr(snapshot, 'progress', None) or '0%').rstrip('%')))
+                    except ValueError:
+                        pass
+        # A snapshot EC2 does not know about yet is still pending, for a while
+        for snapshot_id in pending:
+            if snapshot_id in seen:
+                self._missing.pop(snapshot_id, None)
+                continue
+            self._missing[snapshot_id] = self._missing.get(snapshot_id, 0) + 1
+            if self._missing[snapshot_id] >= self.max_missing_polls:
+                log.error('Snapshot %s has gone missing, it was not found in %d polls', snapshot_id,
+                          self._missing[snapshot_id])
+                self.failed.append(snapshot_id)
+                finished.add(snapshot_id)
+        average = '%d%%' % (sum(progress) / len(progress)) if progress else None
+        return finished, average
+
+    def summary(self):
+        ''' e.g. p50 120s, p90 300s, max 360s '''
+        durations = self.durations.values()
+        if not durations:
+            return 'no completed snapshots'
+        return 'p50 %ds, p90 %ds, max %ds' % (percentile(durations, 50), percentile(durations, 90), max(durations))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Retention benchmark
+===================
+Compares keeping the newest N snapshots per volume with a full sort of every
+volume's snapshots (how remove_old_snapshots used to work) against the
+bounded heaps in backup_monkey.retention, over synthetic snapshots that are
+generated as they are consumed, like pages from DescribeSnapshots.
+
+Each mode runs in its own process so the peak memory figures are separate:
+
+    python benchmarks/bench_retention.py --snapshots 1000000
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backup_monkey.retention import KeepNewest
+
+class SyntheticSnapshot(object):
+    __slots__ = ('id', 'volume_id', 'start_time')
+
+    def __init__(self, id, volume_id, start_time):
+        self.id = id
+        self.volume_id = volume_id
+        self.start_time = start_time
+
+def generate(snapshots, volumes):
+    ''' Snapshots spread evenly over the volumes, one per volume per hour '''
+    for i in xrange(snapshots):
+        hour = i // volumes
+        yield SyntheticSnapshot('snap-%08x' % i, 'vol-%08x' % (i % volumes),
+                                '2016-%02d-%02dT%02d:00:00.000Z' % (hour // 672 % 12 + 1, hour // 24 % 28 + 1, hour % 24))
+
+def run_sort(snapshots, keep):
+    vol_snap_map = {}
+    for snapshot in snapshots:
+        vol_snap_map.setdefault(snapshot.volume_id, []).append(snapshot)
+    expired = 0
+    for volume_id, most_recent_snapshots in vol_snap_map.iteritems():
+        most_recent_snapshots.sort(key=lambda s: s.start_time, reverse=True)
+        expired += len(most_recent_snapshots[keep:])
+    return expired
+
+def run_heap(snapshots, keep):
+    expired = [0]
+    def expire(snapshot):
+        expired[0] += 1
+    retention = KeepNewest(keep, expire)
+    for snapshot in snapshots:
+        retention.add(snapshot)
+    return expired[0]
+
+MODES = {'sort': run_sort, 'heap': run_heap}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per-volume snapshot retention')
+    parser.add_argument('--snapshots', type=int, default=1000000)
+    parser.add_argument('--volumes', type=int, default=20000)
+    parser.add_argument('--keep', type=int, default=3)
+    parser.add_argument('--mode', choices=sorted(MODES))
+    args = parser.parse_args()
+
+    if not args.mode:
+        for mode in sorted(MODES):
+            subprocess.check_call([sys.executable, __file__, '--mode', mode, '--snapshots', str(args.snapshots),
+                                   '--volumes', str(args.volumes), '--keep', str(args.keep)])
+        return
+
+    start = time.time()
+    expired = MODES[args.mode](generate(args.snapshots, args.volumes), args.keep)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print '%-5s %d snapshots, %d volumes, keep %d: %d expired in %.2fs, peak memory %.1f MB' % (
+        args.mode, args.snapshots, args.volumes, args.keep, expired, elapsed, peak)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End to end benchmark
+====================
+Runs BackupMonkey against the simulated EC2 backend in fake_ec2.py, with N
+volumes and M snapshots per volume, and reports the wall time, peak memory
+and EC2 API calls of each mode:
+
+    snapshot  snapshot_volumes
+    remove    remove_old_snapshots
+    plan      plan, without creating or deleting anything
+    full      snapshot_volumes, then remove_old_snapshots
+    wait      snapshot_volumes, wait_for_snapshots, then remove_old_snapshots
+    copy      as wait, with copy_snapshots to a second region in between
+
+Each mode runs in its own process so the peak memory figures are separate.
+New snapshots and copies are pending until --completion-polls
+DescribeSnapshots calls have returned them. Latency can be added to every
+API call, and the backend can throttle requests above a rate, e.g.
+
+    python benchmarks/bench_run.py --volumes 5000 --snapshots-per-volume 30
+    python benchmarks/bench_run.py --mode remove --latency 0.02 --api-rate 100 --concurrency 16
+
+With --json, each mode prints one JSON object instead, so results can be
+collected and compared between versions.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backup_monkey.core import BackupMonkey
+from backup_monkey.throttle import RateLimiter
+from fake_ec2 import FakeEC2Connection
+
+# The region copy mode copies to
+COPY_REGION = 'us-west-2'
+
+class SimulatedBackupMonkey(BackupMonkey):
+    ''' A BackupMonkey that talks to the simulated backend, with one
+    connection per region '''
+
+    def __init__(self, connections, *args, **kwargs):
+        self._simulated = connections
+        super(SimulatedBackupMonkey, self).__init__(*args, **kwargs)
+
+    def get_connection(self, region=None):
+        return self._simulated[region or self._region]
+
+def run_snapshot(monkey):
+    monkey.snapshot_volumes()
+
+def run_remove(monkey):
+    monkey.remove_old_snapshots()
+
+def run_plan(monkey):
+    monkey.plan()
+
+def run_full(monkey):
+    monkey.snapshot_volumes()
+    monkey.remove_old_snapshots()
+
+def run_wait(monkey):
+    monkey.snapshot_volumes()
+    monkey.wait_for_snapshots(min_interval=0, max_interval=0)
+    monkey.remove_old_snapshots()
+
+def run_copy(monkey):
+    monkey.snapshot_volumes()
+    monkey.wait_for_snapshots(min_interval=0, max_interval=0)
+    monkey.copy_snapshots(min_interval=0, max_interval=0)
+    monkey.remove_old_snapshots()
+
+MODES = {'snapshot': run_snapshot, 'remove': run_remove, 'plan': run_plan, 'full': run_full, 'wait': run_wait,
+         'copy': run_copy}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BackupMonkey against a simulated EC2 backend')
+    parser.add_argument('--volumes', type=int, default=2000)
+    parser.add_argument('--snapshots-per-volume', type=int, default=20)
+    parser.add_argument('--keep', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--api-rate', type=float, help='requests per second the backend accepts before throttling')
+    parser.add_argument('--page-size', type=int, default=1000, help='snapshots per DescribeSnapshots page, 0 for none')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--max-requests-per-second', type=float, default=100000.0)
+    parser.add_argument('--completion-polls', type=int, default=3,
+                        help='DescribeSnapshots calls that return a new snapshot or copy before it completes')
+    parser.add_argument('--max-copies-in-flight', type=int, default=5)
+    parser.add_argument('--mode', choices=sorted(MODES))
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    if not args.mode:
+        for mode in ('snapshot', 'remove', 'plan', 'full', 'wait', 'copy'):
+            subprocess.check_call([sys.executable, __file__, '--mode', mode] + sys.argv[1:])
+        return
+
+    logging.basicConfig(level=logging.CRITICAL)
+    conn = FakeEC2Connection(args.volumes, args.snapshots_per_volume, latency=args.latency, api_rate=args.api_rate,
+                             completion_polls=args.completion_polls)
+    copies = FakeEC2Connection(0, 0, latency=args.latency, api_rate=args.api_rate,
+                               completion_polls=args.completion_polls)
+    monkey = SimulatedBackupMonkey({'us-east-1': conn, COPY_REGION: copies}, 'us-east-1', args.keep, [], None, None,
+                                   None, None,
+                                   concurrency=args.concurrency,
+                                   limiter=RateLimiter(args.max_requests_per_second, base_delay=0.01, max_delay=0.1),
+                                   page_size=args.page_size or None,
+                                   copy_regions=[COPY_REGION] if args.mode == 'copy' else None,
+                                   max_copies_in_flight=args.max_copies_in_flight)
+
+    start = time.time()
+    MODES[args.mode](monkey)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    metrics = monkey.metrics.to_dict()
+    # API calls to both regions
+    calls = dict(conn.calls)
+    for action, count in copies.calls.iteritems():
+        calls[action] = calls.get(action, 0) + count
+    throttled = conn.throttled + copies.throttled
+
+    if args.json:
+        print json.dumps({'mode': args.mode, 'volumes': args.volumes,
+                          'snapshots_per_volume': args.snapshots_per_volume, 'seconds': round(elapsed, 3),
+                          'peak_mb': round(peak, 1), 'api_calls': calls, 'throttled': throttled,
+                          'counters': metrics['counters'], 'phases': metrics['phases']}, sort_keys=True)
+        return
+    print '%-8s %d volumes, %d snapshots each: %.2fs, peak memory %.1f MB, %d API calls (%s), %d throttled' % (
+        args.mode, args.volumes, args.snapshots_per_volume, elapsed, peak, sum(calls.itervalues()),
+        ', '.join('%s %d' % item for item in sorted(calls.items())), throttled)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tag matching benchmark
+======================
+Times --reverse-tags blacklist filtering of synthetic volumes, comparing the
+set difference get_volumes_to_snapshot used to do for every volume with the
+compiled, key-indexed rules of backup_monkey.tags.TagMatcher:
+
+    python benchmarks/bench_tags.py --volumes 100000 --rules 50
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backup_monkey.tags import TagMatcher, TagRule
+
+class SyntheticVolume(object):
+    __slots__ = ('id', 'tags')
+
+    def __init__(self, id, tags):
+        self.id = id
+        self.tags = tags
+
+def generate(volumes, tags_per_volume, seed=1):
+    rng = random.Random(seed)
+    keys = ['Name', 'Env', 'Team', 'Owner', 'Service', 'CostCenter', 'Role', 'Stack', 'Version', 'Backup']
+    return [SyntheticVolume('vol-%08x' % i,
+                            dict((key, '%s-%d' % (key.lower(), rng.randint(0, 200)))
+                                 for key in rng.sample(keys, tags_per_volume)))
+            for i in xrange(volumes)]
+
+def blacklist(rules, seed=2):
+    rng = random.Random(seed)
+    keys = ['Name', 'Env', 'Team', 'Owner', 'Service']
+    ret = {}
+    for i in range(rules):
+        key = rng.choice(keys)
+        ret.setdefault(key, []).append('%s-%d' % (key.lower(), rng.randint(0, 200)))
+    return ret
+
+def run_set_difference(volumes, filters):
+    black_list = []
+    for f in filters.keys():
+        black_list = black_list + [(f, i) for i in filters[f]]
+    ret = []
+    for v in volumes:
+        if len(set(v.tags.items()) - set(black_list)) == len(set(v.tags.items())):
+            ret.append(v)
+    return ret
+
+def run_matcher(volumes, filters):
+    matcher = TagMatcher(exclude=[TagRule(key, values) for key, values in filters.items()])
+    return [v for v in volumes if matcher.match(v.tags)]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark --reverse-tags filtering')
+    parser.add_argument('--volumes', type=int, default=100000)
+    parser.add_argument('--tags-per-volume', type=int, default=6)
+    parser.add_argument('--rules', type=int, default=50)
+    args = parser.parse_args()
+
+    volumes = generate(args.volumes, args.tags_per_volume)
+    filters = blacklist(args.rules)
+    results = {}
+    for name, func in (('set difference', run_set_difference), ('tag matcher', run_matcher)):
+        start = time.time()
+        results[name] = func(volumes, filters)
+        elapsed = time.time() - start
+        print '%-15s %d volumes, %d tags each, %d rules: %d kept in %.3fs (%.2fus per volume)' % (
+            name, args.volumes, args.tags_per_volume, args.rules, len(results[name]), elapsed,
+            elapsed * 1e6 / args.volumes)
+    assert results['set difference'] == results['tag matcher']
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,273 @@
+# Copyright 2013 Answers for AWS LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A simulated EC2 backend for the benchmarks. FakeEC2Connection has the parts
+of the boto EC2Connection that BackupMonkey uses, over N volumes with M
+Backup Monkey snapshots each, with optional per-call latency,
+DescribeSnapshots pagination and throttling. Like EC2 itself, the backend
+accepts up to `api_rate` requests per second (in bursts of up to a second's
+worth), and answers RequestLimitExceeded to anything more.
+
+As in EC2, new snapshots and copies start out pending. Each one completes
+once it has been returned by `completion_polls` DescribeSnapshots calls, so
+waiting for snapshots and copying them can be benchmarked too. A backend
+made with no volumes stands in for the region copies go to.
+
+The existing snapshots are not stored: snapshot i belongs to volume
+i % N and is the (i // N)th hour's snapshot of it, so its id, description
+and start time are worked out when it is listed. That keeps the backend's
+own memory small, so peak memory figures are mostly Backup Monkey's.
+"""
+
+import random
+import re
+import threading
+import time
+
+from boto.exception import EC2ResponseError
+
+THROTTLE_BODY = ('<?xml version="1.0" encoding="UTF-8"?><Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                 '<Message>Request limit exceeded.</Message></Error></Errors><RequestID>0</RequestID></Response>')
+
+class ResultSet(list):
+    next_token = None
+
+class FakeAttachData(object):
+    __slots__ = ('instance_id', 'device')
+
+    def __init__(self, instance_id, device):
+        self.instance_id = instance_id
+        self.device = device
+
+class FakeVolume(object):
+    __slots__ = ('connection', 'id', 'tags', 'attach_data', 'size')
+
+    def __init__(self, connection, id, tags, instance_id, device, size):
+        self.connection = connection
+        self.id = id
+        self.tags = tags
+        self.attach_data = FakeAttachData(instance_id, device)
+        self.size = size
+
+    @property
+    def volume_id(self):
+        # So the volume-id filter works the same as for snapshots
+        return self.id
+
+    def create_snapshot(self, description):
+        return self.connection.create_snapshot(self.id, description)
+
+class FakeSnapshot(object):
+    __slots__ = ('connection', 'id', 'volume_id', 'description', 'start_time', 'status', 'progress', 'tags')
+
+    def __init__(self, connection, id, volume_id, description, start_time, status='completed', tags=None):
+        self.connection = connection
+        self.id = id
+        self.volume_id = volume_id
+        self.description = description
+        self.start_time = start_time
+        self.status = status
+        self.progress = '100%' if status == 'completed' else '0%'
+        self.tags = tags or {}
+
+    def delete(self):
+        return self.connection.delete_snapshot(self.id)
+
+def _wildcard(value):
+    ''' A predicate for an EC2 filter value, where * matches anything, ?
+    any one character, and a backslash escapes the next character '''
+    if '*' not in value and '?' not in value and '\\' not in value:
+        return lambda v: v == value
+    pattern = []
+    escaped = False
+    for c in value:
+        if escaped:
+            pattern.append(re.escape(c))
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        else:
+            pattern.append({'*': '.*', '?': '.'}.get(c) or re.escape(c))
+    regex = re.compile(''.join(pattern) + r'\Z', re.DOTALL)
+    return lambda v: v is not None and regex.match(v) is not None
+
+def _predicate(values):
+    if not isinstance(values, list):
+        values = [values]
+    tests = [_wildcard(v) for v in values]
+    return lambda v: any(test(v) for test in tests)
+
+class FakeEC2Connection(object):
+
+    def __init__(self, volumes=1000, snapshots_per_volume=10, prefix='BACKUP_MONKEY', latency=0.0, api_rate=None,
+                 instances_per_volume=0.5, seed=1, completion_polls=1):
+        self.num_volumes = volumes
+        self.snapshots_per_volume = snapshots_per_volume
+        self.completion_polls = completion_polls
+        # snapshot id -> DescribeSnapshots calls left before it completes
+        self._pending = {}
+        self.prefix = prefix
+        self.latency = latency
+        self.api_rate = api_rate
+        self._tokens = api_rate
+        self._last = time.time()
+        self.calls = {}
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._deleted = set()
+        self._created = []
+        self._next_id = volumes * snapshots_per_volume
+        self.volumes = []
+        for i in xrange(volumes):
+            # About instances_per_volume instances per volume, the rest detached
+            instance = i // 2 if self._random.random() < instances_per_volume * 2 else None
+            self.volumes.append(FakeVolume(self, 'vol-%08x' % i,
+                                           {'Name': 'volume-%d' % i, 'Env': ('prod', 'staging', 'dev')[i % 3]},
+                                           'i-%08x' % instance if instance is not None else None,
+                                           '/dev/sd%s' % 'fghijklmnop'[i % 11] if instance is not None else None,
+                                           8 + i % 100))
+
+    def _call(self, action):
+        ''' Counts an API call, then simulates its latency and throttling '''
+        with self._lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+            throttled = False
+            if self.api_rate:
+                now = time.time()
+                self._tokens = min(self.api_rate, self._tokens + (now - self._last) * self.api_rate)
+                self._last = now
+                if self._tokens < 1:
+                    throttled = True
+                    self.throttled += 1
+                else:
+                    self._tokens -= 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise EC2ResponseError(503, 'Service Unavailable', THROTTLE_BODY)
+
+    def total_calls(self):
+        return sum(self.calls.itervalues())
+
+    def _polled(self, snapshots):
+        ''' Counts a DescribeSnapshots call towards the completion of the
+        pending snapshots it returns '''
+        with self._lock:
+            for snapshot in snapshots:
+                if snapshot.status != 'pending':
+                    continue
+                polls = self._pending[snapshot.id] - 1
+                if polls > 0:
+                    self._pending[snapshot.id] = polls
+                    continue
+                del self._pending[snapshot.id]
+                snapshot.status = 'completed'
+                snapshot.progress = '100%'
+        return snapshots
+
+    def _new_snapshot(self, volume_id, description):
+        with self._lock:
+            snapshot = FakeSnapshot(self, 'snap-%08x' % self._next_id, volume_id, description,
+                                    time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime()), status='pending')
+            self._next_id += 1
+            self._created.append(snapshot)
+            self._pending[snapshot.id] = self.completion_polls
+        return snapshot
+
+    def _snapshot(self, i):
+        volume_id = 'vol-%08x' % (i % self.num_volumes)
+        hour = self.snapshots_per_volume - 1 - i // self.num_volumes
+        start = time.gmtime(1451606400 + hour * 3600)
+        return FakeSnapshot(self, 'snap-%08x' % i, volume_id, '%s %s' % (self.prefix, volume_id),
+                            time.strftime('%Y-%m-%dT%H:%M:%S.000Z', start))
+
+    def _snapshots_from(self, position):
+        ''' Yields (position, snapshot) for every snapshot from a position '''
+        total = self.num_volumes * self.snapshots_per_volume
+        for i in xrange(position, total):
+            if 'snap-%08x' % i not in self._deleted:
+                yield i, self._snapshot(i)
+        for i in xrange(max(0, position - total), len(self._created)):
+            snapshot = self._created[i]
+            if snapshot.id not in self._deleted:
+                yield total + i, snapshot
+
+    def _matcher(self, filters):
+        tests = []
+        for name, values in (filters or {}).iteritems():
+            if name.startswith('tag:'):
+                key, test = name[4:], _predicate(values)
+                tests.append(lambda s, key=key, test=test: test(s.tags.get(key)))
+            elif name == 'tag-key':
+                keys = values if isinstance(values, list) else [values]
+                tests.append(lambda s, keys=keys: any(k in s.tags for k in keys))
+            else:
+                attribute = {'snapshot-id': 'id', 'volume-id': 'volume_id', 'start-time': 'start_time'}.get(name, name)
+                test = _predicate(values)
+                tests.append(lambda s, attribute=attribute, test=test: test(getattr(s, attribute)))
+        return lambda s: all(test(s) for test in tests)
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        self._call('DescribeVolumes')
+        match = self._matcher(filters)
+        return [v for v in self.volumes if match(v) and (volume_ids is None or v.id in volume_ids)]
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        self._call('DescribeSnapshots')
+        match = self._matcher(filters)
+        return self._polled([s for i, s in self._snapshots_from(0)
+                             if match(s) and (snapshot_ids is None or s.id in snapshot_ids)])
+
+    def build_list_params(self, params, items, label):
+        pass
+
+    def build_filter_params(self, params, filters):
+        params['_filters'] = filters
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self._call(action)
+        match = self._matcher(params.get('_filters'))
+        page = ResultSet()
+        for i, snapshot in self._snapshots_from(int(params.get('NextToken', 0))):
+            if len(page) == params['MaxResults']:
+                page.next_token = str(i)
+                break
+            if match(snapshot):
+                page.append(snapshot)
+        self._polled(page)
+        return page
+
+    def create_snapshot(self, volume_id, description):
+        self._call('CreateSnapshot')
+        return self._new_snapshot(volume_id, description)
+
+    def copy_snapshot(self, source_region, source_snapshot_id, description=None):
+        self._call('CopySnapshot')
+        # Copies get a volume id of their own, as in EC2
+        return self._new_snapshot('vol-ffffffff', description).id
+
+    def create_tags(self, resource_ids, tags):
+        self._call('CreateTags')
+        ids = set(resource_ids)
+        for snapshot in self._created:
+            if snapshot.id in ids:
+                snapshot.tags.update(tags)
+
+    def delete_snapshot(self, snapshot_id):
+        self._call('DeleteSnapshot')
+        with self._lock:
+            self._deleted.add(snapshot_id)
+        return True
@@ -0,0 +1,231 @@
+''' In-memory stand-ins for the boto EC2 objects BackupMonkey uses, shared
+by the unit tests. Mocks only one test needs stay in its own file. '''
+import re
+import mock
+from boto.exception import EC2ResponseError
+from boto.resultset import ResultSet
+from backup_monkey.core import BackupMonkey
+from backup_monkey.throttle import RateLimiter
+
+THROTTLE_BODY = '''<?xml version="1.0" encoding="UTF-8"?>
+<Response><Errors><Error><Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message></Error></Errors><RequestID>5e3c9ad4</RequestID></Response>'''
+
+NOT_FOUND_BODY = '''<?xml version="1.0" encoding="UTF-8"?>
+<Response><Errors><Error><Code>InvalidSnapshot.NotFound</Code><Message>The snapshot does not exist.</Message></Error></Errors><RequestID>5e3c9ad4</RequestID></Response>'''
+
+def throttle_error():
+    return EC2ResponseError(503, 'Service Unavailable', THROTTLE_BODY)
+
+def matches(pattern, value):
+    ''' Whether `value` matches an EC2 filter value, where * and ? are
+    wildcards unless escaped with a backslash '''
+    regex = ''
+    chars = iter(pattern)
+    for c in chars:
+        if c == '\\':
+            regex += re.escape(next(chars, '\\'))
+        elif c == '*':
+            regex += '.*'
+        elif c == '?':
+            regex += '.'
+        else:
+            regex += re.escape(c)
+    return value is not None and re.match(regex + '$', value, re.S) is not None
+
+class FakeClock(object):
+    ''' Time only moves when somebody sleeps '''
+    def __init__(self, now=0.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class MockAttachData(object):
+    def __init__(self, instance_id=None, device=None):
+        self.instance_id = instance_id
+        self.device = device
+
+class MockSnapshot(object):
+    def __init__(self, id, volume_id, description=None, start_time='2016-01-01T10:00:00.000Z', status='completed',
+                 tags=None, connection=None):
+        self.id = id
+        self.volume_id = volume_id
+        self.volume_size = 8
+        self.description = description or 'BACKUP_MONKEY %s' % volume_id
+        self.start_time = start_time
+        self.status = status
+        self.progress = '100%' if status == 'completed' else '0%'
+        self.tags = tags or {}
+        self.connection = connection
+        # Number of times the snapshot is described before it completes, or 'error'
+        self.polls = 1
+
+    def delete(self):
+        if self.connection is None:
+            self.status = 'deleted'
+            return True
+        return self.connection.delete_snapshot(self.id)
+
+class MockVolume(object):
+    def __init__(self, connection, id, instance_id=None, device=None, size=8, tags=None):
+        self.connection = connection
+        self.id = id
+        self.size = size
+        self.tags = tags or {}
+        self.attach_data = MockAttachData(instance_id, device)
+
+    def create_snapshot(self, description):
+        return self.connection.create_snapshot(self.id, description)
+
+class MockEC2Connection(object):
+    ''' One region of EC2, kept in memory. New snapshots are pending until
+    they are described by id, deleted ones are only marked deleted, and
+    creating, tagging or deleting anything whose id is in `broken` fails.
+    Every request is recorded in `calls` '''
+    def __init__(self):
+        self.volumes = []
+        self.snapshots = []
+        self.broken = set()
+        self.created = []
+        self.deleted = []
+        self.calls = []
+        # The start time of the snapshots created from now on
+        self.start_time = '2016-02-01T10:00:00.000Z'
+
+    def add_volume(self, id, instance_id=None, **kwargs):
+        volume = MockVolume(self, id, instance_id, **kwargs)
+        self.volumes.append(volume)
+        return volume
+
+    def add_snapshot(self, id, volume_id, description=None, start_time='2016-01-01T10:00:00.000Z', **kwargs):
+        snapshot = MockSnapshot(id, volume_id, description, start_time, connection=self, **kwargs)
+        self.snapshots.append(snapshot)
+        return snapshot
+
+    def existing(self):
+        ''' The snapshots that have not been deleted '''
+        return [s for s in self.snapshots if s.status != 'deleted']
+
+    def sent(self, action):
+        ''' The arguments of every `action` request, in order '''
+        return [args for name, args in self.calls if name == action]
+
+    def get_all_volumes(self, filters=None):
+        self.calls.append(('DescribeVolumes', filters))
+        if filters and 'volume-id' in filters:
+            return [v for v in self.volumes if v.id in filters['volume-id']]
+        return self.volumes
+
+    def describe(self, filters):
+        ''' The snapshots `filters` match, where pending snapshots asked for
+        by id take a step towards completing '''
+        found = []
+        for s in self.snapshots:
+            if s.status == 'deleted':
+                continue
+            if 'snapshot-id' in filters and s.id in filters['snapshot-id'] and s.status == 'pending':
+                if s.polls == 'error':
+                    s.status = 'error'
+                else:
+                    s.polls -= 1
+                    if s.polls <= 0:
+                        s.status, s.progress = 'completed', '100%'
+                    else:
+                        s.progress = '50%'
+            if all(self.filter_matches(s, name, value) for name, value in filters.items()):
+                found.append(s)
+        return found
+
+    def filter_matches(self, snapshot, name, value):
+        values = value if isinstance(value, list) else [value]
+        if name == 'tag-key':
+            return any(v in snapshot.tags for v in values)
+        if name == 'snapshot-id':
+            return snapshot.id in values
+        if name.startswith('tag:'):
+            field = snapshot.tags.get(name[4:])
+        else:
+            field = getattr(snapshot, name.replace('-', '_'))
+        return any(matches(v, field) for v in values)
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        filters = filters or {}
+        self.calls.append(('DescribeSnapshots', filters))
+        return self.describe(filters)
+
+    def build_list_params(self, params, items, label):
+        for i, item in enumerate(items):
+            params['%s.%d' % (label, i + 1)] = item
+
+    def build_filter_params(self, params, filters):
+        for i, (name, value) in enumerate(sorted(filters.items())):
+            params['Filter.%d.Name' % (i + 1)] = name
+            for j, v in enumerate(value if isinstance(value, list) else [value]):
+                params['Filter.%d.Value.%d' % (i + 1, j + 1)] = v
+
+    def get_list(self, action, params, markers, verb='GET'):
+        ''' Serves DescribeSnapshots a page at a time, the way EC2 does '''
+        assert action == 'DescribeSnapshots'
+        filters = {}
+        for key in sorted(params):
+            if key.startswith('Filter.') and '.Value.' in key:
+                filters.setdefault(params[key.split('.Value.')[0] + '.Name'], []).append(params[key])
+        self.calls.append(('DescribeSnapshots', filters))
+        snapshots = self.describe(filters)
+        start = int(params.get('NextToken', 0))
+        end = start + params.get('MaxResults', len(snapshots))
+        page = ResultSet(markers)
+        page.extend(snapshots[start:end])
+        if end < len(snapshots):
+            page.next_token = str(end)
+        return page
+
+    def create_snapshot(self, volume_id, description=None):
+        self.calls.append(('CreateSnapshot', volume_id))
+        if volume_id in self.broken:
+            raise Exception('InternalError')
+        self.created.append(volume_id)
+        return self.add_snapshot('snap-%s' % volume_id[4:], volume_id, description, self.start_time, status='pending')
+
+    def create_tags(self, resource_ids, tags):
+        self.calls.append(('CreateTags', (list(resource_ids), tags)))
+        if self.broken.intersection(resource_ids):
+            raise Exception('UnauthorizedOperation')
+        for s in self.snapshots:
+            if s.id in resource_ids:
+                s.tags.update(tags)
+        return True
+
+    def delete_snapshot(self, snapshot_id):
+        self.calls.append(('DeleteSnapshot', snapshot_id))
+        if snapshot_id in self.broken:
+            raise Exception('InternalError')
+        found = [s for s in self.snapshots if s.id == snapshot_id and s.status != 'deleted']
+        if not found:
+            raise EC2ResponseError(400, 'Bad Request', NOT_FOUND_BODY)
+        for s in found:
+            s.status = 'deleted'
+        self.deleted.append(snapshot_id)
+        return True
+
+def create_monkey(conn, max_snapshots_per_volume=3, region='us-west-2', label=None, cross_account_number=None,
+                  **kwargs):
+    ''' A BackupMonkey that talks to `conn`, or to a dict of connections by
+    region, and is never held back by its rate limiter '''
+    if isinstance(conn, dict):
+        get_connection = lambda name=None: conn[name or region]
+    else:
+        get_connection = lambda name=None: conn
+    kwargs.setdefault('limiter', RateLimiter(1000))
+    with mock.patch('backup_monkey.core.BackupMonkey.get_connection', side_effect=get_connection):
+        monkey = BackupMonkey(region, max_snapshots_per_volume, [], None, label, cross_account_number, None, **kwargs)
+    monkey.get_connection = get_connection
+    return monkey
@@ -0,0 +1,192 @@
+from unittest import TestCase
+from argparse import Namespace
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import mock
+from backup_monkey import cli
+from backup_monkey.exceptions import BackupMonkeyException
+
+def create_args(**kwargs):
+    args = dict(region=None, regions=None, all_regions=False, max_snapshots_per_volume=3, tags=None,
+                reverse_tags=False, label=None, cross_account_number=None, cross_account_numbers=None,
+                cross_account_file=None, cross_account_role=None, concurrency=1, max_deletes_per_run=None,
+                max_requests_per_second=10.0, max_retries=8, max_parallel_runs=32, page_size=1000,
+                keep_daily=0, keep_weekly=0, keep_monthly=0, max_age=None, inventory_cache=None,
+                rebuild_cache=False, reconcile_days=7, exclude_tags=None, snapshot_only=False, remove_only=False, wait=False,
+                wait_timeout=None, tag_snapshots=False, match_snapshot_tags=False,
+                group_by_instance=False, plan=None, apply_plan=None,
+                metrics_json=None, metrics_prometheus=None, metrics_statsd=None, daemon=None,
+                journal=None, detached_interval=None, profile_startup=False,
+                copy_to=None, copy_keep=None, max_copies_in_flight=5,
+                shard_index=0, shard_count=1, report=None)
+    args.update(kwargs)
+    return Namespace(**args)
+
+class MockBackupMonkey(object):
+    threads = set()
+    accounts = []
+
+    def __init__(self, region, max_snapshots_per_volume, tags, reverse_tags, label, cross_account_number,
+                 cross_account_role, **kwargs):
+        self.region = region
+        MockBackupMonkey.accounts.append(cross_account_number)
+
+    def snapshot_volumes(self):
+        MockBackupMonkey.threads.add(threading.current_thread().name)
+        if self.region == 'eu-west-1':
+            raise BackupMonkeyException('Could not create snapshots of 1 volumes: vol-fb07ec3a')
+        return True
+
+    def remove_old_snapshots(self):
+        return True
+
+    def end_run(self):
+        pass
+
+class RegionsTest(TestCase):
+
+    def test_single_region(self):
+        assert cli._get_regions(create_args(region='us-east-1')) == ['us-east-1']
+
+    def test_regions(self):
+        assert cli._get_regions(create_args(regions='us-east-1, eu-west-1,')) == ['us-east-1', 'eu-west-1']
+        self.assertRaises(SystemExit, cli._get_regions, create_args(regions=' , '))
+
+    def test_apply_plan_and_wait(self):
+        with mock.patch('backup_monkey.cli.BackupMonkey') as monkey_class:
+            monkey = monkey_class.return_value
+            args = create_args(apply_plan='plan.json', wait=True, wait_timeout=10)
+            assert cli._run_target(args, None, 'us-east-1', {'us-east-1': {'region': 'us-east-1'}}) is None
+        monkey.apply_plan.assert_called_once_with({'region': 'us-east-1'})
+        monkey.wait_for_snapshots.assert_called_once_with(timeout=600)
+        assert not monkey.snapshot_volumes.called
+
+    def test_apply_plan_and_copy(self):
+        errors = []
+        args = cli._create_parser().parse_args(['--apply-plan', 'plan.json', '--copy-to', 'eu-west-1'])
+        cli._check_args(args, errors.append)
+        assert errors == []
+        with mock.patch('backup_monkey.cli.BackupMonkey') as monkey_class:
+            monkey = monkey_class.return_value
+            assert cli._run_target(args, None, 'us-east-1', {'us-east-1': {'region': 'us-east-1'}}) is None
+        assert monkey_class.call_args[1]['copy_regions'] == ['eu-west-1']
+        monkey.wait_for_snapshots.assert_called_once_with(timeout=None)
+        monkey.copy_snapshots.assert_called_once_with(timeout=None)
+
+    def test_empty_plan(self):
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write('{"plans": []}')
+            fh.flush()
+            self.assertRaises(SystemExit, cli._read_plans, fh.name)
+
+    def test_all_regions(self):
+        regions = cli._get_regions(create_args(all_regions=True))
+        assert 'us-east-1' in regions
+        assert 'us-gov-west-1' not in regions
+        assert regions == sorted(regions)
+
+    @mock.patch('backup_monkey.cli.get_instance_metadata', return_value={'placement': {'availability-zone': 'us-west-2b'}})
+    def test_instance_region(self, metadata):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'cache', 'region')
+        try:
+            with mock.patch('backup_monkey.cli.REGION_CACHE_PATH', path), mock.patch.dict('os.environ', clear=True):
+                assert cli._get_regions(create_args()) == ['us-west-2']
+                assert os.stat(path).st_mode & 0777 == 0600
+                # Later runs use the cached region
+                assert cli._get_regions(create_args()) == ['us-west-2']
+                assert metadata.call_count == 1
+                os.utime(path, (0, 0))
+                assert cli._get_regions(create_args()) == ['us-west-2']
+                assert metadata.call_count == 2
+        finally:
+            shutil.rmtree(directory)
+
+    def test_region_cache_is_not_trusted_blindly(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'region')
+        target = os.path.join(directory, 'target')
+        try:
+            with mock.patch('backup_monkey.cli.REGION_CACHE_PATH', path):
+                with open(target, 'w') as fh:
+                    fh.write('precious\n')
+                os.symlink(target, path)
+                # Neither written nor read through a symlink
+                cli._write_region_cache('us-west-2')
+                assert open(target).read() == 'precious\n'
+                assert cli._read_region_cache() is None
+                os.remove(path)
+                cli._write_region_cache('us-west-2')
+                assert cli._read_region_cache() == 'us-west-2'
+                with mock.patch('os.getuid', return_value=os.getuid() + 1):
+                    assert cli._read_region_cache() is None
+                with open(path, 'w') as fh:
+                    fh.write('not a region\n')
+                assert cli._read_region_cache() is None
+        finally:
+            shutil.rmtree(directory)
+
+    @mock.patch('backup_monkey.cli.get_instance_metadata')
+    def test_environment_region(self, metadata):
+        with mock.patch.dict('os.environ', {'AWS_DEFAULT_REGION': 'eu-west-1'}, clear=True):
+            assert cli._get_regions(create_args()) == ['eu-west-1']
+        with mock.patch.dict('os.environ', {'AWS_REGION': 'eu-central-1', 'AWS_DEFAULT_REGION': 'eu-west-1'}):
+            assert cli._get_regions(create_args()) == ['eu-central-1']
+            assert cli._get_regions(create_args(region='us-east-1')) == ['us-east-1']
+        assert not metadata.called
+
+    def test_lazy_boto_import(self):
+        code = 'import sys, backup_monkey.cli; print(sorted(m for m in sys.modules if m.startswith("boto")))'
+        assert subprocess.check_output([sys.executable, '-c', code]).strip() == '[]'
+
+    @mock.patch('backup_monkey.cli.BackupMonkey', MockBackupMonkey)
+    def test_run_targets(self):
+        MockBackupMonkey.threads = set()
+        targets = [(None, 'us-east-1'), (None, 'eu-west-1'), (None, 'ap-southeast-2')]
+        results = cli._run_targets(create_args(), targets)
+        assert results == [('us-east-1', None),
+                           ('eu-west-1', 'Could not create snapshots of 1 volumes: vol-fb07ec3a'),
+                           ('ap-southeast-2', None)]
+        assert threading.current_thread().name not in MockBackupMonkey.threads
+
+    @mock.patch('backup_monkey.cli.BackupMonkey', MockBackupMonkey)
+    def test_run_exit_code(self):
+        with mock.patch('sys.argv', ['backup-monkey', '--regions', 'us-east-1,eu-west-1']):
+            with self.assertRaises(SystemExit) as e:
+                cli.run()
+        assert e.exception.code == 1
+        with mock.patch('sys.argv', ['backup-monkey', '--regions', 'us-east-1,ap-southeast-2']):
+            with self.assertRaises(SystemExit) as e:
+                cli.run()
+        assert e.exception.code == 0
+
+class AccountsTest(TestCase):
+
+    def test_no_accounts(self):
+        assert cli._get_accounts(create_args()) == [None]
+        assert cli._get_accounts(create_args(cross_account_number='111111111111')) == ['111111111111']
+
+    def test_accounts(self):
+        args = create_args(cross_account_numbers='111111111111, 222222222222')
+        assert cli._get_accounts(args) == ['111111111111', '222222222222']
+
+    def test_accounts_file(self):
+        with tempfile.NamedTemporaryFile() as fh:
+            fh.write('# Production\n111111111111\n\n222222222222 # Staging\n')
+            fh.flush()
+            assert cli._get_accounts(create_args(cross_account_file=fh.name)) == ['111111111111', '222222222222']
+
+    @mock.patch('backup_monkey.cli.BackupMonkey', MockBackupMonkey)
+    def test_run_accounts_and_regions(self):
+        MockBackupMonkey.accounts = []
+        argv = ['backup-monkey', '--regions', 'us-east-1,ap-southeast-2', '--cross-account-role', 'Snapshot',
+                '--cross-account-numbers', '111111111111,222222222222,333333333333']
+        with mock.patch('sys.argv', argv):
+            with self.assertRaises(SystemExit) as e:
+                cli.run()
+        assert e.exception.code == 0
+        assert sorted(MockBackupMonkey.accounts) == ['111111111111'] * 2 + ['222222222222'] * 2 + ['333333333333'] * 2
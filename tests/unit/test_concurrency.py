@@ -0,0 +1,77 @@
+from unittest import TestCase
+import threading
+from backup_monkey.exceptions import BackupMonkeyException
+from tests.unit.mocks import MockEC2Connection, create_monkey
+
+class ThreadsEC2Connection(MockEC2Connection):
+    ''' Records the threads snapshots were created from '''
+    def __init__(self, volumes, broken=()):
+        MockEC2Connection.__init__(self)
+        for i in range(volumes):
+            self.add_volume('vol-%08x' % i, 'i-1a2b3c4d', device='/dev/sdf')
+        self.broken = set(broken)
+        self.threads = set()
+
+    def create_snapshot(self, volume_id, description=None):
+        self.threads.add(threading.current_thread().name)
+        return MockEC2Connection.create_snapshot(self, volume_id, description)
+
+    def descriptions(self, volume_id):
+        return [s.description for s in self.snapshots if s.volume_id == volume_id]
+
+class SnapshotConcurrencyTest(TestCase):
+
+    def test_serial(self):
+        conn = ThreadsEC2Connection(5)
+        assert create_monkey(conn, concurrency=1).snapshot_volumes().count('snapshot', 'ok') == 5
+        for v in conn.volumes:
+            assert conn.descriptions(v.id) == ['BACKUP_MONKEY %s i-1a2b3c4d /dev/sdf' % v.id]
+
+    def test_concurrent(self):
+        conn = ThreadsEC2Connection(50)
+        assert create_monkey(conn, concurrency=8).snapshot_volumes().count('snapshot', 'ok') == 50
+        for v in conn.volumes:
+            assert len(conn.descriptions(v.id)) == 1
+        assert threading.current_thread().name not in conn.threads
+
+    def test_failures_do_not_stop_run(self):
+        conn = ThreadsEC2Connection(30, broken=['vol-%08x' % i for i in range(0, 30, 10)])
+        monkey = create_monkey(conn, concurrency=4)
+        self.assertRaises(BackupMonkeyException, monkey.snapshot_volumes)
+        assert len([v for v in conn.volumes if conn.descriptions(v.id)]) == 27
+
+def create_snapshots(volumes, per_volume, fail_every=0):
+    conn = MockEC2Connection()
+    for v in range(volumes):
+        for s in range(per_volume):
+            n = len(conn.snapshots)
+            conn.add_snapshot('snap-%08x' % n, 'vol-%08x' % v, start_time='2016-01-%02dT10:00:00.000Z' % (s + 1))
+            if fail_every and n % fail_every == 0:
+                conn.broken.add('snap-%08x' % n)
+    return conn
+
+class DeleteConcurrencyTest(TestCase):
+
+    def create_monkey(self, conn, concurrency, max_deletes_per_run=None):
+        return create_monkey(conn, 2, concurrency=concurrency, max_deletes_per_run=max_deletes_per_run)
+
+    def test_concurrent(self):
+        conn = create_snapshots(20, 5)
+        assert self.create_monkey(conn, 8).remove_old_snapshots().count('delete', 'ok') == 60
+        kept = [s for s in conn.snapshots if s.status == 'completed']
+        assert len(kept) == 40
+        assert set(s.start_time for s in kept) == set(['2016-01-05T10:00:00.000Z', '2016-01-04T10:00:00.000Z'])
+
+    def test_max_deletes_per_run(self):
+        conn = create_snapshots(20, 5)
+        assert self.create_monkey(conn, 4, max_deletes_per_run=25).remove_old_snapshots().count('delete', 'ok') == 25
+        deleted = [s for s in conn.snapshots if s.status == 'deleted']
+        assert len(deleted) == 25
+        # The oldest expired snapshots go first
+        assert set(s.start_time for s in deleted) == set(['2016-01-01T10:00:00.000Z', '2016-01-02T10:00:00.000Z'])
+
+    def test_failures_do_not_stop_run(self):
+        conn = create_snapshots(10, 4, fail_every=4)
+        monkey = self.create_monkey(conn, 4)
+        self.assertRaises(BackupMonkeyException, monkey.remove_old_snapshots)
+        assert len([s for s in conn.snapshots if s.status == 'deleted']) == 10
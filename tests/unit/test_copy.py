@@ -0,0 +1,207 @@
+from unittest import TestCase
+import mock
+from boto.exception import EC2ResponseError
+from backup_monkey.copier import SnapshotCopier, copy_description, parse_copy_description
+from backup_monkey.exceptions import BackupMonkeyException
+from tests.unit.mocks import MockSnapshot, create_monkey
+
+LIMIT_BODY = '''<?xml version="1.0" encoding="UTF-8"?>
+<Response><Errors><Error><Code>ResourceLimitExceeded</Code><Message>Too many snapshot copies in progress.</Message></Error></Errors><RequestID>5e3c9ad4</RequestID></Response>'''
+
+class MockRegion(object):
+    ''' The snapshots of one region, where copies take `polls` polls to
+    complete, and no more than `limit` can be in progress '''
+    def __init__(self, polls=1, limit=None, broken=()):
+        self.snapshots = {}
+        self.polls = polls
+        self.limit = limit
+        self.broken = set(broken)
+        self.remaining = {}
+        self.started = []
+        self.deleted = []
+        self.most_in_flight = 0
+
+    def in_flight(self):
+        return len([s for s in self.snapshots.values() if s.status == 'pending'])
+
+    def copy_snapshot(self, source_region, source_snapshot_id, description=None):
+        if self.limit is not None and self.in_flight() >= self.limit:
+            raise EC2ResponseError(400, 'Bad Request', LIMIT_BODY)
+        copy = MockSnapshot('snap-copy-%d' % len(self.started), 'vol-ffffffff', description,
+                            '2016-01-02T%02d:00:00.000Z' % len(self.started), 'pending')
+        self.started.append(source_snapshot_id)
+        self.snapshots[copy.id] = copy
+        self.remaining[copy.id] = self.polls
+        self.most_in_flight = max(self.most_in_flight, self.in_flight())
+        return copy.id
+
+    def get_all_snapshots(self, owner='self', filters=None):
+        if 'snapshot-id' in filters:
+            for id in filters['snapshot-id']:
+                if id in self.remaining:
+                    self.remaining[id] -= 1
+                    if self.remaining[id] <= 0:
+                        source_id = parse_copy_description(self.snapshots[id].description)[0]
+                        self.snapshots[id].status = 'error' if source_id in self.broken else 'completed'
+                        del self.remaining[id]
+            return [self.snapshots[id] for id in filters['snapshot-id'] if id in self.snapshots]
+        assert filters == {'description': '[Copied * from us-east-1] BACKUP_MONKEY *'}
+        return [s for id, s in sorted(self.snapshots.items()) if s.description.startswith('[Copied ')]
+
+    def delete_snapshot(self, snapshot_id):
+        self.deleted.append(snapshot_id)
+        del self.snapshots[snapshot_id]
+        return True
+
+class CopyDescriptionTest(TestCase):
+
+    def test_roundtrip(self):
+        source = MockSnapshot('snap-0123abcd', 'vol-1', 'BACKUP_MONKEY daily vol-1 i-1 /dev/sdf')
+        description = copy_description(source, 'us-east-1')
+        assert description == '[Copied snap-0123abcd from us-east-1] BACKUP_MONKEY daily vol-1 i-1 /dev/sdf'
+        assert parse_copy_description(description) == ('snap-0123abcd', 'us-east-1', source.description)
+        assert parse_copy_description(source.description) is None
+
+class SnapshotCopierTest(TestCase):
+
+    def create_copier(self, region, max_in_flight=2, timeout=None):
+        return SnapshotCopier(lambda s: region.copy_snapshot('us-east-1', s.id, copy_description(s, 'us-east-1')),
+                              lambda ids: region.get_all_snapshots(filters={'snapshot-id': ids}),
+                              max_in_flight=max_in_flight, min_interval=0, max_interval=0, timeout=timeout)
+
+    def sources(self, n):
+        return [MockSnapshot('snap-%08x' % i, 'vol-%08x' % i, 'BACKUP_MONKEY vol-%08x' % i) for i in range(n)]
+
+    def test_max_in_flight(self):
+        region = MockRegion(polls=2)
+        copier = self.create_copier(region)
+        assert copier.run(self.sources(5))
+        assert region.started == ['snap-%08x' % i for i in range(5)]
+        assert region.most_in_flight == 2
+        assert len(copier.completed) == 5
+
+    def test_copies_already_in_flight(self):
+        region = MockRegion(polls=2)
+        earlier = region.copy_snapshot('us-east-1', 'snap-0000eeee', '[Copied snap-0000eeee from us-east-1] BACKUP_MONKEY vol-1')
+        copier = self.create_copier(region)
+        assert copier.run(self.sources(3), in_flight=[earlier])
+        assert region.most_in_flight == 2
+        assert len(copier.completed) == 4
+
+    def test_resource_limit(self):
+        # AWS allows fewer copies than the configured limit
+        region = MockRegion(polls=3, limit=2)
+        copier = self.create_copier(region, max_in_flight=4)
+        assert copier.run(self.sources(6))
+        assert len(copier.completed) == 6
+        assert region.most_in_flight == 2
+
+    def test_failures(self):
+        region = MockRegion(broken=['snap-00000001'])
+        copier = self.create_copier(region)
+        assert not copier.run(self.sources(3))
+        assert copier.failed == ['snap-00000001']
+        assert len(copier.completed) == 2
+
+    def test_timeout(self):
+        region = MockRegion(polls=1000)
+        now = [0]
+        copier = SnapshotCopier(lambda s: region.copy_snapshot('us-east-1', s.id, copy_description(s, 'us-east-1')),
+                                lambda ids: region.get_all_snapshots(filters={'snapshot-id': ids}),
+                                max_in_flight=1, min_interval=10, max_interval=10, timeout=60,
+                                clock=lambda: now[0], sleep=lambda seconds: now.__setitem__(0, now[0] + seconds))
+        assert not copier.run(self.sources(2))
+        assert sorted(copier.pending) == ['snap-00000000', 'snap-00000001']
+        assert region.started == ['snap-00000000']
+
+    def test_missing_copy(self):
+        region = MockRegion(polls=3)
+        def delete_first_copy(seconds):
+            # The first copy is deleted while in flight, with no timeout to end the wait
+            if region.remaining.pop('snap-copy-0', None):
+                del region.snapshots['snap-copy-0']
+        copier = SnapshotCopier(lambda s: region.copy_snapshot('us-east-1', s.id, copy_description(s, 'us-east-1')),
+                                lambda ids: region.get_all_snapshots(filters={'snapshot-id': ids}),
+                                max_in_flight=1, min_interval=0, max_interval=0, sleep=delete_first_copy)
+        assert not copier.run(self.sources(2))
+        assert copier.failed == ['snap-00000000']
+        assert copier.pending == []
+        assert len(copier.completed) == 1
+
+class CopySnapshotsTest(TestCase):
+
+    def setUp(self):
+        self.regions = {'us-east-1': mock.Mock(), 'us-west-2': MockRegion(), 'eu-west-1': MockRegion()}
+
+    def create_monkey(self, **kwargs):
+        monkey = create_monkey(self.regions, 2, 'us-east-1', copy_regions=['us-west-2', 'eu-west-1', 'us-east-1'],
+                               **kwargs)
+        monkey._completed = [MockSnapshot('snap-%08x' % i, 'vol-%08x' % (i % 2), 'BACKUP_MONKEY vol-%08x i-1' % (i % 2))
+                             for i in range(2)]
+        return monkey
+
+    def copy(self, monkey):
+        return monkey.copy_snapshots(min_interval=0, max_interval=0)
+
+    def test_copy(self):
+        monkey = self.create_monkey()
+        assert self.copy(monkey)
+        for name in ('us-west-2', 'eu-west-1'):
+            assert self.regions[name].started == ['snap-00000000', 'snap-00000001']
+        assert monkey.metrics.counters['snapshots_copied'] == 4
+
+    def test_already_copied(self):
+        self.copy(self.create_monkey())
+        self.copy(self.create_monkey())
+        assert self.regions['us-west-2'].started == ['snap-00000000', 'snap-00000001']
+
+    def test_keep(self):
+        region = self.regions['us-west-2']
+        for i in range(3):
+            monkey = self.create_monkey(copy_keep=2)
+            monkey._completed = [MockSnapshot('snap-%08x' % i, 'vol-1', 'BACKUP_MONKEY vol-1 i-1')]
+            self.copy(monkey)
+        assert region.deleted == ['snap-copy-0']
+        assert sorted(region.snapshots) == ['snap-copy-1', 'snap-copy-2']
+
+    def test_report(self):
+        report = mock.Mock()
+        self.regions['us-east-1'].get_all_volumes.return_value = []
+        monkey = self.create_monkey(copy_keep=1, report=report)
+        created = monkey.snapshot_volumes()
+        self.copy(monkey)
+        monkey._completed = [MockSnapshot('snap-00000002', 'vol-00000000', 'BACKUP_MONKEY vol-00000000 i-1')]
+        copied = self.copy(monkey)
+        # The copy of snap-00000000 is now the older of two in each region
+        writes = [(args[1], args[2].action, args[2].status, args[2].snapshot_id) for args, kwargs in report.write.call_args_list]
+        assert ('us-west-2', 'copy', 'ok', 'snap-copy-2') in writes
+        assert ('us-west-2', 'copy_delete', 'ok', 'snap-copy-0') in writes
+        assert ('eu-west-1', 'copy_delete', 'ok', 'snap-copy-0') in writes
+        assert 'us-east-1' not in [region for region, action, status, snapshot_id in writes]
+        assert copied.count('copy', 'ok') == 2
+        assert copied.count('copy_delete', 'ok') == 2
+        assert copied.count('delete') == 0
+        # The summary snapshot_volumes returned is left alone
+        assert created.count('copy') == 0 and created.count('copy_delete') == 0
+
+    def test_copies_filter_escapes_label(self):
+        conn = mock.Mock(**{'get_all_snapshots.return_value': []})
+        monkey = self.create_monkey()
+        monkey._prefix = 'BACKUP_MONKEY a*b?'
+        assert monkey.get_copies(conn) == []
+        assert conn.get_all_snapshots.call_args[1]['filters'] == {
+            'description': '[Copied * from us-east-1] BACKUP_MONKEY a\\*b\\? *'}
+
+    def test_other_labels_kept(self):
+        region = self.regions['us-west-2']
+        region.snapshots['snap-other'] = MockSnapshot('snap-other', 'vol-ffffffff',
+                                                      '[Copied snap-0 from eu-west-1] BACKUP_MONKEY vol-1 i-1')
+        monkey = self.create_monkey(copy_keep=1)
+        monkey._completed = []
+        assert self.copy(monkey)
+        assert region.deleted == []
+
+    def test_failed_copy(self):
+        self.regions['eu-west-1'].broken = set(['snap-00000001'])
+        self.assertRaises(BackupMonkeyException, self.copy, self.create_monkey())
+        assert len(self.regions['us-west-2'].started) == 2
@@ -0,0 +1,78 @@
+from unittest import TestCase
+import threading
+import time
+import mock
+from backup_monkey.core import BackupMonkey
+from backup_monkey.credentials import AssumedRoleCache, parse_expiration
+
+class MockCredentials(object):
+    def __init__(self, n, expiration):
+        self.access_key = 'AKIA%d' % n
+        self.secret_key = 'secret'
+        self.session_token = 'token'
+        self.expiration = expiration
+
+class MockAssumedRole(object):
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+class MockSTSConnection(object):
+    ''' Hands out credentials that are valid for an hour '''
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = []
+
+    def assume_role(self, role_arn, role_session_name):
+        self.calls.append(role_arn)
+        expiration = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.clock() + 3600))
+        return MockAssumedRole(MockCredentials(len(self.calls), expiration))
+
+class AssumedRoleCacheTest(TestCase):
+
+    def setUp(self):
+        self.now = 1451606400.0 # 2016-01-01T00:00:00Z
+        self.sts = MockSTSConnection(lambda: self.now)
+        self.cache = AssumedRoleCache(clock=lambda: self.now, sts_factory=lambda: self.sts)
+
+    def test_parse_expiration(self):
+        assert parse_expiration('2016-01-01T01:00:00Z') == 1451610000
+        assert parse_expiration('2016-01-01T01:00:00.000Z') == 1451610000
+
+    def test_reuse(self):
+        first = self.cache.get('arn:aws:iam::111111111111:role/Snapshot')
+        self.now += 3000
+        assert self.cache.get('arn:aws:iam::111111111111:role/Snapshot') is first
+        assert len(self.sts.calls) == 1
+
+    def test_refresh_before_expiry(self):
+        first = self.cache.get('arn:aws:iam::111111111111:role/Snapshot')
+        self.now += 3400
+        assert self.cache.get('arn:aws:iam::111111111111:role/Snapshot') is not first
+        assert len(self.sts.calls) == 2
+
+    def test_per_account(self):
+        self.cache.get('arn:aws:iam::111111111111:role/Snapshot')
+        self.cache.get('arn:aws:iam::222222222222:role/Snapshot')
+        assert len(self.sts.calls) == 2
+
+    def test_concurrent_regions(self):
+        threads = [threading.Thread(target=self.cache.get, args=('arn:aws:iam::111111111111:role/Snapshot',))
+                   for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(self.sts.calls) == 1
+
+class CrossAccountConnectionTest(TestCase):
+
+    @mock.patch('boto.ec2.connect_to_region')
+    def test_regions_share_credentials(self, connect_to_region):
+        now = time.time()
+        sts = MockSTSConnection(lambda: now)
+        with mock.patch('backup_monkey.core.assumed_roles', AssumedRoleCache(sts_factory=lambda: sts)):
+            for region in ('us-east-1', 'us-west-2', 'eu-west-1'):
+                BackupMonkey(region, 3, [], None, None, '111111111111', 'Snapshot')
+        assert sts.calls == ['arn:aws:iam::111111111111:role/Snapshot']
+        assert connect_to_region.call_count == 3
+        assert connect_to_region.call_args[1]['aws_access_key_id'] == 'AKIA1'
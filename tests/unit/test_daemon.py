@@ -0,0 +1,198 @@
+from unittest import TestCase
+import calendar
+import json
+import tempfile
+import threading
+import time
+import mock
+from backup_monkey import cli
+from backup_monkey.connections import ConnectionPool
+from backup_monkey.core import BackupMonkey
+from backup_monkey.daemon import CronSchedule, Daemon, Job
+
+def at(*args):
+    ''' A UTC timestamp, e.g. at(2016, 1, 4, 2, 30) '''
+    return calendar.timegm(args + (0,) * (6 - len(args)))
+
+class CronScheduleTest(TestCase):
+
+    def test_fields(self):
+        schedule = CronSchedule('30 2 * * *')
+        assert schedule.matches(at(2016, 1, 4, 2, 30))
+        assert schedule.matches(at(2016, 1, 4, 2, 30, 59))
+        assert not schedule.matches(at(2016, 1, 4, 2, 31))
+        assert not schedule.matches(at(2016, 1, 4, 3, 30))
+
+    def test_steps_ranges_and_lists(self):
+        schedule = CronSchedule('*/15 8-18/2 1,15 * *')
+        assert schedule.minutes == set([0, 15, 30, 45])
+        assert schedule.hours == set([8, 10, 12, 14, 16, 18])
+        assert schedule.days == set([1, 15])
+
+    def test_weekdays(self):
+        # 2016-01-03 is a Sunday, 2016-01-04 a Monday
+        weekdays = CronSchedule('0 0 * * 1-5')
+        assert not weekdays.matches(at(2016, 1, 3))
+        assert weekdays.matches(at(2016, 1, 4))
+        assert CronSchedule('0 0 * * 7').matches(at(2016, 1, 3))
+        # Either the day of month or the day of week, as in cron
+        either = CronSchedule('0 0 1 * 1')
+        assert either.matches(at(2016, 1, 4))
+        assert either.matches(at(2016, 2, 1))
+        assert not either.matches(at(2016, 1, 5))
+
+    def test_next_after(self):
+        assert CronSchedule('30 2 * * *').next_after(at(2016, 1, 4, 2, 30)) == at(2016, 1, 5, 2, 30)
+        assert CronSchedule('0 0 1 1 *').next_after(at(2016, 1, 4)) == at(2017, 1, 1)
+        assert CronSchedule('0 0 31 2 *').next_after(at(2016, 1, 4)) is None
+
+    def test_invalid(self):
+        for expression in ('', '* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '*/0 * * * *',
+                           '5-1 * * * *', 'a * * * *'):
+            self.assertRaises(ValueError, CronSchedule, expression)
+
+class DaemonTest(TestCase):
+
+    def test_due_jobs(self):
+        hourly = Job('hourly', CronSchedule('0 * * * *'), [(None, 'us-east-1')], None)
+        daily = Job('daily', CronSchedule('0 2 * * *'), [(None, 'us-east-1'), ('111111111111', 'eu-west-1')], None)
+        runs = []
+        daemon = Daemon([hourly, daily], lambda job, account, region: runs.append((job.name, account, region)))
+        try:
+            assert [job.name for job, _, _ in daemon.tick(at(2016, 1, 4, 1))] == ['hourly']
+        finally:
+            daemon.stop()
+        assert runs == [('hourly', None, 'us-east-1')]
+
+    def test_overlapping_runs_are_queued(self):
+        release = threading.Event()
+        done = threading.Event()
+        runs = []
+        def run_target(job, account, region):
+            runs.append((job.name, region))
+            if (job.name, region) == ('second', 'us-east-1'):
+                done.set()
+            else:
+                release.wait(5)
+        first = Job('first', CronSchedule('* * * * *'), [(None, 'us-east-1')], None)
+        second = Job('second', CronSchedule('* * * * *'), [(None, 'us-east-1'), (None, 'eu-west-1')], None)
+        daemon = Daemon([first, second], run_target)
+        try:
+            started = daemon.tick(at(2016, 1, 4))
+            assert [(job.name, region) for job, _, region in started] == [('first', 'us-east-1'), ('second', 'eu-west-1')]
+            # Both jobs are running or queued everywhere, so neither is queued again
+            assert daemon.tick(at(2016, 1, 4, 0, 1)) == []
+            # The second job runs in us-east-1 once the first is done there
+            release.set()
+            assert done.wait(5)
+        finally:
+            release.set()
+            daemon.stop()
+        assert sorted(runs) == [('first', 'us-east-1'), ('second', 'eu-west-1'), ('second', 'us-east-1')]
+        assert daemon.running() == 0
+
+    def test_queued_runs_are_dropped_on_stop(self):
+        release = threading.Event()
+        runs = []
+        def run_target(job, account, region):
+            runs.append(job.name)
+            release.wait(5)
+        first = Job('first', CronSchedule('* * * * *'), [(None, 'us-east-1')], None)
+        second = Job('second', CronSchedule('* * * * *'), [(None, 'us-east-1')], None)
+        daemon = Daemon([first, second], run_target)
+        daemon.tick(at(2016, 1, 4))
+        stopper = threading.Thread(target=daemon.stop)
+        stopper.start()
+        # Let the first run finish only once the queue has been dropped
+        for i in range(500):
+            if not daemon._queued:
+                break
+            time.sleep(0.01)
+        release.set()
+        stopper.join(5)
+        assert runs == ['first']
+        assert daemon.running() == 0
+
+    def test_failed_run_frees_target(self):
+        def run_target(job, account, region):
+            raise Exception('boom')
+        job = Job('job', CronSchedule('* * * * *'), [(None, 'us-east-1')], None)
+        daemon = Daemon([job], run_target, max_parallel_runs=1)
+        daemon.tick(at(2016, 1, 4))
+        daemon.stop()
+        assert daemon.running() == 0
+
+class ConnectionPoolTest(TestCase):
+
+    def test_reuse(self):
+        pool = ConnectionPool()
+        connect = mock.Mock(side_effect=['conn1', 'conn2', 'conn3'])
+        assert pool.get((None, 'us-east-1'), None, connect) == 'conn1'
+        assert pool.get((None, 'us-east-1'), None, connect) == 'conn1'
+        assert pool.get((None, 'eu-west-1'), None, connect) == 'conn2'
+        assert connect.call_count == 2
+
+    def test_refreshed_credentials(self):
+        pool = ConnectionPool()
+        connect = mock.Mock(side_effect=['conn1', 'conn2'])
+        assert pool.get(('111111111111', 'us-east-1'), 'AKIA1', connect) == 'conn1'
+        assert pool.get(('111111111111', 'us-east-1'), 'AKIA2', connect) == 'conn2'
+        assert pool.get(('111111111111', 'us-east-1'), 'AKIA2', connect) == 'conn2'
+
+    def test_none_not_kept(self):
+        pool = ConnectionPool()
+        connect = mock.Mock(side_effect=[None, 'conn'])
+        assert pool.get((None, 'xx-east-1'), None, connect) is None
+        assert pool.get((None, 'xx-east-1'), None, connect) == 'conn'
+
+    @mock.patch('boto.ec2.connect_to_region')
+    def test_backup_monkey_reuses_connection(self, connect_to_region):
+        pool = ConnectionPool()
+        BackupMonkey('us-east-1', 3, [], None, None, None, None, connections=pool)
+        BackupMonkey('us-east-1', 3, [], None, None, None, None, connections=pool)
+        assert connect_to_region.call_count == 1
+
+class DaemonConfigTest(TestCase):
+
+    def read_jobs(self, config, *argv):
+        parser = cli._create_parser()
+        with tempfile.NamedTemporaryFile(suffix='.json') as fh:
+            json.dump(config, fh)
+            fh.flush()
+            args = parser.parse_args(['--daemon', fh.name] + list(argv))
+            return cli._read_jobs(parser, args)
+
+    def test_jobs(self):
+        jobs = self.read_jobs({'jobs': [
+            {'name': 'daily', 'schedule': '0 2 * * *', 'label': 'daily', 'keep-daily': 7,
+             'regions': 'us-east-1,eu-west-1', 'tags': 'Env:prod'},
+            {'schedule': '0 3 * * 0', 'label': 'weekly', 'max-snapshots-per-volume': '4', 'snapshot-only': True},
+        ]}, '--region', 'us-west-2', '--concurrency', '4')
+        assert [job.name for job in jobs] == ['daily', 'job 2']
+        daily, weekly = jobs
+        assert daily.targets == [(None, 'us-east-1'), (None, 'eu-west-1')]
+        assert daily.options.region is None
+        assert daily.options.keep_daily == 7
+        assert daily.options.tags == ['Env:prod']
+        assert daily.options.concurrency == 4
+        assert weekly.targets == [(None, 'us-west-2')]
+        assert weekly.options.max_snapshots_per_volume == 4
+        assert weekly.options.snapshot_only is True
+        assert weekly.options.label == 'weekly'
+
+    def test_invalid_jobs(self):
+        for job in ({'schedule': 'daily', 'region': 'us-east-1'},
+                    {'schedule': '0 2 * * *', 'region': 'us-east-1', 'frequency': 'daily'},
+                    {'schedule': '0 2 * * *', 'region': 'us-east-1', 'plan': 'plan.json'},
+                    {'schedule': '0 2 * * *', 'region': 'us-east-1', 'concurrency': 'many'},
+                    {'schedule': '0 2 * * *', 'region': 'us-east-1', 'wait': 'yes'},
+                    {'schedule': '0 2 * * *', 'region': 'us-east-1', 'concurrency': 0}):
+            self.assertRaises(SystemExit, self.read_jobs, {'jobs': [job]})
+        self.assertRaises(SystemExit, self.read_jobs, {'jobs': []})
+
+    @mock.patch('backup_monkey.cli.BackupMonkey')
+    def test_run_target_uses_pool(self, backup_monkey):
+        jobs = self.read_jobs({'jobs': [{'schedule': '* * * * *', 'region': 'us-east-1'}]})
+        pool = ConnectionPool()
+        cli._run_target(jobs[0].options, None, 'us-east-1', {}, connections=pool)
+        assert backup_monkey.call_args[1]['connections'] is pool
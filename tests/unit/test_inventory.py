@@ -0,0 +1,134 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
+from backup_monkey.inventory import InventoryCache, days_since
+from tests.unit.mocks import MockEC2Connection, MockSnapshot, create_monkey
+
+def today(offset=0):
+    return time.strftime('%Y-%m-%d', time.gmtime(time.time() + offset * 86400))
+
+class InventoryEC2Connection(MockEC2Connection):
+    def __init__(self):
+        MockEC2Connection.__init__(self)
+        self.added = 0
+        for i in range(3):
+            self.add_volume('vol-%08x' % i)
+
+    def add(self, volume_id, days_ago, status='completed', description=None):
+        id = 'snap-%08x' % self.added
+        self.added += 1
+        return self.add_snapshot(id, volume_id, description, today(-days_ago) + 'T10:00:00.000Z', status=status)
+
+class DaysSinceTest(TestCase):
+
+    def test_days_since(self):
+        now = time.mktime((2016, 3, 2, 12, 0, 0, 0, 0, -1))
+        assert days_since('2016-02-27', now) == ['2016-02-27', '2016-02-28', '2016-02-29', '2016-03-01', '2016-03-02']
+        assert days_since('2016-03-02', now) == ['2016-03-02']
+        assert days_since('2016-03-03', now) == []
+
+class InventoryCacheTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'inventory.db')
+        self.conn = InventoryEC2Connection()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_monkey(self, account=None, rebuild_cache=False, max_snapshots_per_volume=2):
+        return create_monkey(self.conn, max_snapshots_per_volume, cross_account_number=account,
+                             cache_path=self.path, rebuild_cache=rebuild_cache)
+
+    def test_scopes(self):
+        a = InventoryCache(self.path, None, 'us-west-2', 'BACKUP_MONKEY')
+        b = InventoryCache(self.path, '111111111111', 'us-west-2', 'BACKUP_MONKEY')
+        a.record([MockSnapshot('snap-1a2b3c4d', 'vol-fb07ec3a', start_time='2016-01-01T10:00:00.000Z')])
+        assert [s.id for page in a.completed_pages(None) for s in page] == ['snap-1a2b3c4d']
+        assert list(b.completed_pages(None)) == []
+
+    def test_completed_pages(self):
+        cache = InventoryCache(self.path, None, 'us-west-2', 'BACKUP_MONKEY')
+        cache.record([MockSnapshot('snap-%08x' % i, 'vol-fb07ec3a', start_time='2016-01-01T10:00:00.000Z',
+                                   status='pending' if i % 4 == 0 else 'completed') for i in range(25)])
+        pages = list(cache.completed_pages(None, page_size=5))
+        assert [len(p) for p in pages] == [5, 5, 5, 3]
+        assert cache.pending_ids() == ['snap-%08x' % i for i in range(0, 25, 4)]
+
+    def test_full_then_incremental(self):
+        for days_ago in (10, 9, 8):
+            self.conn.add('vol-fb07ec3a', days_ago)
+        self.conn.add('vol-fb07ec3a', 1, description='manual')
+        monkey = self.create_monkey()
+        monkey.remove_old_snapshots()
+        assert 'start-time' not in self.conn.sent('DescribeSnapshots')[0]
+        assert len(self.conn.deleted) == 1
+
+        # A later run only asks for today's snapshots
+        self.conn.calls = []
+        self.conn.add('vol-fb07ec3a', 0)
+        monkey = self.create_monkey()
+        monkey.remove_old_snapshots()
+        assert self.conn.sent('DescribeSnapshots')[0]['start-time'] == [today() + '*']
+        assert len(self.conn.deleted) == 2
+        assert sorted(s.start_time[:10] for s in self.conn.existing() if s.description != 'manual') == \
+            [today(-8), today()]
+
+    def test_created_snapshots_are_tracked_until_completed(self):
+        monkey = self.create_monkey()
+        monkey.snapshot_volumes()
+        created = sorted(s.id for s in self.conn.snapshots)
+        assert monkey._cache.pending_ids() == created
+        # Pending snapshots are checked on by id, even when started before the last refresh
+        for s in self.conn.snapshots:
+            s.status = 'completed'
+            s.start_time = today(-3) + 'T10:00:00.000Z'
+        monkey._cache.refreshed(today(), full=True)
+        monkey.refresh_cache()
+        assert self.conn.sent('DescribeSnapshots')[-1] == {'snapshot-id': created}
+        assert monkey._cache.pending_ids() == []
+        assert sorted(s.id for page in monkey._cache.completed_pages(None) for s in page) == created
+
+    def test_snapshots_deleted_elsewhere(self):
+        snapshots = [self.conn.add('vol-fb07ec3a', days_ago) for days_ago in (5, 4, 3)]
+        self.create_monkey(max_snapshots_per_volume=3).remove_old_snapshots()
+        self.conn.snapshots.remove(snapshots[0])
+        self.conn.add('vol-fb07ec3a', 0)
+        # The cache still has the snapshot, the NotFound error just removes it
+        self.create_monkey(max_snapshots_per_volume=3).remove_old_snapshots()
+        assert self.conn.deleted == []
+        cache = InventoryCache(self.path, None, 'us-west-2', 'BACKUP_MONKEY')
+        assert snapshots[0].id not in [s.id for page in cache.completed_pages(None) for s in page]
+
+    def test_snapshots_deleted_elsewhere_are_reconciled(self):
+        snapshots = [self.conn.add('vol-fb07ec3a', days_ago) for days_ago in (10, 9, 8)]
+        self.create_monkey(max_snapshots_per_volume=3).remove_old_snapshots()
+        # The newest of them is deleted by hand, and the cache was last
+        # listed in full a week ago
+        self.conn.snapshots.remove(snapshots[2])
+        InventoryCache(self.path, None, 'us-west-2', 'BACKUP_MONKEY').refreshed(today(-7), full=True)
+        self.conn.add('vol-fb07ec3a', 0)
+        self.conn.calls = []
+        self.create_monkey(max_snapshots_per_volume=3).remove_old_snapshots()
+        assert 'start-time' not in self.conn.sent('DescribeSnapshots')[0]
+        # Without the full listing, the deleted snapshot would have kept its
+        # place and pushed out the oldest real one
+        assert self.conn.deleted == []
+        assert len(self.conn.existing()) == 3
+
+    def test_rebuild(self):
+        self.conn.add('vol-fb07ec3a', 5)
+        self.create_monkey().remove_old_snapshots()
+        self.conn.calls = []
+        self.create_monkey(rebuild_cache=True).remove_old_snapshots()
+        assert 'start-time' not in self.conn.sent('DescribeSnapshots')[0]
+
+    def test_compact(self):
+        cache = InventoryCache(self.path, None, 'us-west-2', 'BACKUP_MONKEY')
+        cache.record([MockSnapshot('snap-1a2b3c4d', 'vol-fb07ec3a', start_time='2016-01-01T10:00:00.000Z', status='error'),
+                      MockSnapshot('snap-2a2b3c4d', 'vol-fb07ec3a', start_time='2016-01-01T10:00:00.000Z', status='pending')])
+        assert cache.compact() == 1
+        assert cache.pending_ids() == ['snap-2a2b3c4d']
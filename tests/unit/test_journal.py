@@ -0,0 +1,178 @@
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+from backup_monkey.core import TAG_RUN_ID
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.journal import Journal, RESUME_HOURS
+from tests.unit.mocks import MockEC2Connection, create_monkey
+
+class KillableEC2Connection(MockEC2Connection):
+    def __init__(self):
+        MockEC2Connection.__init__(self)
+        for i in range(4):
+            self.add_volume('vol-%08x' % i)
+        # Calls that kill the run, as a SIGINT would
+        self.kill = set()
+
+    def add(self, volume_id, hour):
+        self.add_snapshot('snap-%s-%02d' % (volume_id[4:], hour), volume_id, start_time='2016-01-01T%02d:00:00.000Z' % hour)
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        if filters and 'snapshot-id' in filters and 'describe' in self.kill:
+            raise KeyboardInterrupt()
+        return MockEC2Connection.get_all_snapshots(self, snapshot_ids, owner, filters)
+
+    def delete_snapshot(self, snapshot_id):
+        if snapshot_id in self.kill:
+            raise KeyboardInterrupt()
+        return MockEC2Connection.delete_snapshot(self, snapshot_id)
+
+class JournalTest(TestCase):
+
+    def setUp(self):
+        self.dir = os.path.join(tempfile.mkdtemp(), 'journal')
+        self.now = [1451606400.0]
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.dir))
+
+    def open(self, account=None, prefix='BACKUP_MONKEY daily'):
+        return Journal(self.dir, account, 'us-east-1', prefix, clock=lambda: self.now[0])
+
+    def test_resume(self):
+        journal = self.open()
+        assert os.path.basename(journal.path) == 'self_us-east-1_BACKUP_MONKEY_daily.jsonl'
+        assert journal.begin('snapshot', 'run1') == ('run1', {})
+        journal.record('snapshot', 'vol-1', 'snap-1')
+        journal.record('snapshot', 'vol-2', 'snap-2')
+        assert self.open().begin('snapshot', 'run2') == ('run1', {'vol-1': 'snap-1', 'vol-2': 'snap-2'})
+
+    def test_finish(self):
+        journal = self.open()
+        journal.begin('snapshot', 'run1')
+        journal.record('snapshot', 'vol-1', 'snap-1')
+        journal.begin('remove', 'run1')
+        journal.finish('snapshot')
+        assert self.open().unfinished() == {'remove': 'run1'}
+        assert not journal.end()
+        journal.finish('remove')
+        assert self.open().unfinished() == {}
+        assert journal.end()
+        assert os.path.getsize(journal.path) == 0
+        assert self.open().begin('snapshot', 'run2') == ('run2', {})
+
+    def test_finished_step_is_kept_until_the_run_ends(self):
+        journal = self.open()
+        journal.begin('snapshot', 'run1')
+        journal.record('snapshot', 'vol-1', 'snap-1')
+        journal.finish('snapshot')
+        # The run died after the snapshot step, without ending
+        journal = self.open()
+        assert journal.begin('snapshot', 'run2') == ('run1', {'vol-1': 'snap-1'})
+        journal.record('snapshot', 'vol-2', 'snap-2')
+        assert self.open().unfinished() == {'snapshot': 'run1'}
+        self.now[0] += RESUME_HOURS * 3600
+        assert self.open().begin('snapshot', 'run3') == ('run3', {})
+
+    def test_scopes(self):
+        self.open().begin('snapshot', 'run1')
+        assert self.open(account='111111111111').unfinished() == {}
+        assert self.open(prefix='BACKUP_MONKEY weekly').unfinished() == {}
+
+    def test_stale_run(self):
+        self.open().begin('snapshot', 'run1')
+        self.now[0] += RESUME_HOURS * 3600
+        assert self.open().begin('snapshot', 'run2') == ('run2', {})
+
+    def test_truncated_line(self):
+        journal = self.open()
+        journal.begin('remove', 'run1')
+        journal.record('remove', 'snap-1')
+        with open(journal.path, 'a') as fh:
+            fh.write('{"event": "do')
+        assert self.open().begin('remove', 'run2') == ('run1', {'snap-1': None})
+
+class ResumeTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.conn = KillableEC2Connection()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def create_monkey(self, **kwargs):
+        return create_monkey(self.conn, 2, 'us-east-1', journal_path=self.dir, **kwargs)
+
+    def test_snapshot_resume(self):
+        self.conn.broken = set(['vol-00000002'])
+        first = self.create_monkey(tag_snapshots=True)
+        self.assertRaises(BackupMonkeyException, first.snapshot_volumes)
+        assert self.conn.created == ['vol-00000000', 'vol-00000001', 'vol-00000003']
+
+        self.conn.broken = set()
+        self.conn.created = []
+        second = self.create_monkey(tag_snapshots=True)
+        assert second.snapshot_volumes()
+        assert self.conn.created == ['vol-00000002']
+        assert second.run_id == first.run_id
+        assert sorted(s.id for s in second._created) == ['snap-%08x' % i for i in range(4)]
+        assert all(s.tags[TAG_RUN_ID] == first.run_id for s in self.conn.snapshots)
+        assert second.metrics.counters['snapshots_resumed'] == 3
+
+        # The run ended, so the next run snapshots everything again
+        second.end_run()
+        self.conn.created = []
+        third = self.create_monkey()
+        assert third.snapshot_volumes()
+        assert len(self.conn.created) == 4
+        assert third.run_id != first.run_id
+
+    def test_remove_resume(self):
+        for volume in self.conn.volumes[:2]:
+            for hour in range(4):
+                self.conn.add(volume.id, hour)
+        self.conn.broken = set(['snap-00000001-00'])
+        self.assertRaises(BackupMonkeyException, self.create_monkey().remove_old_snapshots)
+        assert self.conn.deleted == ['snap-00000000-00', 'snap-00000000-01', 'snap-00000001-01']
+
+        # A snapshot that is still listed after being deleted is not deleted twice
+        self.conn.add('vol-00000000', 0)
+        self.conn.broken = set()
+        self.conn.deleted = []
+        assert self.create_monkey().remove_old_snapshots()
+        assert self.conn.deleted == ['snap-00000001-00']
+
+    def test_killed_in_remove_step(self):
+        for volume in self.conn.volumes[:2]:
+            for hour in range(4):
+                self.conn.add(volume.id, hour)
+        self.conn.kill = set(['snap-00000000-01'])
+        first = self.create_monkey()
+        assert first.snapshot_volumes()
+        self.assertRaises(KeyboardInterrupt, first.remove_old_snapshots)
+        assert self.conn.deleted == ['snap-00000000-00']
+
+        self.conn.kill = set()
+        second = self.create_monkey()
+        assert second.snapshot_volumes()
+        assert second.run_id == first.run_id
+        assert len(self.conn.created) == 4
+        assert sorted(s.id for s in second._created) == ['snap-%08x' % i for i in range(4)]
+        assert second.remove_old_snapshots()
+        assert self.conn.deleted == ['snap-00000000-00', 'snap-00000000-01', 'snap-00000001-00', 'snap-00000001-01']
+        second.end_run()
+        assert os.path.getsize(second._journal.path) == 0
+
+    def test_killed_while_waiting(self):
+        self.conn.kill = set(['describe'])
+        first = self.create_monkey()
+        assert first.snapshot_volumes()
+        self.assertRaises(KeyboardInterrupt, first.wait_for_snapshots, min_interval=0)
+
+        self.conn.kill = set()
+        second = self.create_monkey()
+        assert second.snapshot_volumes()
+        assert len(self.conn.created) == 4
+        assert second.metrics.counters['snapshots_resumed'] == 4
@@ -0,0 +1,110 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import mock
+from backup_monkey import cli
+from backup_monkey.metrics import Metrics, to_prometheus, to_statsd, write_prometheus
+from backup_monkey.throttle import RateLimiter
+from tests.unit.mocks import FakeClock, MockEC2Connection, create_monkey, throttle_error
+
+class ThrottledOnceEC2Connection(MockEC2Connection):
+    def __init__(self):
+        MockEC2Connection.__init__(self)
+        self.attempts = 0
+        for i in range(3):
+            self.add_volume('vol-%d' % i, tags={'env': 'dev' if i == 2 else 'prod'})
+        for day in range(1, 6):
+            self.add_snapshot('snap-%d' % day, 'vol-0', start_time='2016-01-%02dT10:00:00.000Z' % day)
+
+    def create_snapshot(self, volume_id, description=None):
+        # Throttled the first time
+        self.attempts += 1
+        if self.attempts == 1:
+            raise throttle_error()
+        return MockEC2Connection.create_snapshot(self, volume_id, description)
+
+class MetricsTest(TestCase):
+
+    def test_phases_and_calls(self):
+        clock = FakeClock()
+        metrics = Metrics('111111111111', 'us-east-1', clock=clock)
+        for i in range(2):
+            with metrics.phase('create'):
+                clock.now += 1.5
+        metrics.api_call('CreateSnapshot', 0.02)
+        metrics.api_call('CreateSnapshot', 0.3, retries=2)
+        metrics.api_call('CreateSnapshot', 100, error=True)
+        metrics.count('snapshots_created', 2)
+        data = metrics.to_dict()
+        assert data['phases'] == {'create': 3.0}
+        assert data['counters'] == {'snapshots_created': 2}
+        op = data['api_calls']['CreateSnapshot']
+        assert (op['calls'], op['retries'], op['errors']) == (3, 2, 1)
+        assert op['latency_buckets']['0.025'] == 1
+        assert op['latency_buckets']['0.5'] == 1
+        assert op['latency_buckets']['+Inf'] == 1
+        json.dumps(data)
+
+    def test_prometheus(self):
+        metrics = Metrics(None, 'us-east-1')
+        metrics.api_call('DescribeSnapshots', 0.2)
+        metrics.api_call('DescribeSnapshots', 2.0)
+        metrics.count('snapshots_scanned', 2000)
+        text = to_prometheus([metrics])
+        labels = 'account="self",region="us-east-1"'
+        assert 'backup_monkey_objects{%s,kind="snapshots_scanned"} 2000\n' % labels in text
+        assert 'backup_monkey_api_calls{%s,operation="DescribeSnapshots"} 2\n' % labels in text
+        assert 'backup_monkey_api_latency_seconds_bucket{%s,le="0.25",operation="DescribeSnapshots"} 1\n' % labels in text
+        assert 'backup_monkey_api_latency_seconds_bucket{%s,le="+Inf",operation="DescribeSnapshots"} 2\n' % labels in text
+        assert '# TYPE backup_monkey_api_latency_seconds histogram\n' in text
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'backup_monkey.prom')
+            write_prometheus(path, [metrics])
+            assert open(path).read() == text
+            assert os.listdir(directory) == ['backup_monkey.prom']
+        finally:
+            shutil.rmtree(directory)
+
+    def test_statsd(self):
+        metrics = Metrics(None, 'us-east-1')
+        metrics.api_call('DeleteSnapshot', 0.5)
+        metrics.api_call('DeleteSnapshot', 1.5, retries=1)
+        assert to_statsd([metrics]) == ['backup_monkey.self.us-east-1.api.DeleteSnapshot.calls:2|g',
+                                         'backup_monkey.self.us-east-1.api.DeleteSnapshot.retries:1|g',
+                                         'backup_monkey.self.us-east-1.api.DeleteSnapshot.errors:0|g',
+                                         'backup_monkey.self.us-east-1.api.DeleteSnapshot.latency:1000|ms']
+
+class BackupMonkeyMetricsTest(TestCase):
+
+    def test_run(self):
+        monkey = create_monkey(ThrottledOnceEC2Connection(), exclude_tags=['env:dev'],
+                               limiter=RateLimiter(1000, sleep=lambda s: None))
+        monkey.snapshot_volumes()
+        monkey.remove_old_snapshots()
+        data = monkey.metrics.to_dict()
+        assert data['region'] == 'us-west-2'
+        assert sorted(data['phases']) == ['connect', 'create', 'delete', 'filter_volumes', 'list_volumes', 'scan_snapshots']
+        assert data['counters'] == {'volumes_scanned': 3, 'volumes_matched': 2, 'snapshots_created': 2,
+                                    'snapshots_failed': 0, 'snapshots_scanned': 5, 'snapshots_expired': 2,
+                                    'snapshots_deleted': 2, 'snapshots_not_deleted': 0}
+        calls = dict((name, (op['calls'], op['retries'])) for name, op in data['api_calls'].items())
+        assert calls == {'DescribeVolumes': (1, 0), 'CreateSnapshot': (2, 1), 'DescribeSnapshots': (1, 0),
+                         'DeleteSnapshot': (2, 0)}
+
+    def test_cli_json(self):
+        conn = ThrottledOnceEC2Connection()
+        conn.attempts = 1
+        with tempfile.NamedTemporaryFile(suffix='.json') as fh:
+            argv = ['backup-monkey', '--region', 'us-west-2', '--snapshot-only', '--metrics-json', fh.name]
+            with mock.patch('backup_monkey.core.BackupMonkey.get_connection', return_value=conn):
+                with mock.patch('sys.argv', argv):
+                    with self.assertRaises(SystemExit) as e:
+                        cli.run()
+            assert e.exception.code == 0
+            targets = json.load(open(fh.name))['targets']
+        assert [(t['account'], t['region'], t['counters']['snapshots_created']) for t in targets] == \
+            [(None, 'us-west-2', 3)]
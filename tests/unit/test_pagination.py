@@ -0,0 +1,73 @@
+from unittest import TestCase
+import mock
+from backup_monkey.core import BackupMonkey
+from tests.unit.mocks import MockEC2Connection, create_monkey
+
+class PagingEC2Connection(MockEC2Connection):
+    ''' Records the parameters of every DescribeSnapshots request '''
+    def __init__(self):
+        MockEC2Connection.__init__(self)
+        self.requests = []
+
+    def get_list(self, action, params, markers, verb='GET'):
+        self.requests.append(dict(params))
+        return MockEC2Connection.get_list(self, action, params, markers, verb)
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        self.requests.append({})
+        return MockEC2Connection.get_all_snapshots(self, snapshot_ids, owner, filters)
+
+def create_snapshots():
+    conn = PagingEC2Connection()
+    for i in range(95):
+        volume_id = 'vol-%08x' % (i % 10)
+        description = 'BACKUP_MONKEY %s' % volume_id if i % 3 else 'manual %s' % volume_id
+        conn.add_snapshot('snap-%08x' % i, volume_id, description, '2016-01-01T%02d:00:00.000Z' % (i // 10))
+    conn.snapshots[-1].status = 'pending'
+    return conn
+
+class PaginationTest(TestCase):
+
+    def create_monkey(self, conn, page_size):
+        return create_monkey(conn, 2, page_size=page_size)
+
+    def test_pages(self):
+        conn = create_snapshots()
+        pages = list(self.create_monkey(conn, 20).get_snapshot_pages())
+        assert [len(p) for p in pages] == [20, 20, 20, 20, 15]
+        assert [r.get('NextToken') for r in conn.requests] == [None, '20', '40', '60', '80']
+        assert all(r['Owner.1'] == 'self' and r['MaxResults'] == 20 for r in conn.requests)
+
+    def test_unpaged(self):
+        conn = create_snapshots()
+        pages = list(self.create_monkey(conn, None).get_snapshot_pages())
+        assert len(pages) == 1 and len(pages[0]) == 95
+
+    def test_same_result_as_unpaged(self):
+        paged = create_snapshots()
+        unpaged = create_snapshots()
+        paged_monkey = self.create_monkey(paged, 20)
+        unpaged_monkey = self.create_monkey(unpaged, None)
+        paged_monkey.remove_old_snapshots()
+        unpaged_monkey.remove_old_snapshots()
+        deleted = lambda conn: sorted(s.id for s in conn.snapshots if s.status == 'deleted')
+        # Only the 62 completed Backup Monkey snapshots are listed
+        assert len(paged.requests) == 4
+        # Both ways of listing are the same EC2 action in the metrics
+        assert sorted(paged_monkey.metrics.to_dict()['api_calls']) == ['DeleteSnapshot', 'DescribeSnapshots']
+        assert sorted(unpaged_monkey.metrics.to_dict()['api_calls']) == ['DeleteSnapshot', 'DescribeSnapshots']
+        assert deleted(paged) == deleted(unpaged)
+        assert len(deleted(paged)) == 62 - 20
+
+    def test_filters(self):
+        conn = create_snapshots()
+        monkey = self.create_monkey(conn, 20)
+        assert monkey.get_snapshot_filters() == {'description': 'BACKUP_MONKEY*', 'status': 'completed'}
+        monkey.remove_old_snapshots()
+        assert conn.requests[0]['Filter.1.Name'] == 'description'
+        assert conn.requests[0]['Filter.2.Value.1'] == 'completed'
+
+    def test_filters_escape_label(self):
+        with mock.patch('backup_monkey.core.BackupMonkey.get_connection'):
+            monkey = BackupMonkey('us-west-2', 2, [], None, 'week*ly?', None, None)
+        assert monkey.get_snapshot_filters()['description'] == 'BACKUP_MONKEY week\\*ly\\?*'
@@ -0,0 +1,106 @@
+from unittest import TestCase
+import json
+import tempfile
+import mock
+from backup_monkey import cli
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.retention import RetentionPolicy
+from tests.unit import mocks
+
+def create_connection():
+    conn = mocks.MockEC2Connection()
+    conn.add_volume('vol-2', 'i-1', device='/dev/sdf')
+    conn.add_volume('vol-1')
+    for volume_id in ('vol-1', 'vol-2'):
+        for day in range(1, 5):
+            conn.add_snapshot('snap-%s-%d' % (volume_id, day), volume_id, start_time='2016-01-%02dT10:00:00.000Z' % day)
+    conn.add_snapshot('snap-manual', 'vol-1', 'manual', '2016-01-01T10:00:00.000Z')
+    return conn
+
+def create_monkey(conn, **kwargs):
+    return mocks.create_monkey(conn, 2, **kwargs)
+
+class PlanTest(TestCase):
+
+    def test_plan_does_not_change_anything(self):
+        conn = create_connection()
+        plan = create_monkey(conn).plan()
+        assert [call for call, args in conn.calls] == ['DescribeVolumes', 'DescribeSnapshots']
+        assert len(conn.existing()) == 9
+        assert plan['snapshot'] == [{'volume_id': 'vol-1', 'description': 'BACKUP_MONKEY vol-1'},
+                                    {'volume_id': 'vol-2', 'description': 'BACKUP_MONKEY vol-2 i-1 /dev/sdf'}]
+        assert [s['id'] for s in plan['delete']['vol-1']] == ['snap-vol-1-1', 'snap-vol-1-2']
+        assert [s['id'] for s in plan['delete']['vol-2']] == ['snap-vol-2-1', 'snap-vol-2-2']
+        assert plan['keep']['vol-1'] == [{'id': 'snap-vol-1-4', 'start_time': '2016-01-04T10:00:00.000Z', 'buckets': ['latest']},
+                                         {'id': 'snap-vol-1-3', 'start_time': '2016-01-03T10:00:00.000Z', 'buckets': ['latest']}]
+        assert plan['api_calls'] == {'DescribeVolumes': 1, 'DescribeSnapshots': 1, 'CreateSnapshot': 2,
+                                     'CreateTags': 0, 'DeleteSnapshot': 4}
+
+    def test_plan_is_deterministic(self):
+        first = json.dumps(create_monkey(create_connection()).plan(), sort_keys=True)
+        conn = create_connection()
+        conn.volumes.reverse()
+        conn.snapshots.reverse()
+        assert json.dumps(create_monkey(conn).plan(), sort_keys=True) == first
+
+    def test_plan_shows_retention_buckets(self):
+        policy = RetentionPolicy(latest=1, daily=2, weekly=1)
+        plan = create_monkey(create_connection(), policy=policy).plan(snapshot=False)
+        assert [(s['id'], s['buckets']) for s in plan['keep']['vol-2']] == [
+            ('snap-vol-2-4', ['daily', 'latest', 'weekly']), ('snap-vol-2-3', ['daily'])]
+        assert [s['id'] for s in plan['delete']['vol-2']] == ['snap-vol-2-1', 'snap-vol-2-2']
+
+    def test_partial_plans(self):
+        conn = create_connection()
+        plan = create_monkey(conn, tag_snapshots=True).plan(remove=False)
+        assert plan['delete'] == {}
+        assert plan['keep'] == {}
+        assert plan['api_calls']['CreateTags'] == 2
+        plan = create_monkey(conn).plan(snapshot=False)
+        assert plan['snapshot'] == []
+        assert plan['api_calls']['DescribeVolumes'] == 0
+
+    def test_apply_plan(self):
+        conn = create_connection()
+        plan = json.loads(json.dumps(create_monkey(conn).plan()))
+        conn.calls = []
+        assert create_monkey(conn).apply_plan(plan) == True
+        assert [call for call, args in conn.calls] == ['DescribeVolumes'] + ['CreateSnapshot'] * 2 + ['DeleteSnapshot'] * 4
+        assert sorted(s.id for s in conn.existing()) == ['snap-1', 'snap-2', 'snap-manual',
+                                                        'snap-vol-1-3', 'snap-vol-1-4', 'snap-vol-2-3', 'snap-vol-2-4']
+
+    def test_apply_stale_plan(self):
+        conn = create_connection()
+        plan = create_monkey(conn).plan()
+        conn.volumes.pop()
+        plan['delete']['vol-1'].append({'id': 'snap-manual', 'description': 'manual', 'start_time': ''})
+        assert create_monkey(conn).apply_plan(plan) == True
+        assert conn.created == ['vol-2']
+        assert 'snap-manual' in [s.id for s in conn.existing()]
+
+    def test_apply_plan_elsewhere(self):
+        conn = create_connection()
+        plan = create_monkey(conn).plan()
+        plan['region'] = 'eu-west-1'
+        self.assertRaises(BackupMonkeyException, create_monkey(conn).apply_plan, plan)
+        plan['region'] = 'us-west-2'
+        self.assertRaises(BackupMonkeyException, create_monkey(conn, policy=None).apply_plan, dict(plan, version=2))
+
+class PlanCLITest(TestCase):
+
+    def test_plan_and_apply(self):
+        conn = create_connection()
+        with tempfile.NamedTemporaryFile(suffix='.json') as fh:
+            with mock.patch('backup_monkey.core.BackupMonkey.get_connection', return_value=conn):
+                for argv in (['backup-monkey', '--region', 'us-west-2', '--max-snapshots-per-volume', '2',
+                              '--plan', fh.name],
+                             ['backup-monkey', '--apply-plan', fh.name]):
+                    with mock.patch('sys.argv', argv):
+                        with self.assertRaises(SystemExit) as e:
+                            cli.run()
+                    assert e.exception.code == 0
+                    if '--plan' in argv:
+                        assert len(conn.existing()) == 9
+                        plans = json.load(open(fh.name))['plans']
+                        assert [(p['region'], p['account']) for p in plans] == [('us-west-2', None)]
+        assert len(conn.existing()) == 7
@@ -0,0 +1,124 @@
+from unittest import TestCase
+import json
+import os
+import shutil
+import tempfile
+import mock
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.report import Result, RunReport, Summary
+from tests.unit.mocks import MockEC2Connection, create_monkey
+
+class SummaryTest(TestCase):
+
+    def test_totals(self):
+        summary = Summary()
+        summary.add(Result('snapshot', 'ok', 'vol-1', 'snap-1', size=8, seconds=0.5))
+        summary.add(Result('snapshot', 'ok', 'vol-2', 'snap-2', size=100, seconds=1.5))
+        summary.add(Result('snapshot', 'failed', 'vol-3', size=20, seconds=0.25, detail='InternalError'))
+        summary.add(Result('delete', 'ok', 'vol-1', 'snap-0'))
+        assert summary.count('snapshot') == 3
+        assert summary.count('snapshot', 'ok') == 2
+        assert summary.count('delete', 'failed') == 0
+        assert summary.count('copy') == 0
+        assert summary.gib('snapshot') == 108
+        assert summary.to_dict()['snapshot'] == {'statuses': {'ok': 2, 'failed': 1}, 'gib': 108,
+                                                 'bytes': 108 * 2 ** 30, 'seconds': 2.25, 'max_seconds': 1.5}
+
+    def test_result_leaves_out_unset_fields(self):
+        result = Result('delete', 'ok', 'vol-1', 'snap-1')
+        assert result.to_dict() == {'action': 'delete', 'status': 'ok', 'volume_id': 'vol-1', 'snapshot_id': 'snap-1'}
+        self.assertRaises(AttributeError, setattr, result, 'extra', 1)
+
+class RunReportTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'report.jsonl')
+        self.now = [1451606400.0]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_results_are_written_as_they_arrive(self):
+        report = RunReport(self.path, clock=lambda: self.now[0])
+        report.write('111111111111', 'us-east-1', Result('snapshot', 'ok', 'vol-1', 'snap-1', size=8))
+        assert self.read() == [{'type': 'result', 'account': '111111111111', 'region': 'us-east-1',
+                                'time': 1451606400.0, 'action': 'snapshot', 'status': 'ok',
+                                'volume_id': 'vol-1', 'snapshot_id': 'snap-1', 'size': 8}]
+        self.now[0] += 30
+        summary = report.close([('111111111111/us-east-1', None), ('111111111111/eu-west-1', 'Throttled')])
+        lines = self.read()
+        assert len(lines) == 2
+        assert lines[1] == summary
+        assert summary['seconds'] == 30
+        assert summary['results']['snapshot']['bytes'] == 8 * 2 ** 30
+        assert summary['targets'] == {'111111111111/us-east-1': None, '111111111111/eu-west-1': 'Throttled'}
+
+    def test_write_errors_do_not_fail_the_run(self):
+        report = RunReport(self.path)
+        report._fh = mock.Mock(**{'write.side_effect': IOError(28, 'No space left on device')})
+        report.write(None, 'us-east-1', Result('snapshot', 'ok', 'vol-1', 'snap-1'))
+        report.write(None, 'us-east-1', Result('snapshot', 'ok', 'vol-2', 'snap-2'))
+        assert report._fh.write.call_count == 1
+        assert report.summary.count('snapshot', 'ok') == 2
+
+class BackupMonkeyReportTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'report.jsonl')
+        self.conn = MockEC2Connection()
+        self.conn.start_time = '2016-01-04T10:00:00.000Z'
+        self.conn.add_volume('vol-1', 'i-1a2b3c4d', size=8)
+        self.conn.add_volume('vol-2', 'i-1a2b3c4d', size=100)
+        self.conn.add_volume('vol-3', size=20)
+        for day in (1, 2, 3):
+            self.conn.add_snapshot('snap-3-%d' % day, 'vol-3', start_time='2016-01-0%dT10:00:00.000Z' % day)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path) as fh:
+            return [json.loads(line) for line in fh]
+
+    def create_monkey(self, report, **kwargs):
+        return create_monkey(self.conn, 2, 'us-east-1', report=report, **kwargs)
+
+    def test_run(self):
+        report = RunReport(self.path)
+        monkey = self.create_monkey(report, concurrency=4)
+        created = monkey.snapshot_volumes()
+        assert created.count('snapshot', 'ok') == 3
+        assert created.gib('snapshot') == 128
+        deleted = monkey.remove_old_snapshots()
+        assert deleted.count('delete', 'ok') == 1
+        assert deleted.count('snapshot') == 0
+        assert monkey.results.count('snapshot', 'ok') == 3
+        report.close()
+
+        lines = self.read()
+        results = sorted((line['action'], line.get('volume_id'), line['status']) for line in lines[:-1])
+        assert results == [('delete', 'vol-3', 'ok'), ('snapshot', 'vol-1', 'ok'),
+                           ('snapshot', 'vol-2', 'ok'), ('snapshot', 'vol-3', 'ok')]
+        assert lines[-1]['type'] == 'summary'
+        assert lines[-1]['results']['delete']['gib'] == 8
+
+    def test_failed_and_skipped_volumes(self):
+        self.conn.broken = set(['vol-2'])
+        report = RunReport(self.path)
+        monkey = self.create_monkey(report, detached_interval=7 * 86400)
+        with mock.patch('time.time', return_value=1451822400.0):
+            self.assertRaises(BackupMonkeyException, monkey.snapshot_volumes)
+        report.close()
+
+        lines = dict((line.get('volume_id'), line) for line in self.read()[:-1])
+        assert lines['vol-1']['status'] == 'ok'
+        assert lines['vol-2']['status'] == 'failed'
+        assert lines['vol-2']['detail'] == 'InternalError'
+        assert lines['vol-3']['status'] == 'skipped'
+        assert monkey.results.count('snapshot', 'skipped') == 1
@@ -0,0 +1,212 @@
+from unittest import TestCase
+import calendar
+import random
+import time
+from backup_monkey.retention import GFSRetention, KeepNewest, RetentionPolicy, parse_start_time
+from tests.unit.mocks import MockEC2Connection, MockSnapshot, create_monkey
+
+def create_snapshots(volumes, per_volume):
+    ret = []
+    for v in range(volumes):
+        for day in range(1, per_volume + 1):
+            ret.append(MockSnapshot('snap-%04x%04x' % (v, day), 'vol-%08x' % v,
+                                    start_time='2016-01-%02dT10:00:00.000Z' % day))
+    return ret
+
+class ParseStartTimeTest(TestCase):
+
+    def test_parse(self):
+        assert parse_start_time('2016-01-01T10:00:00.000Z') == 1451642400
+        assert parse_start_time('2016-01-01T10:00:00Z') == 1451642400
+
+    def test_order(self):
+        times = ['2015-12-31T23:59:59.000Z', '2016-01-01T00:00:00.000Z', '2016-02-01T00:00:00.000Z']
+        assert sorted(times, key=parse_start_time) == times
+
+class KeepNewestTest(TestCase):
+
+    def test_keep_newest(self):
+        snapshots = create_snapshots(5, 10)
+        random.Random(1).shuffle(snapshots)
+        expired = []
+        retention = KeepNewest(3, expired.append)
+        for s in snapshots:
+            retention.add(s)
+        assert len(expired) == 35
+        for v in range(5):
+            kept = retention.kept('vol-%08x' % v)
+            assert [s.start_time[:10] for s in kept] == ['2016-01-10', '2016-01-09', '2016-01-08']
+            assert retention.counts['vol-%08x' % v] == 10
+        assert all(s.start_time[:10] < '2016-01-08' for s in expired)
+
+    def test_expired_as_soon_as_pushed_out(self):
+        expired = []
+        retention = KeepNewest(1, expired.append)
+        old, new = create_snapshots(1, 2)
+        retention.add(old)
+        assert expired == []
+        retention.add(new)
+        assert expired == [old]
+
+    def test_same_start_time(self):
+        expired = []
+        retention = KeepNewest(1, expired.append)
+        a = MockSnapshot('snap-a', 'vol-fb07ec3a', start_time='2016-01-01T10:00:00.000Z')
+        b = MockSnapshot('snap-b', 'vol-fb07ec3a', start_time='2016-01-01T10:00:00.000Z')
+        retention.add(b)
+        retention.add(a)
+        assert expired == [a]
+
+    def test_keep_none(self):
+        expired = []
+        retention = KeepNewest(0, expired.append)
+        for s in create_snapshots(2, 2):
+            retention.add(s)
+        assert len(expired) == 4
+
+def create_daily_snapshots(volume_id, days, start='2016-01-01'):
+    ''' One snapshot a day at 10:00, and the last day also at 11:00 and 12:00 '''
+    first = calendar.timegm(time.strptime(start, '%Y-%m-%d'))
+    ret = []
+    for day in range(days):
+        hours = (10, 11, 12) if day == days - 1 else (10,)
+        for hour in hours:
+            start_time = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(first + day * 86400 + hour * 3600))
+            ret.append(MockSnapshot('snap-%s-%03d-%02d' % (volume_id[-4:], day, hour), volume_id, start_time=start_time))
+    return ret
+
+def reference_gfs(snapshots, policy, now):
+    ''' The obvious (sort everything) way to evaluate a policy '''
+    snapshots = sorted(snapshots, key=lambda s: (parse_start_time(s.start_time), s.id), reverse=True)
+    if policy.max_age is not None:
+        snapshots = [s for s in snapshots if parse_start_time(s.start_time) >= now - policy.max_age]
+    kept = set(s.id for s in snapshots[:policy.latest])
+    for name, keep, period in policy.periods():
+        seen = []
+        for s in snapshots:
+            key = period(parse_start_time(s.start_time), s.start_time)
+            if key not in seen:
+                seen.append(key)
+                if len(seen) <= keep:
+                    kept.add(s.id)
+    return kept
+
+class GFSRetentionTest(TestCase):
+    now = calendar.timegm((2016, 5, 1, 0, 0, 0))
+
+    def evaluate(self, snapshots, policy):
+        expired = []
+        retention = GFSRetention(policy, expired.append, self.now)
+        for s in snapshots:
+            retention.add(s)
+        return retention, expired
+
+    def test_schedule(self):
+        snapshots = create_daily_snapshots('vol-fb07ec3a', 120)
+        retention, expired = self.evaluate(snapshots, RetentionPolicy(latest=2, daily=7, weekly=4, monthly=3))
+        kept = retention.kept('vol-fb07ec3a')
+        assert len(kept) + len(expired) == len(snapshots)
+        # Apr 29 12:00 and 11:00, Apr 23 to 28, the Sundays of the three weeks
+        # before that, and the ends of March and February
+        assert [s.start_time[:13] for s in kept] == [
+            '2016-04-29T12', '2016-04-29T11', '2016-04-28T10', '2016-04-27T10', '2016-04-26T10',
+            '2016-04-25T10', '2016-04-24T10', '2016-04-23T10', '2016-04-17T10', '2016-04-10T10',
+            '2016-03-31T10', '2016-02-29T10']
+        assert retention.buckets('vol-fb07ec3a', kept[0].id) == ['daily', 'latest', 'monthly', 'weekly']
+        assert retention.buckets('vol-fb07ec3a', kept[1].id) == ['latest']
+        assert retention.buckets('vol-fb07ec3a', kept[6].id) == ['daily', 'weekly']
+        assert retention.buckets('vol-fb07ec3a', kept[-1].id) == ['monthly']
+
+    def test_matches_reference_in_any_order(self):
+        policy = RetentionPolicy(latest=3, daily=7, weekly=4, monthly=12, max_age=100 * 86400)
+        snapshots = create_daily_snapshots('vol-fb07ec3a', 200) + create_daily_snapshots('vol-089322fc', 30)
+        for seed in range(5):
+            random.Random(seed).shuffle(snapshots)
+            retention, expired = self.evaluate(snapshots, policy)
+            for volume_id in ('vol-fb07ec3a', 'vol-089322fc'):
+                volume_snapshots = [s for s in snapshots if s.volume_id == volume_id]
+                kept = set(s.id for s in retention.kept(volume_id))
+                assert kept == reference_gfs(volume_snapshots, policy, self.now)
+            assert len(expired) + len(retention.kept('vol-fb07ec3a')) + len(retention.kept('vol-089322fc')) == len(snapshots)
+
+    def test_max_age(self):
+        snapshots = create_daily_snapshots('vol-fb07ec3a', 10, start='2016-04-01')
+        retention, expired = self.evaluate(snapshots, RetentionPolicy(latest=20, max_age=25 * 86400))
+        assert [s.start_time[:10] for s in retention.kept('vol-fb07ec3a')][-1] == '2016-04-06'
+        assert len(expired) == 5
+
+class PolicyBackupMonkeyTest(TestCase):
+
+    def test_remove_old_snapshots(self):
+        start = time.strftime('%Y-%m-%d', time.gmtime(time.time() - 59 * 86400))
+        conn = MockEC2Connection()
+        conn.snapshots = snapshots = create_daily_snapshots('vol-fb07ec3a', 60, start=start)
+        policy = RetentionPolicy(latest=1, daily=3, weekly=2, monthly=2)
+        create_monkey(conn, 1, policy=policy).remove_old_snapshots()
+        kept = set(s.id for s in snapshots if s.status == 'completed')
+        assert kept == reference_gfs(snapshots, policy, time.time())
+
+class NewestTest(TestCase):
+
+    def test_keep_newest(self):
+        retention = KeepNewest(1, lambda s: None)
+        for s in create_snapshots(2, 5):
+            retention.add(s)
+        assert retention.newest == {'vol-00000000': parse_start_time('2016-01-05T10:00:00.000Z'),
+                                    'vol-00000001': parse_start_time('2016-01-05T10:00:00.000Z')}
+
+    def test_gfs_counts_expired(self):
+        snapshots = create_daily_snapshots('vol-fb07ec3a', 3, start='2016-04-01')
+        retention = GFSRetention(RetentionPolicy(latest=1, max_age=86400), lambda s: None,
+                                 parse_start_time('2016-05-01T00:00:00.000Z'))
+        for s in snapshots:
+            retention.add(s)
+        assert retention.kept('vol-fb07ec3a') == []
+        assert retention.newest == {'vol-fb07ec3a': parse_start_time(snapshots[-1].start_time)}
+
+def listings(conn):
+    return len([filters for filters in conn.sent('DescribeSnapshots') if 'snapshot-id' not in filters])
+
+class DetachedIntervalTest(TestCase):
+
+    def setUp(self):
+        self.conn = MockEC2Connection()
+        for volume_id, instance_id in (('vol-attached', 'i-1'), ('vol-recent', None), ('vol-stale', None),
+                                       ('vol-new', None)):
+            self.conn.add_volume(volume_id, instance_id)
+        for volume_id, days_ago in (('vol-attached', 1), ('vol-recent', 1), ('vol-recent', 2), ('vol-stale', 8),
+                                    ('vol-stale', 9)):
+            start_time = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(time.time() - days_ago * 86400))
+            self.conn.add_snapshot('snap-%s-%d' % (volume_id, days_ago), volume_id, start_time=start_time)
+        self.snapshots = self.conn.snapshots
+
+    def create_monkey(self):
+        return create_monkey(self.conn, 1, detached_interval=7 * 86400)
+
+    def test_snapshot_and_remove(self):
+        monkey = self.create_monkey()
+        monkey.snapshot_volumes()
+        assert self.conn.created == ['vol-attached', 'vol-stale', 'vol-new']
+        assert [volume_id for volume_id, reason in monkey.skipped] == ['vol-recent']
+        assert monkey.skipped[0][1].startswith('detached, newest snapshot 1.0 days old')
+        assert monkey.metrics.counters['volumes_skipped'] == 1
+        monkey.remove_old_snapshots()
+        # The snapshots were listed once, for both
+        assert listings(self.conn) == 1
+        assert [s.id for s in self.snapshots if s.status == 'deleted'] == ['snap-vol-recent-2', 'snap-vol-stale-9']
+
+    def test_waited_for_snapshots_count_towards_retention(self):
+        self.conn.start_time = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+        monkey = self.create_monkey()
+        monkey.snapshot_volumes()
+        # The new snapshots complete, and are listed from now on
+        monkey.wait_for_snapshots(min_interval=0)
+        monkey.remove_old_snapshots()
+        assert listings(self.conn) == 2
+        assert sorted(s.id for s in self.snapshots if s.status == 'deleted') == \
+            ['snap-vol-attached-1', 'snap-vol-recent-2', 'snap-vol-stale-8', 'snap-vol-stale-9']
+
+    def test_plan(self):
+        plan = self.create_monkey().plan(remove=False)
+        assert [v['volume_id'] for v in plan['snapshot']] == ['vol-attached', 'vol-new', 'vol-stale']
+        assert plan['delete'] == {}
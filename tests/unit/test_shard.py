@@ -0,0 +1,54 @@
+from unittest import TestCase
+import zlib
+from backup_monkey.core import TAG_GROUP
+from tests.unit.mocks import MockEC2Connection, create_monkey
+
+class ShardTest(TestCase):
+
+    def setUp(self):
+        self.conn = MockEC2Connection()
+        for i in range(40):
+            self.conn.add_volume('vol-%08x' % i, 'i-%08x' % (i // 4))
+            for hour in range(5):
+                self.conn.add_snapshot('snap-%08x%02d' % (i, hour), 'vol-%08x' % i,
+                                       start_time='2016-01-01T%02d:00:00.000Z' % hour)
+        self.volumes = self.conn.volumes
+        self.snapshots = self.conn.snapshots
+
+    def create_monkey(self, shard_index=0, shard_count=1, **kwargs):
+        return create_monkey(self.conn, 3, 'us-east-1', shard_index=shard_index, shard_count=shard_count, **kwargs)
+
+    def test_stable_hash(self):
+        monkey = self.create_monkey(1, 3)
+        # The same on every host and process, unlike hash()
+        assert monkey.in_shard('vol-00000000') == ((zlib.crc32('vol-00000000') & 0xffffffff) % 3 == 1)
+        assert self.create_monkey().in_shard('vol-00000000')
+
+    def test_volumes_split_without_overlap(self):
+        shards = [[v.id for v in self.create_monkey(i, 3).get_volumes_to_snapshot()] for i in range(3)]
+        assert all(shards)
+        assert sorted(sum(shards, [])) == sorted(v.id for v in self.volumes)
+
+    def test_group_by_instance(self):
+        for i in range(3):
+            volumes = self.create_monkey(i, 3, group_by_instance=True).get_volumes_to_snapshot()
+            # Each instance's volumes are all in one shard
+            instances = set(v.attach_data.instance_id for v in volumes)
+            assert len(volumes) == 4 * len(instances)
+
+    def test_retention_split_without_overlap(self):
+        expected = sorted(s.id for s in self.create_monkey().get_expired_snapshots())
+        shards = [self.create_monkey(i, 3).get_expired_snapshots() for i in range(3)]
+        assert all(shards)
+        assert sorted(s.id for shard in shards for s in shard) == expected
+        for i, shard in enumerate(shards):
+            monkey = self.create_monkey(i, 3)
+            assert all(monkey.in_shard(s.volume_id) for s in shard)
+
+    def test_grouped_snapshots(self):
+        for s in self.snapshots:
+            instance_id = 'i-%08x' % (int(s.volume_id[4:], 16) // 4)
+            s.tags = {TAG_GROUP: '%s/run-%s' % (instance_id, s.start_time[11:13])}
+        expected = sorted(s.id for s in self.create_monkey(group_by_instance=True).get_expired_snapshots())
+        shards = [self.create_monkey(i, 3, group_by_instance=True).get_expired_snapshots() for i in range(3)]
+        assert sorted(s.id for shard in shards for s in shard) == expected
@@ -0,0 +1,115 @@
+from unittest import TestCase
+import mock
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.retention import RetentionPolicy
+from tests.unit.mocks import MockEC2Connection, create_monkey
+
+def create_connection(instances):
+    conn = MockEC2Connection()
+    conn.start_time = '2016-01-02T10:00:00.000Z'
+    for i, instance_id in enumerate(instances):
+        conn.add_volume('vol-%08x' % i, instance_id, device='/dev/sdf' if instance_id else None)
+    return conn
+
+class TagSnapshotsTest(TestCase):
+
+    def create_monkey(self, conn, label=None, **kwargs):
+        return create_monkey(conn, label=label, run_id='run-1', **kwargs)
+
+    def test_not_tagged_by_default(self):
+        conn = create_connection(['i-1', 'i-1'])
+        assert self.create_monkey(conn).snapshot_volumes().count('snapshot', 'ok') == 2
+        assert conn.sent('CreateTags') == []
+
+    def test_tags(self):
+        conn = create_connection(['i-1', None])
+        self.create_monkey(conn, 'daily', tag_snapshots=True).snapshot_volumes()
+        assert conn.snapshots[0].tags == {'backup-monkey:label': 'daily', 'backup-monkey:policy': 'latest=3',
+                                          'backup-monkey:run-id': 'run-1', 'backup-monkey:instance': 'i-1'}
+        assert conn.snapshots[1].tags == {'backup-monkey:label': 'daily', 'backup-monkey:policy': 'latest=3',
+                                          'backup-monkey:run-id': 'run-1'}
+
+    def test_policy_tag(self):
+        conn = create_connection([None])
+        policy = RetentionPolicy(latest=2, daily=7, weekly=4, max_age=90 * 86400)
+        self.create_monkey(conn, tag_snapshots=True, policy=policy).snapshot_volumes()
+        assert conn.snapshots[0].tags['backup-monkey:policy'] == 'latest=2,daily=7,weekly=4,max-age=90d'
+
+    @mock.patch('backup_monkey.core.TAG_BATCH_SIZE', 3)
+    def test_batched_by_tags(self):
+        conn = create_connection(['i-1'] * 4 + ['i-2'] * 2 + [None] * 3)
+        self.create_monkey(conn, tag_snapshots=True).snapshot_volumes()
+        assert [(len(ids), tags.get('backup-monkey:instance')) for ids, tags in conn.sent('CreateTags')] == \
+            [(3, 'i-1'), (1, 'i-1'), (2, 'i-2'), (3, None)]
+        assert all(s.tags for s in conn.snapshots)
+
+    def test_tagging_failure_fails_the_run(self):
+        conn = create_connection(['i-1', 'i-2'])
+        conn.broken = set(['snap-00000001'])
+        monkey = self.create_monkey(conn, tag_snapshots=True)
+        self.assertRaises(BackupMonkeyException, monkey.snapshot_volumes)
+        assert len(conn.snapshots) == 2
+
+class MatchSnapshotTagsTest(TestCase):
+
+    def create_monkey(self, conn, label=None):
+        return create_monkey(conn, 1, label=label, match_snapshot_tags=True)
+
+    def test_filters(self):
+        conn = create_connection([])
+        assert self.create_monkey(conn, 'daily').get_snapshot_filters() == \
+            {'tag:backup-monkey:label': 'daily', 'status': 'completed'}
+        assert self.create_monkey(conn).get_snapshot_filters() == \
+            {'tag-key': 'backup-monkey:label', 'status': 'completed'}
+
+    def test_untagged_snapshots_are_left_alone(self):
+        conn = create_connection([])
+        conn.add_snapshot('snap-1', 'vol-1', 'BACKUP_MONKEY daily vol-1', '2016-01-01T10:00:00.000Z')
+        conn.add_snapshot('snap-2', 'vol-1', 'BACKUP_MONKEY daily vol-1', '2016-01-02T10:00:00.000Z',
+                          tags={'backup-monkey:label': 'daily'})
+        conn.add_snapshot('snap-3', 'vol-1', 'BACKUP_MONKEY daily vol-1', '2016-01-03T10:00:00.000Z',
+                          tags={'backup-monkey:label': 'daily'})
+        conn.add_snapshot('snap-4', 'vol-1', 'BACKUP_MONKEY weekly vol-1', '2016-01-01T10:00:00.000Z',
+                          tags={'backup-monkey:label': 'weekly'})
+        assert self.create_monkey(conn, 'daily').remove_old_snapshots().count('delete', 'ok') == 1
+        assert [s.status for s in conn.snapshots] == ['completed', 'deleted', 'completed', 'completed']
+
+class GroupByInstanceTest(TestCase):
+
+    def create_monkey(self, conn, keep=3, **kwargs):
+        return create_monkey(conn, keep, group_by_instance=True, **kwargs)
+
+    def test_group_volumes(self):
+        conn = create_connection(['i-1', None, 'i-2', 'i-1', None])
+        groups = self.create_monkey(conn).group_volumes(conn.volumes)
+        assert [[v.id[-1] for v in group] for group in groups] == [['0', '3'], ['1'], ['2'], ['4']]
+
+    def test_group_tags(self):
+        conn = create_connection(['i-1', 'i-1', 'i-2', None])
+        assert self.create_monkey(conn, run_id='run-1', concurrency=4).snapshot_volumes().count('snapshot', 'ok') == 4
+        assert [s.tags.get('backup-monkey:group') for s in sorted(conn.snapshots, key=lambda s: s.id)] == \
+            ['i-1/run-1', 'i-1/run-1', 'i-2/run-1', None]
+        assert len(conn.sent('CreateTags')) == 3
+
+    def group(self, conn, group_id, day, volume_ids):
+        for volume_id in volume_ids:
+            conn.add_snapshot('snap-%s-%s' % (group_id, volume_id), volume_id, 'BACKUP_MONKEY %s i-1' % volume_id,
+                              '2016-01-%02dT10:00:%02d.000Z' % (day, len(conn.snapshots)),
+                              tags={'backup-monkey:group': 'i-1/%s' % group_id})
+
+    def test_groups_are_removed_whole(self):
+        conn = create_connection([])
+        # A volume was added to the instance on the third day
+        self.group(conn, 'a', 1, ['vol-1', 'vol-2'])
+        self.group(conn, 'b', 2, ['vol-1', 'vol-2'])
+        self.group(conn, 'c', 3, ['vol-1', 'vol-2', 'vol-3'])
+        assert self.create_monkey(conn, keep=2).remove_old_snapshots().count('delete', 'ok') == 2
+        assert sorted(s.id for s in conn.snapshots if s.status == 'deleted') == ['snap-a-vol-1', 'snap-a-vol-2']
+
+    def test_max_deletes_does_not_split_groups(self):
+        conn = create_connection([])
+        self.group(conn, 'a', 1, ['vol-1', 'vol-2'])
+        self.group(conn, 'b', 2, ['vol-1', 'vol-2'])
+        self.group(conn, 'c', 3, ['vol-1', 'vol-2'])
+        assert self.create_monkey(conn, keep=1, max_deletes_per_run=3).remove_old_snapshots().count('delete', 'ok') == 2
+        assert sorted(s.id for s in conn.snapshots if s.status == 'deleted') == ['snap-a-vol-1', 'snap-a-vol-2']
@@ -1,6 +1,8 @@
 from unittest import TestCase
 import mock
 from backup_monkey.core import BackupMonkey
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.tags import TagMatcher, TagRule, parse_tag_selector
 
 class MockVolume(object):
     def __init__(self, id, tags={}):
@@ -69,7 +71,7 @@ class MockEC2Connection(object):
                 return [v for v in volumes if 'name' in v.tags and v.tags['name'] == filters['tag:name']]
         return volumes
 
-    def get_all_snapshots(self, owner='self'):
+    def get_all_snapshots(self, owner='self', filters=None):
         return self.snapshots
 
 def mock_get_connection():
@@ -174,3 +176,99 @@ class LabelTest(TestCase):
         end_snapshot = filter(lambda x: x.status == 'completed', snaps)
         assert len(init_snapshot) == 4
         assert len(end_snapshot) == 3
+
+class TagMatcherTest(TestCase):
+
+    def test_rule(self):
+        rule = TagRule('name', ['foo', 'bar*'])
+        assert rule.match('foo')
+        assert rule.match('bar')
+        assert rule.match('barbaz')
+        assert not rule.match('foobar')
+        assert TagRule('name').match('anything')
+        assert TagRule('name', ['*']).match('anything')
+
+    def test_filters(self):
+        matcher = TagMatcher(include=[TagRule('name', ['foo']), TagRule('env', ['prod', 'stag*']), TagRule('backup')])
+        assert matcher.filters() == {'tag:name': 'foo', 'tag:env': ['prod', 'stag*'], 'tag-key': 'backup'}
+        assert not matcher.needs_local_check()
+
+    def test_rules_ec2_cannot_check(self):
+        matcher = TagMatcher(include=[TagRule('backup'), TagRule('owner'), TagRule('name', ['foo*']),
+                                      TagRule('name', ['*bar'])])
+        assert matcher.filters() == {'tag-key': 'backup', 'tag:name': 'foo*'}
+        assert matcher.needs_local_check()
+        assert matcher.match({'backup': 'yes', 'owner': 'me', 'name': '*bar'})
+        assert not matcher.match({'backup': 'yes', 'name': '*bar'})
+
+    def test_filters_escape_wildcards(self):
+        # Only the trailing * of a prefix is a wildcard, on EC2 as here
+        matcher = TagMatcher(include=[TagRule('name', ['a?c']), TagRule('env', ['*prod', 'st*g*']),
+                                      TagRule('path', ['c:\\tmp']), TagRule('key*')])
+        assert matcher.filters() == {'tag:name': 'a\\?c', 'tag:env': ['\\*prod', 'st\\*g*'],
+                                     'tag:path': 'c:\\\\tmp', 'tag-key': 'key\\*'}
+        assert TagRule('name', ['a?c']).match('a?c') and not TagRule('name', ['a?c']).match('abc')
+
+    def test_include_and_exclude(self):
+        matcher = TagMatcher(include=[TagRule('env', ['prod'])],
+                             exclude=[TagRule('name', ['scratch-*']), TagRule('name', ['tmp']), TagRule('nobackup')])
+        assert matcher.filters() == {'tag:env': 'prod'}
+        assert matcher.match({'env': 'prod', 'name': 'db'})
+        assert not matcher.match({'env': 'prod', 'name': 'scratch-1'})
+        assert not matcher.match({'env': 'prod', 'name': 'tmp'})
+        assert not matcher.match({'env': 'prod', 'nobackup': ''})
+
+    @mock.patch('backup_monkey.core.BackupMonkey.get_connection', side_effect=mock_get_connection)
+    def test_exclude_tags(self, mock):
+        monkey = BackupMonkey('us-west-2', 3, [], None, None, None, None, exclude_tags=["name:['bar','foo']"])
+        assert monkey.get_volumes_to_snapshot() == [a, b, match_tag_or_2]
+
+    @mock.patch('backup_monkey.core.BackupMonkey.get_connection', side_effect=mock_get_connection)
+    def test_tags_and_exclude_tags(self, mock):
+        monkey = BackupMonkey('us-west-2', 3, tag, None, None, None, None, exclude_tags=['customer:bar'])
+        assert monkey.get_volumes_to_snapshot() == [match_tag]
+
+class TagSelectorTest(TestCase):
+
+    def parse(self, text):
+        negated, rule = parse_tag_selector(text)
+        return negated, rule.key, rule.values
+
+    def test_value(self):
+        assert self.parse('name:foo') == (False, 'name', ['foo'])
+        assert self.parse('name:foo:bar') == (False, 'name', ['foo:bar'])
+        assert self.parse('name:') == (False, 'name', [''])
+        assert self.parse('name') == (False, 'name', [])
+
+    def test_list(self):
+        assert self.parse("name:['bar','baz']") == (False, 'name', ['bar', 'baz'])
+        assert self.parse('name:[bar, baz*]') == (False, 'name', ['bar', 'baz*'])
+        assert self.parse('name:["a,b", \'c]\']') == (False, 'name', ['a,b', 'c]'])
+
+    def test_negation_and_quoted_key(self):
+        assert self.parse('!env:dev*') == (True, 'env', ['dev*'])
+        assert self.parse('"aws:autoscaling:groupName":web') == (False, 'aws:autoscaling:groupName', ['web'])
+
+    def test_no_code_is_run(self):
+        assert self.parse("name:__import__('os').getcwd()") == (False, 'name', ["__import__('os').getcwd()"])
+
+    def test_invalid(self):
+        for text in ['', ':foo', '!', "name:['bar'", 'name:[bar] baz', '"name:foo', '"name"foo']:
+            self.assertRaises(ValueError, parse_tag_selector, text)
+
+    def test_compile(self):
+        matcher = TagMatcher.compile(['env:prod', '!name:scratch-*'], ['nobackup'])
+        assert matcher.filters() == {'tag:env': 'prod'}
+        assert matcher.match({'env': 'prod', 'name': 'db'})
+        assert not matcher.match({'env': 'prod', 'name': 'scratch-1'})
+        assert not matcher.match({'env': 'prod', 'nobackup': 'yes'})
+
+    def test_compile_reverse(self):
+        matcher = TagMatcher.compile(['name:foo', '!env:prod'], reverse=True)
+        assert matcher.filters() == {'tag:env': 'prod'}
+        assert not matcher.match({'env': 'prod', 'name': 'foo'})
+
+    @mock.patch('backup_monkey.core.BackupMonkey.get_connection', side_effect=mock_get_connection)
+    def test_invalid_tag_parameter(self, mock):
+        monkey = BackupMonkey('us-west-2', 3, ['name:[foo'], None, None, None, None)
+        self.assertRaises(BackupMonkeyException, monkey.get_volumes_to_snapshot)
@@ -0,0 +1,196 @@
+from unittest import TestCase
+import socket
+import threading
+import mock
+from boto.exception import EC2ResponseError
+from backup_monkey.core import BackupMonkey
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.connections import ConnectionPool
+from backup_monkey.throttle import RateLimiter, is_retryable_error, is_throttle_error
+from tests.unit.mocks import FakeClock, MockEC2Connection, create_monkey, throttle_error
+
+def create_limiter(clock, rate=10.0, max_retries=8):
+    return RateLimiter(rate, max_retries=max_retries, clock=clock.time, sleep=clock.sleep, random=lambda: 1.0)
+
+class ThrottlingEC2Connection(MockEC2Connection):
+    ''' Raises RequestLimitExceeded for every `throttle_every`th call '''
+    def __init__(self, throttle_every):
+        MockEC2Connection.__init__(self)
+        self.throttle_every = throttle_every
+        self.attempts = 0
+        self.throttled = 0
+        for i in range(10):
+            self.add_volume('vol-%08x' % i)
+
+    def maybe_throttle(self):
+        self.attempts += 1
+        if self.throttle_every and self.attempts % self.throttle_every == 0:
+            self.throttled += 1
+            raise throttle_error()
+
+    def get_all_volumes(self, filters=None):
+        self.maybe_throttle()
+        return MockEC2Connection.get_all_volumes(self, filters)
+
+    def create_snapshot(self, volume_id, description=None):
+        self.maybe_throttle()
+        return MockEC2Connection.create_snapshot(self, volume_id, description)
+
+class RateLimiterTest(TestCase):
+
+    def test_is_throttle_error(self):
+        assert is_throttle_error(throttle_error())
+        assert not is_throttle_error(EC2ResponseError(400, 'Bad Request'))
+        assert not is_throttle_error(ValueError())
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock, rate=5)
+        for i in range(15):
+            limiter.acquire()
+        # The first 5 calls use up the burst, the next 10 are paced at 5 per second
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_retry_with_backoff(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock)
+        func = mock.Mock(side_effect=[throttle_error(), throttle_error(), 'ok'])
+        assert limiter.call(func, 'arg') == 'ok'
+        assert func.call_count == 3
+        assert 0.5 in clock.sleeps and 1.0 in clock.sleeps
+        # The second throttle came within a second of the first, so only one
+        # halved the rate, which then grew by 10%/s for the 1.5s of backoff
+        self.assertAlmostEqual(limiter.rate, 5.0 * 1.15)
+
+    def test_gives_up(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock, max_retries=2)
+        func = mock.Mock(side_effect=throttle_error())
+        self.assertRaises(EC2ResponseError, limiter.call, func)
+        assert func.call_count == 3
+
+    def test_other_errors_are_not_retried(self):
+        limiter = create_limiter(FakeClock())
+        func = mock.Mock(side_effect=EC2ResponseError(400, 'Bad Request'))
+        self.assertRaises(EC2ResponseError, limiter.call, func)
+        assert func.call_count == 1
+
+    def test_server_errors_are_retried_without_slowing_down(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock)
+        assert is_retryable_error(EC2ResponseError(500, 'Internal Server Error'))
+        assert is_retryable_error(socket.error(104, 'Connection reset by peer'))
+        func = mock.Mock(side_effect=[EC2ResponseError(500, 'Internal Server Error'), socket.timeout(), 'ok'])
+        assert limiter.call(func) == 'ok'
+        assert func.call_count == 3
+        assert limiter.rate == 10.0
+
+    def test_rate_recovers(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock)
+        limiter.throttled()
+        clock.sleep(1.0)
+        limiter.throttled()
+        assert limiter.rate == 2.5
+        for i in range(100):
+            limiter.call(lambda: None)
+        assert limiter.rate == 10.0
+
+    def test_increase_is_proportional(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock, rate=400)
+        limiter.throttled()
+        assert limiter.rate == 200
+        clock.sleep(1.0)
+        limiter.succeeded()
+        self.assertAlmostEqual(limiter.rate, 220)
+        clock.sleep(0.5)
+        limiter.succeeded()
+        self.assertAlmostEqual(limiter.rate, 231)
+
+    def test_simultaneous_throttles_decrease_once(self):
+        clock = FakeClock()
+        limiter = create_limiter(clock, rate=400)
+        start = threading.Event()
+        def throttled():
+            start.wait()
+            limiter.throttled()
+        threads = [threading.Thread(target=throttled) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        assert limiter.rate == 200
+        clock.sleep(1.0)
+        limiter.throttled()
+        assert limiter.rate == 100
+
+    def test_concurrent_calls_throttled_at_once(self):
+        limiter = RateLimiter(400, base_delay=0.001, max_delay=0.001, random=lambda: 1.0)
+        barrier = threading.Semaphore(0)
+        calls = []
+        lock = threading.Lock()
+        def func():
+            with lock:
+                calls.append(1)
+                first = len(calls) <= 8
+            if first:
+                # Hold every thread's first call until all eight are in flight
+                if len(calls) == 8:
+                    for i in range(8):
+                        barrier.release()
+                barrier.acquire()
+                raise throttle_error()
+            return 'ok'
+        threads = [threading.Thread(target=limiter.call, args=(func, )) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 16
+        assert limiter.rate >= 200
+
+class ThrottledBackupMonkeyTest(TestCase):
+
+    def create_monkey(self, conn, **kwargs):
+        return create_monkey(conn, limiter=create_limiter(FakeClock(), **kwargs))
+
+    def test_snapshot_volumes_survives_throttling(self):
+        conn = ThrottlingEC2Connection(throttle_every=3)
+        assert self.create_monkey(conn).snapshot_volumes().count('snapshot', 'ok') == 10
+        assert conn.throttled > 0
+        assert sorted(conn.created) == sorted(v.id for v in conn.volumes)
+
+    def test_listing_gives_up(self):
+        conn = ThrottlingEC2Connection(throttle_every=1)
+        monkey = self.create_monkey(conn, max_retries=1)
+        self.assertRaises(EC2ResponseError, monkey.snapshot_volumes)
+        assert conn.attempts == 2
+
+    def test_throttled_volume_is_reported(self):
+        conn = ThrottlingEC2Connection(throttle_every=0)
+        conn.volumes[3].create_snapshot = mock.Mock(side_effect=throttle_error())
+        monkey = self.create_monkey(conn, max_retries=1)
+        self.assertRaises(BackupMonkeyException, monkey.snapshot_volumes)
+        assert len(conn.created) == 9
+
+class BotoRetriesTest(TestCase):
+
+    @mock.patch('boto.ec2.connect_to_region')
+    def test_boto_does_not_retry(self, connect_to_region):
+        # Left to boto, a throttled call would be retried 6 times before the
+        # rate limiter saw it
+        connect_to_region.return_value = mock.Mock(num_retries=6)
+        monkey = BackupMonkey('us-east-1', 3, [], None, None, None, None)
+        assert monkey._conn.num_retries == 0
+
+    @mock.patch('boto.ec2.connect_to_region')
+    def test_pooled_connection_does_not_retry(self, connect_to_region):
+        pool = ConnectionPool()
+        connect_to_region.return_value = mock.Mock(num_retries=6)
+        BackupMonkey('us-east-1', 3, [], None, None, None, None, connections=pool)
+        connect_to_region.return_value.num_retries = 6
+        monkey = BackupMonkey('us-east-1', 3, [], None, None, None, None, connections=pool)
+        assert connect_to_region.call_count == 1
+        assert monkey._conn.num_retries == 0
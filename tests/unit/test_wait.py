@@ -0,0 +1,96 @@
+from unittest import TestCase
+from backup_monkey.exceptions import BackupMonkeyException
+from backup_monkey.waiter import SnapshotWaiter, percentile
+from tests.unit.mocks import FakeClock, MockEC2Connection, create_monkey
+
+class PollingEC2Connection(MockEC2Connection):
+    ''' A volume for each of `polls`, the number of polls before its
+    snapshots complete, or 'error' '''
+    def __init__(self, polls):
+        MockEC2Connection.__init__(self)
+        self.start_time = '2016-01-01T10:00:00.000Z'
+        self.polls = {}
+        for i, p in enumerate(polls):
+            self.add_volume('vol-%08x' % i)
+            self.polls['vol-%08x' % i] = p
+
+    def create_snapshot(self, volume_id, description=None):
+        snapshot = MockEC2Connection.create_snapshot(self, volume_id, description)
+        snapshot.polls = self.polls[volume_id]
+        return snapshot
+
+def describe(conn):
+    return lambda ids: conn.get_all_snapshots(filters={'snapshot-id': ids})
+
+def describe_calls(conn):
+    return [len(filters['snapshot-id']) for filters in conn.sent('DescribeSnapshots') if 'snapshot-id' in filters]
+
+class SnapshotWaiterTest(TestCase):
+
+    def test_percentile(self):
+        assert percentile([], 50) is None
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile(range(1, 101), 90) == 90
+        assert percentile([5], 99) == 5
+
+    def test_batches_and_adaptive_interval(self):
+        conn = PollingEC2Connection([1] * 3 + [4] * 2)
+        for v in conn.volumes:
+            v.create_snapshot('BACKUP_MONKEY')
+        clock = FakeClock(1000.0)
+        waiter = SnapshotWaiter(describe(conn), min_interval=5, max_interval=20, batch_size=2,
+                                clock=clock, sleep=clock.sleep)
+        assert waiter.wait([s.id for s in conn.snapshots]) == True
+        # 5 snapshots in batches of 2, then only the 2 slow ones
+        assert describe_calls(conn) == [2, 2, 1, 2, 2, 2]
+        assert clock.sleeps == [5, 10, 20]
+        assert sorted(waiter.durations.values()) == [0, 0, 0, 35, 35]
+        assert waiter.summary() == 'p50 0s, p90 35s, max 35s'
+
+    def test_error_and_timeout(self):
+        conn = PollingEC2Connection(['error', 100, 1])
+        for v in conn.volumes:
+            v.create_snapshot('BACKUP_MONKEY')
+        clock = FakeClock(1000.0)
+        waiter = SnapshotWaiter(describe(conn), min_interval=5, max_interval=60, timeout=60,
+                                clock=clock, sleep=clock.sleep)
+        assert waiter.wait([s.id for s in conn.snapshots]) == False
+        assert waiter.failed == ['snap-00000000']
+        assert waiter.pending == ['snap-00000001']
+        assert waiter.durations.keys() == ['snap-00000002']
+        assert clock.now - 1000 <= 60
+
+    def test_missing_snapshot(self):
+        conn = PollingEC2Connection([3, 3])
+        for v in conn.volumes:
+            v.create_snapshot('BACKUP_MONKEY')
+        # Deleted before it completed, with no timeout to end the wait
+        del conn.snapshots[0]
+        clock = FakeClock(1000.0)
+        waiter = SnapshotWaiter(describe(conn), min_interval=5, max_interval=60, max_missing_polls=4,
+                                clock=clock, sleep=clock.sleep)
+        assert waiter.wait(['snap-00000000', 'snap-00000001']) == False
+        assert waiter.failed == ['snap-00000000']
+        assert waiter.pending == []
+        assert waiter.durations.keys() == ['snap-00000001']
+
+class WaitForSnapshotsTest(TestCase):
+
+    def test_wait(self):
+        conn = PollingEC2Connection([1, 2, 3])
+        monkey = create_monkey(conn)
+        assert monkey.snapshot_volumes().count('snapshot', 'ok') == 3
+        assert monkey.wait_for_snapshots(min_interval=0, max_interval=0) == True
+        assert [s.status for s in conn.snapshots] == ['completed'] * 3
+        assert describe_calls(conn) == [3, 2, 1]
+
+    def test_failed_snapshot(self):
+        conn = PollingEC2Connection([1, 'error'])
+        monkey = create_monkey(conn)
+        monkey.snapshot_volumes()
+        self.assertRaises(BackupMonkeyException, monkey.wait_for_snapshots, min_interval=0, max_interval=0)
+
+    def test_nothing_to_wait_for(self):
+        monkey = create_monkey(PollingEC2Connection([]))
+        monkey.snapshot_volumes()
+        assert monkey.wait_for_snapshots() == True